@@ -0,0 +1,114 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime
+from benchmark.sales_generator import generate_sales_csv
+
+
+def baseline_line_converter(inserting_line):
+    # Converter of stage ETL before compiled converters (stage/converters.py), it's the reference of speedups
+    from datetime import datetime
+    val_count = 6
+    types = {
+        0: lambda val: int(val),
+        1: lambda val: str(val),
+        2: lambda val: int(val),
+        3: lambda val: float(val),
+        4: lambda val: datetime.strptime(val, '%m/%d/%y %H:%M'),
+        5: lambda val: str(val),
+    }
+
+    return [types[i](inserting_line[i]) for i in range(val_count)]
+
+
+def valid_lines(path: str) -> list:
+    # Lines which reach converter in stage ETL: without headers and lines with empty values
+    with open(path, newline='') as f:
+        reader = csv.reader(f, delimiter=',')
+        header_line = next(reader, None)
+        return [line for line in reader if line != header_line and '' not in line]
+
+
+def best_seconds(func, repeats: int) -> float:
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def run_benchmark(rows: int, seed: int, repeats: int, batch_size: int) -> dict:
+    """
+    Measures throughput of stage CSV line conversion on synthetic file in Kaggle sales format:
+    the baseline converter, compiled line converter and batch converter (columnar, with NumPy if it's installed).
+    Every converter is built once per measurement, as it's built once per file by ETL, best of 'repeats' runs is taken.
+    :return: dict with results {converter: {'rows', 'seconds', 'rows_per_sec', 'speedup'}}
+    """
+    import stage.converters as converters
+    import stage.etl as stage_etl
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'sales.csv')
+        generate_sales_csv(path, rows, seed=seed)
+        lines = valid_lines(path)
+
+    def line_mode(convert):
+        return lambda: [convert(line) for line in lines]
+
+    def batch_mode(convert_batch):
+        return lambda: [row for start in range(0, len(lines), batch_size)
+                        for row in convert_batch(lines[start:start + batch_size])]
+
+    # Every converter has to give the same rows as the baseline one
+    expected = line_mode(baseline_line_converter)()
+    assert line_mode(stage_etl.sales_line_converter())() == expected
+    assert batch_mode(stage_etl.sales_batch_converter(stage_etl.sales_line_converter()))() == expected
+
+    modes = {
+        "baseline": lambda: line_mode(baseline_line_converter)(),
+        "compiled_line": lambda: line_mode(stage_etl.sales_line_converter())(),
+        "compiled_batch": lambda: batch_mode(stage_etl.sales_batch_converter(stage_etl.sales_line_converter()))()
+    }
+    results = {
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": converters.np.__version__ if converters.np is not None else None,
+        "settings": {"rows": rows, "seed": seed, "repeats": repeats, "batch_size": batch_size},
+        "converters": {}
+    }
+    baseline_seconds = None
+    for mode, func in modes.items():
+        seconds = best_seconds(func, repeats)
+        baseline_seconds = baseline_seconds or seconds
+        results["converters"][mode] = {
+            "rows": len(lines),
+            "seconds": round(seconds, 3),
+            "rows_per_sec": round(len(lines) / seconds),
+            "speedup": round(baseline_seconds / seconds, 2)
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of stage CSV line converters on synthetic sales data.")
+    parser.add_argument("--rows", type=int, default=200000, help="CSV lines to generate")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=10000, help="lines per batch of batch converter")
+    parser.add_argument("--output", help="JSON file for results")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.rows, args.seed, args.repeats, args.batch_size)
+    print(f"Python {results['python']}, NumPy {results['numpy'] or 'is not installed'}")
+    for mode, stats in results["converters"].items():
+        print(f"{mode:16} {stats['rows']:>10} rows {stats['seconds']:>8.3f} sec "
+              f"{stats['rows_per_sec']:>10} rows/sec  x{stats['speedup']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results are saved to {args.output}")
@@ -0,0 +1,193 @@
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from dotenv import dotenv_values
+from benchmark.sales_generator import generate_sales_csv
+
+env = dotenv_values()
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+STAGE_NEW_PATH = os.path.join(ROOT_PATH, 'stage', 'source_data', 'new')
+STAGE_PROCESSED_PATH = os.path.join(ROOT_PATH, 'stage', 'source_data', 'processed')
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_phase(func, *args) -> dict:
+    """
+    Runs benchmark phase in a new process, so peak RSS belongs to this phase only.
+    Phase function returns count of processed rows (and optionally other stats in dict).
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(_timed, func, *args).result()
+
+
+def _timed(func, *args) -> dict:
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    stats = result if isinstance(result, dict) else {"rows": result}
+    stats.update({
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(stats["rows"] / seconds) if seconds else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    })
+    return stats
+
+
+def generate(path: str, rows: int, header_rate: float, blank_rate: float, duplicate_rate: float, seed: int) -> dict:
+    counts = generate_sales_csv(path, rows, header_rate, blank_rate, duplicate_rate, seed)
+    return {"rows": rows, "lines": counts}
+
+
+def stage_parse_validate(path: str) -> int:
+    # CSV parsing, validation, type conversion and deduplication without database
+    import stage.etl as stage_etl
+    rows_count = 0
+    with open(path, newline='') as f, stage_etl.LineDeduplicator(stage_etl.DEDUP_MAX_MEMORY_LINES) as dedup:
+        reader = csv.reader(f, delimiter=',')
+        header_line = next(reader, None)
+        lines = stage_etl.validate_csv_lines(
+            reader, header_line, dedup, 0, stage_etl.sales_line_converter(), stage_etl.CONVERT_BATCH_SIZE)
+        for _, row, _ in lines:
+            if row:
+                rows_count += 1
+    return rows_count
+
+
+def stage_load(file: str) -> int:
+    # Whole stage ETL of the file: parsing, validation and insert
+    import stage.etl as stage_etl
+    connection = stage_etl.stage_connect()
+    try:
+        return stage_etl.etl_file(connection, file)
+    finally:
+        connection.close()
+        stage_etl.events.close()
+
+
+def ods_increment() -> dict:
+    import ods.etl as ods_etl
+    stage_connection = ods_etl.stage_connect()
+    ods_connection = ods_etl.ods_connect()
+    ods_connection_meta = ods_etl.ods_connect()
+    try:
+        dim_cache = ods_etl.load_dim_cache(ods_connection)
+        rows_count = ods_etl.run_etl(stage_connection, ods_connection, ods_connection_meta, dim_cache)
+        with ods_connection:
+            with ods_connection.cursor() as cur:
+                cur.execute("SELECT max(id) FROM etl_meta_info")
+                etl_meta_info_id = cur.fetchone()[0]
+        return {"rows": rows_count, "etl_meta_info_id": etl_meta_info_id}
+    finally:
+        ods_etl.events.close()
+        for connection in (stage_connection, ods_connection, ods_connection_meta):
+            connection.close()
+
+
+def ods_phases(etl_meta_info_id: int) -> dict:
+    # Exact durations, rows and peak RSS of ODS ETL phases are saved by ETL run itself (see etl_metrics.py)
+    import ods.etl as ods_etl
+    connection = ods_etl.ods_connect()
+    try:
+        with connection:
+            with connection.cursor() as cur:
+                cur.execute("SELECT phase_metrics FROM etl_meta_info WHERE id = %s", (etl_meta_info_id,))
+                row = cur.fetchone()
+                phase_metrics = row[0] if row and row[0] else {}
+                return {
+                    f"ods_{phase}": {
+                        "rows": stat["rows"],
+                        "seconds": stat["seconds"],
+                        "rows_per_sec": stat["rows_per_sec"],
+                        "peak_rss_mb": stat["peak_rss_mb"]
+                    }
+                    for phase, stat in phase_metrics.items()
+                }
+    finally:
+        connection.close()
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_PATH, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(rows: int, header_rate: float, blank_rate: float, duplicate_rate: float, seed: int,
+                  with_db=True, keep_file=False) -> dict:
+    """
+    Runs end-to-end benchmark: generates CSV file, parses it, loads it in stage and runs ODS increment.
+    :param with_db: False - only generation and parsing are measured, PostgreSQL is not needed
+    :return: dict with results, see README
+    """
+    file = f"benchmark_{rows}_{seed}_{int(time.time())}.csv"
+    path = os.path.join(STAGE_NEW_PATH, file)
+    os.makedirs(STAGE_NEW_PATH, exist_ok=True)
+    results = {
+        "revision": git_revision(),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "settings": {
+            "rows": rows, "header_rate": header_rate, "blank_rate": blank_rate,
+            "duplicate_rate": duplicate_rate, "seed": seed,
+            "env": {key: env.get(key) for key in (
+                "STAGE_LOAD_MODE", "STAGE_CHUNK_SIZE", "STAGE_CONVERT_BATCH_SIZE", "STAGE_WORKERS",
+                "ODS_TRANSFER_MODE", "ODS_PY_RESOLVE_MAX_ROWS"
+            ) if env.get(key) is not None}
+        },
+        "phases": {}
+    }
+    phases = results["phases"]
+    try:
+        phases["generate"] = run_phase(generate, path, rows, header_rate, blank_rate, duplicate_rate, seed)
+        phases["stage_parse_validate"] = run_phase(stage_parse_validate, path)
+        if with_db:
+            phases["stage_load"] = run_phase(stage_load, file)
+            phases["ods_increment"] = run_phase(ods_increment)
+            phases.update(ods_phases(phases["ods_increment"].pop("etl_meta_info_id")))
+    finally:
+        if not keep_file:
+            for file_path in (path, os.path.join(STAGE_PROCESSED_PATH, file)):
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end ETL benchmark on synthetic sales data.")
+    parser.add_argument("--rows", type=int, default=10000, help="CSV lines to generate (10k - 100M)")
+    parser.add_argument("--header-rate", type=float, default=0.002)
+    parser.add_argument("--blank-rate", type=float, default=0.002)
+    parser.add_argument("--duplicate-rate", type=float, default=0.001)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-db", action="store_true", help="measure only generation and parsing")
+    parser.add_argument("--keep-file", action="store_true", help="don't delete generated CSV file")
+    parser.add_argument("--output", help="JSON file for results")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.rows, args.header_rate, args.blank_rate, args.duplicate_rate, args.seed,
+        with_db=not args.no_db, keep_file=args.keep_file
+    )
+    for phase, stats in results["phases"].items():
+        print(f"{phase:22} {stats['rows']!s:>12} rows {stats['seconds']:>10.3f} sec "
+              f"{stats['rows_per_sec']!s:>10} rows/sec  peak RSS {stats.get('peak_rss_mb', '-')} MB")
+    output = args.output or f"benchmark_{results['revision'] or 'local'}_{args.rows}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results are saved to {output}")
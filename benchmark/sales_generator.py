@@ -0,0 +1,108 @@
+import argparse
+import csv
+import random
+from datetime import datetime, timedelta
+
+# Header and products of Kaggle sales dataset
+SALES_HEADER = ["Order ID", "Product", "Quantity Ordered", "Price Each", "Order Date", "Purchase Address"]
+SALES_PRODUCTS = {
+    "USB-C Charging Cable": 11.95,
+    "Lightning Charging Cable": 14.95,
+    "Wired Headphones": 11.99,
+    "AA Batteries (4-pack)": 3.84,
+    "AAA Batteries (4-pack)": 2.99,
+    "Apple Airpods Headphones": 150,
+    "Bose SoundSport Headphones": 99.99,
+    "27in FHD Monitor": 149.99,
+    "27in 4K Gaming Monitor": 389.99,
+    "34in Ultrawide Monitor": 379.99,
+    "iPhone": 700,
+    "Google Phone": 600,
+    "Vareebadd Phone": 400,
+    "Macbook Pro Laptop": 1700,
+    "ThinkPad Laptop": 999.99,
+    "20in Monitor": 109.99,
+    "Flatscreen TV": 300,
+    "LG Washing Machine": 600,
+    "LG Dryer": 600
+}
+SALES_CITIES = [
+    ("San Francisco", "CA 94016"), ("Los Angeles", "CA 90001"), ("New York City", "NY 10001"),
+    ("Boston", "MA 02215"), ("Atlanta", "GA 30301"), ("Dallas", "TX 75001"), ("Seattle", "WA 98101"),
+    ("Portland", "OR 97035"), ("Portland", "ME 04101"), ("Austin", "TX 73301")
+]
+SALES_STREETS = ["Main St", "Park St", "Oak St", "Pine St", "Maple St", "Cedar St", "Elm St", "Lake St",
+                 "Hill St", "Washington St", "1st St", "2nd St", "Church St", "Center St", "Spruce St"]
+
+
+def generate_sales_csv(
+        path: str, rows: int, header_rate=0.002, blank_rate=0.002, duplicate_rate=0.001,
+        seed=42, start_order_id=176558, year=2019) -> dict:
+    """
+    Writes synthetic CSV file in Kaggle sales format. File is written by stream, so size is not limited by memory.
+    Besides order lines, file contains the same garbage as source files: repeated header lines,
+    blank lines (',,,,,') and duplicated lines.
+    :param path: CSV file path
+    :param rows: count of lines after the first header line (order lines and garbage lines)
+    :param header_rate: share of repeated header lines
+    :param blank_rate: share of blank lines
+    :param duplicate_rate: share of duplicated order lines
+    :param seed: seed of random generator, the same seed gives the same file
+    :return: dict with counts of lines by kind
+    """
+    rnd = random.Random(seed)
+    products = list(SALES_PRODUCTS.items())
+    addresses = [f"{rnd.randint(1, 999)} {rnd.choice(SALES_STREETS)}, {city}, {state}"
+                 for city, state in SALES_CITIES for _ in range(2000)]
+    start = datetime(year, 1, 1)
+    minutes_in_year = 365 * 24 * 60
+    blank_line = [""] * len(SALES_HEADER)
+    counts = {"orders": 0, "order_lines": 0, "headers": 0, "blanks": 0, "duplicates": 0}
+    garbage_limits = (header_rate, header_rate + blank_rate, header_rate + blank_rate + duplicate_rate)
+    order_id = start_order_id - 1
+    order_lines_left = 0
+    previous = None
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SALES_HEADER)
+        for _ in range(rows):
+            dice = rnd.random()
+            if dice < garbage_limits[0]:
+                writer.writerow(SALES_HEADER)
+                counts["headers"] += 1
+                continue
+            if dice < garbage_limits[1]:
+                writer.writerow(blank_line)
+                counts["blanks"] += 1
+                continue
+            if dice < garbage_limits[2] and previous:
+                writer.writerow(previous)
+                counts["duplicates"] += 1
+                continue
+            if not order_lines_left:
+                # New order: 1-3 lines with the same date and address
+                order_id += 1
+                order_lines_left = rnd.choice((1, 1, 1, 1, 2, 3))
+                order_date = (start + timedelta(minutes=rnd.randrange(minutes_in_year))).strftime("%m/%d/%y %H:%M")
+                address = rnd.choice(addresses)
+                counts["orders"] += 1
+            order_lines_left -= 1
+            product, price = rnd.choice(products)
+            quantity = 1 if price > 100 else rnd.choice((1, 1, 1, 2, 3))
+            previous = [order_id, product, quantity, price, order_date, address]
+            writer.writerow(previous)
+            counts["order_lines"] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates synthetic sales CSV file in Kaggle format.")
+    parser.add_argument("path")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--header-rate", type=float, default=0.002)
+    parser.add_argument("--blank-rate", type=float, default=0.002)
+    parser.add_argument("--duplicate-rate", type=float, default=0.001)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    print(generate_sales_csv(
+        args.path, args.rows, args.header_rate, args.blank_rate, args.duplicate_rate, args.seed))
@@ -5,16 +5,52 @@
 #  'БД'
 #  'ETL'
 # Почитать про ORM
+import re
+from datetime import date, datetime, timedelta
 
+# Fastest python parsers of string values for SQL types
+sql_type_parsers = {
+    "SMALLINT": int,
+    "INT": int,
+    "INTEGER": int,
+    "BIGINT": int,
+    "DECIMAL": float,
+    "NUMERIC": float,
+    "REAL": float,
+    "FLOAT": float,
+    "VARCHAR": str,
+    "CHAR": str,
+    "TEXT": str,
+    "DATE": date.fromisoformat,
+    "TIMESTAMP": datetime.fromisoformat
+}
 
+# NumPy dtypes for vectorized casting of string values
+sql_type_numpy_dtypes = {
+    "SMALLINT": "int64",
+    "INT": "int64",
+    "INTEGER": "int64",
+    "BIGINT": "int64",
+    "DECIMAL": "float64",
+    "NUMERIC": "float64",
+    "REAL": "float64",
+    "FLOAT": "float64"
+}
 
-def create_table_ddl(table_name: str, table_dict: dict, is_temp=False) -> str:
+
+def create_table_ddl(
+        table_name: str, table_dict: dict, is_temp=False, partition_by: str = None, primary_key: tuple = None
+) -> str:
     """
     Function generates SQL statement for table creating.
     :param table_name: name of table to be created
     :param table_dict: dictionary with columns and their definitions. Dictionary format can get from example.
     DO NOT define references. Better to create tables and then create refs. See also 'add_reference' function.
     :param is_temp: is table temporary?
+    :param partition_by: partitioning clause for partitioned table, e.g. 'RANGE (ts)'.
+    Partitions are created separately, see 'create_range_partition_ddl'.
+    :param primary_key: tuple of columns of table level primary key.
+    Primary key of partitioned table has to contain partition columns.
     :return: sql (ddl)
 
     Example
@@ -35,18 +71,122 @@ def create_table_ddl(table_name: str, table_dict: dict, is_temp=False) -> str:
 
     """
     sql_line_join_sep = ", \n"
+    lines = [f'  {column} {column_ddl}' for column, column_ddl in table_dict.items()]
+    if primary_key:
+        lines.append(f"  PRIMARY KEY ({', '.join(primary_key)})")
     sql =  \
         f"CREATE{' TEMP ' if is_temp else ' '}TABLE IF NOT EXISTS {table_name} (\n" \
-        f"{sql_line_join_sep.join([f'  {column} {column_ddl}' for column, column_ddl in table_dict.items()])}" \
+        f"{sql_line_join_sep.join(lines)}" \
         f"\n)"
+    if partition_by:
+        sql += f" PARTITION BY {partition_by}"
     return sql
 
 
-def add_fk_ddl(table_name: str, ref_list: list) -> str:
+def add_columns_ddl(table_name: str, table_dict: dict) -> str:
+    """
+    Function generates SQL statement adding columns of table definition, which are missing in existing table.
+    CREATE TABLE IF NOT EXISTS doesn't change existing table, so columns added to definition later reach it
+    only by this statement. Pass only missing columns (see 'table_columns_sql'): though existing columns are skipped
+    (IF NOT EXISTS), older PostgreSQL versions still process SERIAL and PRIMARY KEY of skipped columns.
+    :param table_name: name of table
+    :param table_dict: dictionary with columns and their definitions (see 'create_table_ddl')
+    :return: sql (ddl)
+
+    Example
+        in:
+            - table_name='t'
+            - table_dict={"id": "INT PRIMARY KEY", "rows_count": "BIGINT"}
+        out:
+            "ALTER TABLE t
+                ADD COLUMN IF NOT EXISTS id INT PRIMARY KEY,
+                ADD COLUMN IF NOT EXISTS rows_count BIGINT"
+    """
+    sql_line_join_sep = ", \n"
+    columns = sql_line_join_sep.join(
+        [f"\tADD COLUMN IF NOT EXISTS {column} {column_ddl}" for column, column_ddl in table_dict.items()]
+    )
+    return f"ALTER TABLE {table_name} \n{columns}"
+
+
+def table_columns_sql(table_name: str) -> str:
+    # Query of existing columns of table (one column name per row), see 'add_columns_ddl'
+    return f"SELECT attname FROM pg_attribute " \
+           f"WHERE attrelid = to_regclass('{table_name}') AND attnum > 0 AND NOT attisdropped"
+
+
+def add_missing_columns(cur, table_name: str, table_dict: dict) -> list:
+    """
+    Function adds columns of table definition, which are missing in existing table (see 'add_columns_ddl').
+    :param cur: cursor of database with table
+    :param table_name: name of table
+    :param table_dict: dictionary with columns and their definitions (see 'create_table_ddl')
+    :return: names of added columns
+    """
+    cur.execute(table_columns_sql(table_name))
+    existing_columns = {row[0] for row in cur.fetchall()}
+    missing_columns = {column: column_ddl for column, column_ddl in table_dict.items()
+                       if column not in existing_columns}
+    if missing_columns:
+        cur.execute(add_columns_ddl(table_name, missing_columns))
+    return list(missing_columns)
+
+
+def set_logged_ddl(table_name: str, is_logged=True) -> str:
+    # Switches table between logged and unlogged, changes of unlogged table are not written to WAL (fast load),
+    # but it's truncated after crash and it's not replicated. SET LOGGED rewrites the whole table into WAL
+    return f"ALTER TABLE {table_name} SET {'LOGGED' if is_logged else 'UNLOGGED'}"
+
+
+def fk_name(table_name: str, reference: dict) -> str:
+    # Name of foreign key added by 'add_fk_ddl' with 'not_valid' (bulk load restores it so), e.g. 't_col1_fkey'
+    return f"{table_name}_{'_'.join(reference.get('referencing_columns'))}_fkey"
+
+
+def foreign_keys_sql(table_name: str) -> str:
+    """
+    Function generates query of existing foreign keys of table. Rows are (constraint name, referencing columns,
+    referenced table), see 'existing_fk_names'.
+    :return: sql
+    """
+    return f"""
+        SELECT
+            c.conname,
+            ARRAY(
+                SELECT a.attname::TEXT
+                FROM unnest(c.conkey) WITH ORDINALITY k(attnum, ord)
+                JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+                ORDER BY k.ord
+            ),
+            c.confrelid::regclass::TEXT
+        FROM pg_constraint c
+        WHERE c.conrelid = to_regclass('{table_name}') AND c.contype = 'f'
+        ORDER BY c.conname
+    """
+
+
+def existing_fk_names(foreign_keys: list, reference: dict) -> list:
+    """
+    Function returns names of existing foreign keys made by reference definition. Names are not guessed:
+    unnamed constraints get names from PostgreSQL ('t_col1_fkey', 't_col1_fkey1' for the second one and so on).
+    :param foreign_keys: rows of 'foreign_keys_sql' query
+    :param reference: reference definition (see 'add_fk_ddl')
+    :return: list of constraint names
+    """
+    return [
+        name for name, columns, referenced_table in foreign_keys
+        if tuple(columns) == tuple(reference.get('referencing_columns'))
+        and referenced_table == reference.get('referenced_table')
+    ]
+
+
+def add_fk_ddl(table_name: str, ref_list: list, not_valid=False) -> str:
     """
     Function generates SQL statement for adding foreign constraints
     :param table_name: name of referencing table
     :param ref_list: list with references definitions, see format in example below
+    :param not_valid: existing rows are not checked (only new ones), constraints are named by 'fk_name',
+    so they can be validated later by 'validate_constraints_ddl'
     :return: sql (ddl)
 
     Example
@@ -75,9 +215,11 @@ def add_fk_ddl(table_name: str, ref_list: list) -> str:
     sql_line_join_sep = ", \n"
     fk = sql_line_join_sep.join(
             [
-            f"\tADD FOREIGN KEY ({', '.join(reference.get('referencing_columns'))}) " \
+            f"\tADD{f' CONSTRAINT {fk_name(table_name, reference)}' if not_valid else ''} " \
+            f"FOREIGN KEY ({', '.join(reference.get('referencing_columns'))}) " \
             f"REFERENCES {reference.get('referenced_table')} " \
-            f"({', '.join(reference.get('referenced_columns'))})"
+            f"({', '.join(reference.get('referenced_columns'))})" \
+            f"{' NOT VALID' if not_valid else ''}"
             for reference in ref_list])
     return f"ALTER TABLE {table_name} \n{fk}"
 
@@ -109,5 +251,303 @@ def add_unique_constr_ddl(table_name: str, col_lists: tuple) -> str:
     return f"ALTER TABLE {table_name} \n{constr}"
 
 
+def unique_constr_name(table_name: str, col_list) -> str:
+    # Name of unique constraint generated by PostgreSQL for unnamed constraint, e.g. 't_col1_col2_key'
+    return f"{table_name}_{'_'.join(col_list)}_key"
+
+
+def check_constraints(table_dict: dict) -> dict:
+    """
+    Function extracts named check constraints from column definitions.
+    :param table_dict: dictionary with columns and their definitions (see 'create_table_ddl')
+    :return: dict {constraint name: check expression}
+
+    Example
+        in: table_dict={"quantity": "INT CONSTRAINT positive_quantity CHECK (quantity > 0)"}
+        out: {"positive_quantity": "quantity > 0"}
+    """
+    checks = {}
+    for column_ddl in table_dict.values():
+        match = re.search(r"CONSTRAINT (\w+) CHECK \((.*)\)", column_ddl, re.IGNORECASE)
+        if match:
+            checks[match.group(1)] = match.group(2)
+    return checks
+
+
+def add_check_ddl(table_name: str, checks: dict, not_valid=False) -> str:
+    # Adds named check constraints {name: expression}, with 'not_valid' existing rows are not checked
+    sql_line_join_sep = ", \n"
+    constr = sql_line_join_sep.join(
+        [f"\tADD CONSTRAINT {name} CHECK ({expression}){' NOT VALID' if not_valid else ''}"
+         for name, expression in checks.items()]
+    )
+    return f"ALTER TABLE {table_name} \n{constr}"
+
+
+def drop_constraints_ddl(table_name: str, names) -> str:
+    """
+    Function generates SQL statement for dropping constraints. Statement is idempotent (IF EXISTS).
+    :param names: constraint names, see 'existing_fk_names', 'unique_constr_name' and 'check_constraints'
+    :return: sql (ddl)
+    """
+    sql_line_join_sep = ", \n"
+    constr = sql_line_join_sep.join([f"\tDROP CONSTRAINT IF EXISTS {name}" for name in names])
+    return f"ALTER TABLE {table_name} \n{constr}"
+
+
+def validate_constraints_ddl(table_name: str, names) -> list:
+    """
+    Function generates SQL statements validating NOT VALID constraints, one statement per constraint.
+    Validation checks all rows by one scan and doesn't block writes to table (SHARE UPDATE EXCLUSIVE lock).
+    :return: list of sql
+    """
+    return [f"ALTER TABLE {table_name} VALIDATE CONSTRAINT {name}" for name in names]
+
+
+def index_name(table_name: str, index: dict) -> str:
+    # Name of index from definition or generated by table and columns
+    columns = '_'.join([column.split()[0] for column in index.get('columns')])
+    return index.get('name') or f"{table_name}_{columns}_{index.get('method', 'btree')}_idx"
+
+
+def create_index_ddl(table_name: str, index: dict, concurrently=False) -> str:
+    """
+    Function generates SQL statement for index creating. Statement is idempotent (IF NOT EXISTS).
+    :param table_name: name of indexed table
+    :param index: dictionary with index definition, see format in example below. Only 'columns' is required:
+        - name: index name, by default it's generated from table name, columns and method
+        - columns: tuple of columns (or expressions, can contain ordering like "ts DESC")
+        - method: index method ('btree', 'brin', 'hash', 'gin', ...), 'btree' by default
+        - unique: is index unique?
+        - include: tuple of non-key columns for covering index
+        - where: predicate for partial index
+    :param concurrently: build index without locking writes (CREATE INDEX CONCURRENTLY).
+    Such statement can't be executed inside a transaction block.
+    :return: sql (ddl)
+
+    Example
+        in:
+            - table_name='t'
+            - index={
+                "name": "t_col1_idx",
+                "columns": ("col1",),
+                "include": ("col2",),
+                "where": "col3 IS NOT NULL"
+            }
+            - concurrently=True
+
+        out:
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS t_col1_idx ON t USING btree (col1)
+                INCLUDE (col2)
+                WHERE col3 IS NOT NULL"
+    """
+    sql = \
+        f"CREATE{' UNIQUE' if index.get('unique') else ''} INDEX{' CONCURRENTLY' if concurrently else ''} " \
+        f"IF NOT EXISTS {index_name(table_name, index)} ON {table_name} " \
+        f"USING {index.get('method', 'btree')} ({', '.join(index.get('columns'))})"
+    if index.get('include'):
+        sql += f"\n\tINCLUDE ({', '.join(index.get('include'))})"
+    if index.get('where'):
+        sql += f"\n\tWHERE {index.get('where')}"
+    return sql
+
+
+def index_is_valid_sql(index_name: str) -> str:
+    """
+    Function generates query checking index validity: it returns one row with 'indisvalid' if index exists.
+    Failed CREATE INDEX CONCURRENTLY leaves INVALID index behind, which is not used by queries, but
+    CREATE INDEX IF NOT EXISTS skips it. Such index has to be dropped and created again.
+    :return: sql
+    """
+    return f"SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('{index_name}')"
+
+
+def drop_index_ddl(table_name: str, index: dict, concurrently=False) -> str:
+    # Drops index by definition (see 'create_index_ddl'), statement is idempotent (IF EXISTS)
+    return f"DROP INDEX{' CONCURRENTLY' if concurrently else ''} IF EXISTS {index_name(table_name, index)}"
+
+
+def bulk_load_ddl(
+        table_name: str, table_dict: dict, ref_list: list = (), unique_col_lists: tuple = (), index_list: list = (),
+        not_valid=True, foreign_keys: list = ()
+) -> tuple:
+    """
+    Function generates SQL statements suspending constraints and indexes of table for bulk load and restoring them.
+    Foreign keys and checks are restored NOT VALID and validated by separate statements: every constraint
+    is checked by one scan of table, not row by row during load. Unique constraints and indexes are rebuilt
+    by one sort. Primary key is kept.
+    :param table_dict: dictionary with columns and their definitions, named check constraints are taken from it
+    :param ref_list: list with references definitions (see 'add_fk_ddl')
+    :param unique_col_lists: unique constraints (see 'add_unique_constr_ddl')
+    :param index_list: list with index definitions (see 'create_index_ddl')
+    :param not_valid: False - constraints are restored validated at once (still one scan per constraint),
+    PostgreSQL before 18 doesn't support NOT VALID foreign keys of partitioned tables
+    :param foreign_keys: existing foreign keys of table (rows of 'foreign_keys_sql'), all of them made by 'ref_list'
+    are dropped (also duplicates), every reference is restored by one constraint named by 'fk_name'
+    :return: tuple (suspending statements, restoring statements, validating statements)
+
+    Example
+        in:
+            - table_name='t'
+            - table_dict={"ref_id": "BIGINT", "qty": "INT CONSTRAINT positive_qty CHECK (qty > 0)"}
+            - ref_list=[{"referencing_columns": ("ref_id",), "referenced_table": "r", "referenced_columns": ("id",)}]
+            - foreign_keys=[("t_ref_id_fkey", ["ref_id"], "r"), ("t_ref_id_fkey1", ["ref_id"], "r")]
+        out:
+            (
+                ["ALTER TABLE t DROP CONSTRAINT IF EXISTS t_ref_id_fkey, DROP CONSTRAINT IF EXISTS t_ref_id_fkey1",
+                 "ALTER TABLE t DROP CONSTRAINT IF EXISTS positive_qty"],
+                ["ALTER TABLE t ADD CONSTRAINT t_ref_id_fkey FOREIGN KEY (ref_id) REFERENCES r (id) NOT VALID",
+                 "ALTER TABLE t ADD CONSTRAINT positive_qty CHECK (qty > 0) NOT VALID"],
+                ["ALTER TABLE t VALIDATE CONSTRAINT t_ref_id_fkey", "ALTER TABLE t VALIDATE CONSTRAINT positive_qty"]
+            )
+    """
+    checks = check_constraints(table_dict)
+    dropped_fk_names = [name for reference in ref_list for name in existing_fk_names(foreign_keys, reference)]
+    fk_names = [fk_name(table_name, reference) for reference in ref_list]
+    suspend = []
+    restore = []
+    if dropped_fk_names:
+        suspend.append(drop_constraints_ddl(table_name, dropped_fk_names))
+    if checks:
+        suspend.append(drop_constraints_ddl(table_name, list(checks)))
+    if unique_col_lists:
+        suspend.append(drop_constraints_ddl(
+            table_name, [unique_constr_name(table_name, col_list) for col_list in unique_col_lists]))
+        restore.append(add_unique_constr_ddl(table_name, unique_col_lists))
+    suspend += [drop_index_ddl(table_name, index) for index in index_list]
+    restore += [create_index_ddl(table_name, index) for index in index_list]
+    if fk_names:
+        restore.append(add_fk_ddl(table_name, ref_list, not_valid))
+    if checks:
+        restore.append(add_check_ddl(table_name, checks, not_valid))
+    return suspend, restore, validate_constraints_ddl(table_name, fk_names + list(checks)) if not_valid else []
+
+
+def partition_bounds(ts: datetime, interval='month') -> tuple:
+    """
+    Function returns range of partition containing timestamp.
+    :param ts: timestamp
+    :param interval: partition size: 'day', 'month' or 'year'
+    :return: tuple (start, end), start is included and end is excluded
+
+    Example
+        in: ts=datetime(2019, 12, 30, 8, 46), interval='month'
+        out: (datetime(2019, 12, 1), datetime(2020, 1, 1))
+    """
+    match interval:
+        case 'day':
+            start = datetime(ts.year, ts.month, ts.day)
+            return start, start + timedelta(days=1)
+        case 'month':
+            return datetime(ts.year, ts.month, 1), datetime(ts.year + ts.month // 12, ts.month % 12 + 1, 1)
+        case 'year':
+            return datetime(ts.year, 1, 1), datetime(ts.year + 1, 1, 1)
+        case _:
+            raise ValueError(f"Partition interval '{interval}' is not supported")
+
+
+def partition_name(table_name: str, ts: datetime, interval='month') -> str:
+    # Name of partition containing timestamp, e.g. 'sales_info_p2019_04' for monthly partitions
+    fmt = {'day': '%Y_%m_%d', 'month': '%Y_%m', 'year': '%Y'}[interval]
+    return f"{table_name}_p{partition_bounds(ts, interval)[0].strftime(fmt)}"
+
+
+def create_range_partition_ddl(table_name: str, ts: datetime, interval='month') -> str:
+    """
+    Function generates SQL statement for creating partition of range partitioned table, which contains timestamp.
+    Statement is idempotent (IF NOT EXISTS).
+    :param table_name: name of partitioned table
+    :param ts: timestamp to be stored in partition
+    :param interval: partition size: 'day', 'month' or 'year'
+    :return: sql (ddl)
+
+    Example
+        in:
+            - table_name='t'
+            - ts=datetime(2019, 4, 19, 8, 46)
+            - interval='month'
+        out:
+            "CREATE TABLE IF NOT EXISTS t_p2019_04 PARTITION OF t
+                FOR VALUES FROM ('2019-04-01 00:00:00') TO ('2019-05-01 00:00:00')"
+    """
+    start, end = partition_bounds(ts, interval)
+    return f"CREATE TABLE IF NOT EXISTS {partition_name(table_name, ts, interval)} PARTITION OF {table_name} \n" \
+           f"\tFOR VALUES FROM ('{start}') TO ('{end}')"
+
+
+def detach_partition_ddl(table_name: str, ts: datetime, interval='month', concurrently=False) -> str:
+    """
+    Function generates SQL statement for detaching partition containing timestamp (e.g. to archive old months).
+    :param concurrently: detach without blocking queries (PostgreSQL 14+), can't be executed inside a transaction block
+    :return: sql (ddl)
+    """
+    return f"ALTER TABLE {table_name} DETACH PARTITION {partition_name(table_name, ts, interval)}" \
+           f"{' CONCURRENTLY' if concurrently else ''}"
+
+
+def column_sql_type(column_ddl: str) -> str:
+    """
+    Function extracts base SQL type from column definition.
+    :param column_ddl: column definition from table dictionary
+    :return: SQL type in upper case without size/precision
+
+    Example
+        in: column_ddl="VARCHAR(20) NOT NULL"
+        out: "VARCHAR"
+    """
+    return column_ddl.split()[0].split('(')[0].upper()
+
+
+def loading_columns(table_dict: dict, exclude=()) -> tuple:
+    """
+    Function returns columns which values have to be loaded by ETL, in order of table definition.
+    Columns generated by database (SERIAL types or with DEFAULT) are skipped.
+    :param table_dict: dictionary with columns and their definitions (see 'create_table_ddl')
+    :param exclude: columns to skip additionally
+    :return: tuple of column names
+
+    Example
+        in:
+            - table_dict={
+                "id": "BIGSERIAL PRIMARY KEY",
+                "name": "VARCHAR",
+                "created_at": "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP"
+            }
+        out: ("name",)
+    """
+    return tuple(
+        column for column, column_ddl in table_dict.items()
+        if column not in exclude
+        and not column_sql_type(column_ddl).endswith('SERIAL')
+        and ' DEFAULT ' not in f" {column_ddl.upper()} "
+    )
+
+
+def column_parsers(table_dict: dict, columns: tuple, type_parsers: dict = None) -> tuple:
+    """
+    Function returns parsers of string values for columns, choosing them by SQL type of column.
+    Column of type without parser raises ValueError, so new column can't be loaded by wrong parser silently.
+    :param table_dict: dictionary with columns and their definitions (see 'create_table_ddl')
+    :param columns: columns to get parsers for
+    :param type_parsers: parsers overriding 'sql_type_parsers' for some SQL types
+    :return: tuple of functions, one per column
+
+    Example
+        in:
+            - table_dict={"id": "INT", "ts": "TIMESTAMP"}
+            - columns=("ts", "id")
+            - type_parsers={"TIMESTAMP": my_ts_parser}
+        out: (my_ts_parser, int)
+    """
+    parsers = dict(sql_type_parsers, **(type_parsers or {}))
+    result = []
+    for column in columns:
+        column_type = column_sql_type(table_dict[column])
+        if column_type not in parsers:
+            raise ValueError(f"There is no parser for column '{column}' of type '{column_type}'")
+        result.append(parsers[column_type])
+    return tuple(result)
+
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+import psycopg2
+
+
+@contextmanager
+def bulk_load(connection: psycopg2._psycopg.connection, tables_ddl: list):
+    """
+    Bulk load mode for initial loads and backfills: constraints and indexes of tables are dropped before load,
+    so rows are not checked and indexed one by one, and restored after load (also after load error).
+    NOT VALID constraints are validated one by one in their own transactions: long validation doesn't block
+    writes and doesn't roll back rebuilt indexes. Tables are locked exclusively while constraints are changed,
+    so bulk load should not run together with other ETL runs.
+    :param connection: connection for DDL statements, load itself may use other connections
+    :param tables_ddl: list of tuples (suspending statements, restoring statements, validating statements),
+    see 'bulk_load_ddl' in ddl_func.py
+
+    Example
+        with bulk_load(connection, [bulk_load_ddl('t', table_dict, ref_list, (), index_list)]):
+            load()
+    """
+    with connection:
+        with connection.cursor() as cur:
+            for suspend, _, _ in tables_ddl:
+                for sql in suspend:
+                    cur.execute(sql)
+    try:
+        yield
+    except Exception:
+        # Error of restoring (e.g. unique constraint violated by loaded rows) must not hide the load error
+        try:
+            restore_constraints(connection, tables_ddl)
+        except Exception as error:
+            print(f"Error while restoring constraints and indexes after failed load: {error}")
+        raise
+    restore_constraints(connection, tables_ddl)
+
+
+def restore_constraints(connection: psycopg2._psycopg.connection, tables_ddl: list):
+    """
+    Function restores constraints and indexes suspended by 'bulk_load' and validates NOT VALID constraints.
+    :param connection: connection for DDL statements
+    :param tables_ddl: list of tuples (suspending statements, restoring statements, validating statements)
+    """
+    with connection:
+        with connection.cursor() as cur:
+            for _, restore, _ in tables_ddl:
+                for sql in restore:
+                    cur.execute(sql)
+    for _, _, validate in tables_ddl:
+        for sql in validate:
+            with connection:
+                with connection.cursor() as cur:
+                    cur.execute(sql)
@@ -0,0 +1,190 @@
+import os
+import signal
+import time
+import psycopg2
+from psycopg2.pool import SimpleConnectionPool
+import stage.etl as stage_etl
+import ods.etl as ods_etl
+
+env = stage_etl.env
+# How often 'source_data/new' is checked for new files, seconds
+POLL_INTERVAL = float(env.get("ETL_DAEMON_POLL_INTERVAL") or 5)
+# Files modified less than this time ago may be still copied, they are loaded by next polls, seconds
+FILE_SETTLE_TIME = float(env.get("ETL_DAEMON_FILE_SETTLE_TIME") or 2)
+# ODS increment is started when stage got this count of new rows ...
+ODS_MIN_ROWS = int(env.get("ETL_DAEMON_ODS_MIN_ROWS") or 10000)
+# ... or when the oldest not transferred stage rows wait longer than this time, seconds
+ODS_MAX_DELAY = float(env.get("ETL_DAEMON_ODS_MAX_DELAY") or 60)
+# How often dimension ids cache is saved to file, seconds
+DIM_CACHE_SAVE_INTERVAL = 600
+
+
+def connection_params(prefix: str) -> dict:
+    return {
+        "host": env.get(f"{prefix}_POSTGRES_HOST"),
+        "port": env.get(f"{prefix}_POSTGRES_PORT"),
+        "database": env.get(f"{prefix}_POSTGRES_DB"),
+        "user": env.get(f"{prefix}_POSTGRES_USER"),
+        "password": env.get(f"{prefix}_POSTGRES_PASS")
+    }
+
+
+def settled_files(path: str, skipped: dict) -> list:
+    """
+    Returns new files, which are not being written anymore, in order of arrival.
+    :param skipped: dict {file name: mtime} of failed files, they are returned again only after modification
+    """
+    now = time.time()
+    files = []
+    for entry in os.scandir(path):
+        if not entry.is_file():
+            continue
+        mtime = entry.stat().st_mtime
+        if now - mtime >= FILE_SETTLE_TIME and skipped.get(entry.name) != mtime:
+            files.append((mtime, entry.name))
+    return [name for _, name in sorted(files)]
+
+
+def release(pool: SimpleConnectionPool, connection: psycopg2._psycopg.connection):
+    # Broken connections are closed, pool opens new ones on demand
+    if connection is not None:
+        pool.putconn(connection, close=bool(connection.closed))
+
+
+def checked_connection(pool: SimpleConnectionPool) -> psycopg2._psycopg.connection:
+    """
+    Takes connection from pool and pings it. Pooled connection may be broken since it was used last time
+    (database restart, idle timeout), then it's closed and replaced by new one.
+    Raises psycopg2.Error if database is not available.
+    """
+    connection = pool.getconn()
+    try:
+        with connection:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1")
+    except psycopg2.Error:
+        pool.putconn(connection, close=True)
+        connection = pool.getconn()
+    return connection
+
+
+class EtlDaemon:
+    """
+    Long-running ETL: loads new CSV files to stage as soon as they appear and transfers them to ODS
+    by micro-batches (see ODS_MIN_ROWS and ODS_MAX_DELAY).
+    Connections are kept in pools between runs and settings are read once, so a run has no start-up cost.
+    Stops after current step on SIGTERM or SIGINT.
+
+    Example
+        EtlDaemon().run()
+    """
+
+    def __init__(self):
+        # Parallel ODS increments (ODS_WORKERS > 1) take a stage and an ODS connection for every worker
+        workers = ods_etl.WORKERS if ods_etl.WORKERS > 1 else 0
+        self.stage_pool = SimpleConnectionPool(1, 2 + workers, **connection_params("STAGE"))
+        self.ods_pool = SimpleConnectionPool(2, 2 + workers, **connection_params("ODS"))
+        self.pending_rows = 0
+        self.pending_since = None
+        self.failed_files = {}
+        self.stopping = False
+        ods_connection = self.ods_pool.getconn()
+        try:
+            self.dim_cache = ods_etl.load_dim_cache(ods_connection)
+        finally:
+            release(self.ods_pool, ods_connection)
+        self.dim_cache_saved_at = time.monotonic()
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def load_stage(self, files: list):
+        for file in files:
+            if self.stopping:
+                break
+            connection = None
+            try:
+                connection = checked_connection(self.stage_pool)
+                rows_count = stage_etl.etl_file(connection, file)
+            except (psycopg2.Error, stage_etl.InsertMetaError, stage_etl.UpdateMetaError) as error:
+                # Database is not available: file stays in new files and is loaded by next polls
+                print(f"{file}: {error}\nFile will be loaded again.")
+                break
+            finally:
+                release(self.stage_pool, connection)
+            # Loaded file is moved away from new files, failed one stays and is skipped until it's changed
+            path = os.path.join(stage_etl.CSV_FILES_PATH_NEW, file)
+            if os.path.isfile(path):
+                self.failed_files[file] = os.stat(path).st_mtime
+            if rows_count and self.pending_since is None:
+                self.pending_since = time.monotonic()
+            self.pending_rows += rows_count
+
+    def ods_increment_due(self) -> bool:
+        if self.pending_since is None:
+            return False
+        return self.pending_rows >= ODS_MIN_ROWS or time.monotonic() - self.pending_since >= ODS_MAX_DELAY
+
+    def load_ods(self):
+        stage_connection = ods_connection = ods_connection_meta = None
+        workers = []
+        try:
+            stage_connection = checked_connection(self.stage_pool)
+            ods_connection = checked_connection(self.ods_pool)
+            ods_connection_meta = checked_connection(self.ods_pool)
+            if ods_etl.WORKERS > 1:
+                for _ in range(ods_etl.WORKERS):
+                    worker_stage_connection = checked_connection(self.stage_pool)
+                    try:
+                        workers.append((worker_stage_connection, checked_connection(self.ods_pool)))
+                    except psycopg2.Error:
+                        release(self.stage_pool, worker_stage_connection)
+                        raise
+                source_rows_count = ods_etl.run_etl_parallel(
+                    stage_connection, ods_connection, ods_connection_meta, self.dim_cache, workers,
+                    save_dim_cache=False
+                )
+            else:
+                source_rows_count = ods_etl.run_etl(
+                    stage_connection, ods_connection, ods_connection_meta, self.dim_cache, save_dim_cache=False)
+            print(f"ODS increment: {source_rows_count} source rows.")
+            self.pending_rows, self.pending_since = 0, None
+        except (psycopg2.Error, ods_etl.InsertEtlMetaError, ods_etl.UpdateEtlMetaError, ods_etl.EtlError) as error:
+            # Stage rows stay pending, increment is retried by next poll
+            print(f"{error}\nODS increment terminated.")
+        finally:
+            release(self.stage_pool, stage_connection)
+            release(self.ods_pool, ods_connection)
+            release(self.ods_pool, ods_connection_meta)
+            for worker_stage_connection, worker_ods_connection in workers:
+                release(self.stage_pool, worker_stage_connection)
+                release(self.ods_pool, worker_ods_connection)
+        if time.monotonic() - self.dim_cache_saved_at >= DIM_CACHE_SAVE_INTERVAL:
+            self.dim_cache.save()
+            self.dim_cache_saved_at = time.monotonic()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"ETL daemon is watching '{stage_etl.CSV_FILES_PATH_NEW}'.")
+        try:
+            while not self.stopping:
+                files = settled_files(stage_etl.CSV_FILES_PATH_NEW, self.failed_files)
+                if files:
+                    self.load_stage(files)
+                if self.ods_increment_due() and not self.stopping:
+                    self.load_ods()
+                if not files:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            self.dim_cache.save()
+            self.stage_pool.closeall()
+            self.ods_pool.closeall()
+            print("ETL daemon stopped.")
+
+
+if __name__ == '__main__':
+    try:
+        EtlDaemon().run()
+    except (Exception, psycopg2.Error) as error:
+        print(f"{error}\nETL daemon won't be started.")
@@ -0,0 +1,116 @@
+import atexit
+import datetime
+import sys
+import threading
+import time
+from queue import Queue, Empty
+import psycopg2
+from psycopg2.extras import execute_values
+
+# Columns of events table, table definitions are in stage/db_structure.py and ods/db_structure.py
+events_table_ddl = {
+    "id": "BIGSERIAL PRIMARY KEY",
+    "etl_meta_info_id": "BIGINT NOT NULL",
+    "ts": "TIMESTAMP NOT NULL",
+    "phase": "VARCHAR NOT NULL",
+    "level": "VARCHAR NOT NULL",
+    "message": "TEXT",
+    "rows_count": "BIGINT",
+    "duration_sec": "NUMERIC"
+}
+event_columns = ("etl_meta_info_id", "ts", "phase", "level", "message", "rows_count", "duration_sec")
+
+
+class EtlEventLog:
+    """
+    Append-only ETL event log written by background thread.
+    'log' only puts event in queue, so ETL transaction is never blocked by logging. Writer inserts queued events
+    in batches by its own connection (events are visible at once, even if ETL transaction is rolled back).
+    'flush' waits until all queued events are written, it's called after errors and (by atexit) on exit.
+    Writer thread and connection are started by the first event.
+
+    Example
+        events = EtlEventLog(stage_connect, 'etl_events')
+        events.log(etl_meta_info_id, 'load', 'info', 'Loading was finished.', rows_count=1000, duration=1.5)
+        events.flush()
+    """
+
+    def __init__(self, connect, table: str, batch_size: int = 1000, flush_interval: float = 1.0):
+        # connect is a function returning new connection to database with events table
+        self.connect = connect
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._events = Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def log(self, etl_meta_info_id: int, phase: str, level: str, message, rows_count: int = None,
+            duration: float = None, ts: datetime.datetime = None):
+        self._start()
+        self._events.put((
+            etl_meta_info_id, ts or datetime.datetime.now(datetime.timezone.utc), phase, level,
+            None if message is None else str(message), rows_count, duration
+        ))
+
+    def flush(self):
+        if self._writer is not None:
+            self._events.join()
+
+    def close(self):
+        with self._lock:
+            if self._writer is None:
+                return
+            self._events.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def _start(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, daemon=True)
+                self._writer.start()
+                atexit.register(self.close)
+
+    def _write(self):
+        connection = None
+        stop = False
+        while not stop:
+            batch = [self._events.get()]
+            # Events arriving during flush interval after the first one are written in the same batch
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._events.get(timeout=max(deadline - time.monotonic(), 0)))
+                except Empty:
+                    break
+            if batch[-1] is None:
+                stop = True
+                batch.pop()
+            if batch:
+                try:
+                    if connection is None or connection.closed:
+                        connection = self.connect()
+                    with connection:
+                        with connection.cursor() as cur:
+                            execute_values(
+                                cur,
+                                f"INSERT INTO {self.table} ({', '.join(event_columns)}) VALUES %s",
+                                batch,
+                                page_size=self.batch_size
+                            )
+                except (Exception, psycopg2.Error) as error:
+                    # Events are not lost silently, they are printed if they can't be written
+                    print(f"Error while writing ETL events: {error}", file=sys.stderr)
+                    for event in batch:
+                        print(f"[{event[1]}] {event[3].upper()} {event[2]} (meta {event[0]}): {event[4]}",
+                              file=sys.stderr)
+                    if connection is not None:
+                        connection.close()
+                        connection = None
+            for _ in range(len(batch) + stop):
+                self._events.task_done()
+        if connection is not None:
+            connection.close()
@@ -0,0 +1,197 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Columns of meta tables with run metrics, added to meta table definitions in stage/db_structure.py and
+# ods/db_structure.py
+metrics_columns_ddl = {
+    "duration_sec": "NUMERIC",
+    "rows_count": "BIGINT",
+    "peak_rss_mb": "NUMERIC",
+    "phase_metrics": "JSONB"
+}
+
+
+def peak_rss_mb() -> float:
+    # Peak resident memory of the process (ru_maxrss is in kilobytes on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class EtlProfiler:
+    """
+    Collects wall time, row counts, bytes and peak RSS of ETL phases.
+    Repeated phases (chunks, batches) are accumulated under the same name. Peak RSS of phase is peak of the process
+    at the end of phase. Phases may be recorded from several threads.
+
+    Example
+        profiler = EtlProfiler()
+        with profiler.phase('insert') as stat:
+            stat['rows'] = insert(data)
+        lines = profiler.timed_iter(reader, 'read')
+        profiler.summary() -> {'insert': {'seconds': 1.2, 'rows': 1000, 'rows_per_sec': 833, ...}, ...}
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def _stat(self, name: str) -> dict:
+        with self._lock:
+            return self.phases.setdefault(name, {"seconds": 0.0, "rows": 0, "bytes": 0, "peak_rss_mb": 0.0})
+
+    def add(self, name: str, seconds: float, rows: int = 0, bytes_count: int = 0):
+        stat = self._stat(name)
+        with self._lock:
+            stat["seconds"] += seconds
+            stat["rows"] += rows or 0
+            stat["bytes"] += bytes_count or 0
+            stat["peak_rss_mb"] = max(stat["peak_rss_mb"], peak_rss_mb())
+
+    @contextmanager
+    def phase(self, name: str):
+        # Caller may set 'rows' and 'bytes' of yielded dict
+        stat = {"rows": 0, "bytes": 0}
+        start = time.perf_counter()
+        try:
+            yield stat
+        finally:
+            self.add(name, time.perf_counter() - start, stat["rows"], stat["bytes"])
+
+    def timed_iter(self, iterable, name: str):
+        # Time spent in getting items of iterable, every item is counted as row
+        iterator = iter(iterable)
+        seconds = 0.0
+        rows = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += time.perf_counter() - start
+                    break
+                seconds += time.perf_counter() - start
+                rows += 1
+                yield item
+        finally:
+            self.add(name, seconds, rows)
+
+    def timed(self, func, name: str):
+        """
+        Wraps function, time of its calls is accumulated, every call is counted as row.
+        It's made for hot per-line functions: there is no locking, wrapper should be called from one thread.
+        """
+        stat = self._stat(name)
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stat["seconds"] += time.perf_counter() - start
+                stat["rows"] += 1
+        return wrapper
+
+    def exclude(self, name: str, *nested: str):
+        # Makes time of phase exclusive: time of phases measured inside it is subtracted
+        with self._lock:
+            if name in self.phases:
+                nested_seconds = sum([self.phases[phase]["seconds"] for phase in nested if phase in self.phases])
+                self.phases[name]["seconds"] = max(self.phases[name]["seconds"] - nested_seconds, 0.0)
+
+    def seconds(self, name: str) -> float:
+        with self._lock:
+            return self.phases[name]["seconds"] if name in self.phases else 0.0
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> dict:
+        with self._lock:
+            # Phases recorded by 'timed' get peak RSS now
+            for stat in self.phases.values():
+                stat["peak_rss_mb"] = stat["peak_rss_mb"] or peak_rss_mb()
+            return {
+                name: {
+                    "seconds": round(stat["seconds"], 3),
+                    "rows": stat["rows"],
+                    "rows_per_sec": round(stat["rows"] / stat["seconds"]) if stat["seconds"] else None,
+                    "bytes": stat["bytes"],
+                    "peak_rss_mb": round(stat["peak_rss_mb"], 1)
+                }
+                for name, stat in self.phases.items()
+            }
+
+    def meta_values(self, rows_count: int = None) -> dict:
+        # Values of metrics columns of meta table
+        return {
+            "duration_sec": round(self.elapsed(), 3),
+            "rows_count": rows_count,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "phase_metrics": self.summary()
+        }
+
+
+def prometheus_label(val) -> str:
+    return str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus_textfile(path: str, etl: str, profiler: EtlProfiler, rows_count: int = None, success=True,
+                              labels: dict = None):
+    """
+    Writes metrics of ETL run in Prometheus text format (for node_exporter textfile collector).
+    File is replaced atomically, so collector never reads partially written file.
+    :param path: metrics file path, '.prom' extension is expected by collector
+    :param etl: ETL name, value of label 'etl'
+    :param labels: additional labels of all metrics (for example, source file)
+    """
+    common = {"etl": etl, **(labels or {})}
+
+    def series(name: str, value, **extra) -> str:
+        all_labels = ','.join([f'{key}="{prometheus_label(val)}"' for key, val in {**common, **extra}.items()])
+        return f"{name}{{{all_labels}}} {value}"
+
+    phases = profiler.summary()
+    metrics = {
+        "etl_phase_duration_seconds": ("Wall time of ETL phase.", "seconds"),
+        "etl_phase_rows": ("Rows processed by ETL phase.", "rows"),
+        "etl_phase_rows_per_second": ("Throughput of ETL phase.", "rows_per_sec"),
+        "etl_phase_bytes": ("Bytes moved by ETL phase.", "bytes"),
+        "etl_phase_peak_rss_bytes": ("Peak resident memory of ETL process at the end of phase.", "peak_rss_mb")
+    }
+    lines = []
+    for name, (description, key) in metrics.items():
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+        for phase, stat in phases.items():
+            value = stat[key]
+            if value is None:
+                continue
+            if key == "peak_rss_mb":
+                value = int(value * 1024 * 1024)
+            lines.append(series(name, value, phase=phase))
+    run_metrics = {
+        "etl_run_duration_seconds": ("Wall time of ETL run.", round(profiler.elapsed(), 3)),
+        "etl_run_rows": ("Rows loaded by ETL run.", rows_count or 0),
+        "etl_run_success": ("1 if the last ETL run succeeded, 0 otherwise.", int(success)),
+        "etl_run_last_timestamp_seconds": ("Time of the last ETL run end.", int(time.time()))
+    }
+    for name, (description, value) in run_metrics.items():
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", series(name, value)]
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def export_run_metrics(textfile_dir: str, etl: str, profiler: EtlProfiler, rows_count: int = None, success=True):
+    # Metrics file is written only if directory of textfile collector is configured, its errors don't stop ETL
+    if not textfile_dir:
+        return
+    try:
+        write_prometheus_textfile(os.path.join(textfile_dir, f"etl_{etl}.prom"), etl, profiler, rows_count, success)
+    except OSError as error:
+        print(f"Error while writing metrics file: {error}")
@@ -0,0 +1,280 @@
+import json
+import os
+import shutil
+import numpy as np
+from dotenv import dotenv_values
+import psycopg2
+from ods.olap import OlapQueryError, filter_operators, finished_etl_meta_info_id
+
+env = dotenv_values()
+
+CUBE_SNAPSHOT_DIR = env.get("ODS_CUBE_SNAPSHOT_DIR") or \
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cube_snapshot')
+CUBE_FETCH_SIZE = 100000
+
+# Fact columns of 'sales_info' loaded in cube and their NumPy dtypes
+cube_fact_columns = {
+    "sys_id": "int64",
+    "order_id": "int64",
+    "product_id": "int64",
+    "purchase_address_id": "int64",
+    "datetime_id": "int64",
+    "quantity": "int64",
+    "price_per_each": "float64",
+    "total_price": "float64",
+    "sys_etl_meta_info_id": "int64"
+}
+
+# Dimension attributes loaded as dense arrays indexed by surrogate id: {array name: (table, column, dtype)}.
+# Surrogate ids are dictionary codes of dimensions, id 0 (absent in tables) means unknown value.
+cube_attributes = {
+    "order_id": ("sales_order", "order_id", "int64"),
+    "product_name": ("sales_product", "name", "str"),
+    "address": ("sales_purchase_address", "address", "str"),
+    "year": ("sales_date", "year", "int64"),
+    "month": ("sales_date", "month", "int64"),
+    "day": ("sales_date", "day", "int64")
+}
+
+# Dimensions of cube (same names as in ods/olap.py): {dimension: (fact key column, attribute array)}
+cube_dimensions = {
+    "Order": ("order_id", "order_id"),
+    "Product": ("product_id", "product_name"),
+    "Purchase Address": ("purchase_address_id", "address"),
+    "Order Year": ("datetime_id", "year"),
+    "Order Month": ("datetime_id", "month"),
+    "Order Day": ("datetime_id", "day")
+}
+
+# Measures of cube (same names as in ods/olap.py): {measure: (fact column, aggregate)}
+cube_measures = {
+    "Product Quantity": ("quantity", "sum"),
+    "Order Full Price": ("total_price", "sum"),
+    "Order Lines": (None, "count"),
+    "Product Price": ("price_per_each", "mean")
+}
+
+
+class ColumnarCube:
+    """
+    In-memory columnar copy of 'sales_info' with dimension attributes for interactive slicing.
+    Facts are NumPy arrays, dimensions are dictionary encoded by surrogate ids of dimension tables,
+    so filters and group by are vectorized over integer codes.
+    Snapshot is saved as '.npy' files and loaded memory-mapped, without querying ODS.
+    'refresh' loads only facts of ETL runs after the last loaded one ('sys_etl_meta_info_id'),
+    facts updated by these runs replace their previous versions (by 'sys_id').
+
+    Example
+        cube = ColumnarCube.load('ods/cube_snapshot')
+        with connection:
+            with connection.cursor() as cur:
+                cube.refresh(cur)
+        cube.save()
+        cube.query(["Product"], ["Order Full Price"], [("Order Year", "=", 2019)])
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.last_etl_meta_info_id = 0
+        self.facts = {column: np.empty(0, dtype) for column, dtype in cube_fact_columns.items()}
+        self.attributes = {
+            name: np.empty(0, dtype) for name, (_, _, dtype) in cube_attributes.items()
+        }
+
+    def __len__(self):
+        return len(self.facts['sys_id'])
+
+    @classmethod
+    def load(cls, path: str):
+        cube = cls(path)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return cube
+        with open(meta_path) as f:
+            meta = json.load(f)
+        facts = {column: np.load(os.path.join(path, f"fact_{column}.npy"), mmap_mode='r')
+                 for column in cube_fact_columns}
+        attributes = {name: np.load(os.path.join(path, f"attr_{name}.npy"), mmap_mode='r')
+                      for name in cube_attributes}
+        # Snapshot interrupted while saving is useless
+        if any(len(arr) != meta['rows'] for arr in facts.values()):
+            return cube
+        cube.facts = facts
+        cube.attributes = attributes
+        cube.last_etl_meta_info_id = meta['last_etl_meta_info_id']
+        return cube
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        arrays = {f"fact_{column}": arr for column, arr in self.facts.items()}
+        arrays.update({f"attr_{name}": arr for name, arr in self.attributes.items()})
+        for name, arr in arrays.items():
+            tmp_path = os.path.join(self.path, f"{name}.tmp.npy")
+            np.save(tmp_path, arr)
+            os.replace(tmp_path, os.path.join(self.path, f"{name}.npy"))
+        tmp_path = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'rows': len(self), 'last_etl_meta_info_id': self.last_etl_meta_info_id}, f)
+        os.replace(tmp_path, os.path.join(self.path, 'meta.json'))
+
+    def clear(self):
+        self.__init__(self.path)
+        if self.path and os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+    def refresh(self, cur) -> int:
+        """
+        Loads facts of ETL runs finished after the last loaded one and new dimension rows.
+        Facts of ETL run in progress are not loaded, they will be loaded after it ends.
+        :param cur: cursor of ODS transaction
+        :return: count of loaded facts
+        """
+        max_etl_meta_info_id = finished_etl_meta_info_id(cur)
+        if max_etl_meta_info_id <= self.last_etl_meta_info_id:
+            return 0
+
+        self._refresh_attributes(cur)
+
+        columns = ', '.join([f"coalesce({column}, 0)" for column in cube_fact_columns])
+        # Facts of new runs are found by index on 'sys_etl_meta_info_id' (see ods/db_structure.py)
+        cur.execute(f"""
+            SELECT {columns}
+            FROM sales_info
+            WHERE sys_etl_meta_info_id > %s AND sys_etl_meta_info_id <= %s
+        """, (self.last_etl_meta_info_id, max_etl_meta_info_id))
+        chunks = {column: [] for column in cube_fact_columns}
+        while rows := cur.fetchmany(CUBE_FETCH_SIZE):
+            for column, values in zip(cube_fact_columns, zip(*rows)):
+                chunks[column].append(np.array(values, dtype=cube_fact_columns[column]))
+        new_facts = {column: np.concatenate(arrays) if arrays else np.empty(0, cube_fact_columns[column])
+                     for column, arrays in chunks.items()}
+
+        # Previous versions of updated facts are replaced
+        keep = ~np.isin(self.facts['sys_id'], new_facts['sys_id'])
+        self.facts = {column: np.concatenate([self.facts[column][keep], new_facts[column]])
+                      for column in cube_fact_columns}
+        self.last_etl_meta_info_id = max_etl_meta_info_id
+        return len(new_facts['sys_id'])
+
+    def _refresh_attributes(self, cur):
+        # Dimension tables are append only (ETL never updates them), so only rows after loaded ids are selected
+        for table in {table for table, _, _ in cube_attributes.values()}:
+            names = [name for name, (attr_table, _, _) in cube_attributes.items() if attr_table == table]
+            loaded = len(self.attributes[names[0]])
+            columns = ', '.join([cube_attributes[name][1] for name in names])
+            cur.execute(f"SELECT id, {columns} FROM {table} WHERE id >= %s ORDER BY id", (loaded,))
+            rows = cur.fetchall()
+            if not rows:
+                continue
+            ids = np.array([row[0] for row in rows], dtype='int64')
+            size = max(int(ids.max()) + 1, loaded)
+            for i, name in enumerate(names, start=1):
+                if cube_attributes[name][2] == 'str':
+                    values = np.array([row[i] for row in rows], dtype='str')
+                    # Fixed width unicode arrays can be memory-mapped, width is grown for longer values
+                    dtype = np.promote_types(self.attributes[name].dtype, values.dtype)
+                else:
+                    values = np.array([row[i] for row in rows], dtype=cube_attributes[name][2])
+                    dtype = values.dtype
+                arr = np.zeros(size, dtype=dtype)
+                arr[:loaded] = self.attributes[name]
+                arr[ids] = values
+                self.attributes[name] = arr
+
+    def dimension_values(self, dimension: str, mask=None):
+        key_column, attribute = cube_dimensions[dimension]
+        keys = self.facts[key_column] if mask is None else self.facts[key_column][mask]
+        return self.attributes[attribute][keys]
+
+    def filter_mask(self, filters: list):
+        mask = np.ones(len(self), dtype=bool)
+        for dim, operator, value in filters:
+            values = self.dimension_values(dim)
+            match operator:
+                case '=':
+                    mask &= values == value
+                case '!=':
+                    mask &= values != value
+                case '<':
+                    mask &= values < value
+                case '<=':
+                    mask &= values <= value
+                case '>':
+                    mask &= values > value
+                case '>=':
+                    mask &= values >= value
+                case 'in':
+                    mask &= np.isin(values, list(value))
+                case 'between':
+                    mask &= (values >= value[0]) & (values <= value[1])
+        return mask
+
+    def query(self, dimensions: list, measures: list, filters: list = None) -> tuple:
+        """
+        Aggregates facts of cube, same query as 'run_query' in ods/olap.py.
+        :param dimensions: dimension names to group by, see 'cube_dimensions'
+        :param measures: measure names, see 'cube_measures'
+        :param filters: list of tuples (dimension, operator, value)
+        :return: tuple (column names, rows), rows are ordered by dimensions
+        """
+        filters = filters or []
+        for dim in list(dimensions) + [item[0] for item in filters]:
+            if dim not in cube_dimensions:
+                raise OlapQueryError(f"Unknown dimension '{dim}'")
+        for measure in measures:
+            if measure not in cube_measures:
+                raise OlapQueryError(f"Unknown measure '{measure}'")
+        for _, operator, _ in filters:
+            if operator not in filter_operators:
+                raise OlapQueryError(f"Unknown filter operator '{operator}'")
+
+        mask = self.filter_mask(filters)
+        if dimensions:
+            # Group number of every fact by unique combinations of dimension values
+            uniques, codes = zip(*[np.unique(self.dimension_values(dim, mask), return_inverse=True)
+                                   for dim in dimensions])
+            group_keys, groups = np.unique(np.stack([c.ravel() for c in codes], axis=1), axis=0, return_inverse=True)
+            groups = groups.ravel()
+            group_count = len(group_keys)
+        else:
+            groups = np.zeros(int(mask.sum()), dtype='int64')
+            group_count = 1 if len(groups) else 0
+
+        counts = np.bincount(groups, minlength=group_count)
+        results = []
+        for measure in measures:
+            column, aggregate = cube_measures[measure]
+            if aggregate == 'count':
+                results.append(counts)
+                continue
+            sums = np.bincount(groups, weights=self.facts[column][mask], minlength=group_count)
+            if aggregate == 'mean':
+                results.append(sums / counts)
+            else:
+                results.append(sums.astype(self.facts[column].dtype))
+
+        if dimensions:
+            dim_values = [uniques[i][group_keys[:, i]] for i in range(len(dimensions))]
+        else:
+            dim_values = []
+        rows = [tuple(val.item() for val in row) for row in zip(*dim_values, *results)]
+        return list(dimensions) + list(measures), rows
+
+
+if __name__ == '__main__':
+    connection = psycopg2.connect(
+        host=env.get("ODS_POSTGRES_HOST"),
+        port=env.get("ODS_POSTGRES_PORT"),
+        database=env.get("ODS_POSTGRES_DB"),
+        user=env.get("ODS_POSTGRES_USER"),
+        password=env.get("ODS_POSTGRES_PASS")
+    )
+    cube = ColumnarCube.load(CUBE_SNAPSHOT_DIR)
+    with connection:
+        with connection.cursor() as cur:
+            loaded = cube.refresh(cur)
+    cube.save()
+    connection.close()
+    print(f"Cube refreshed: {loaded} facts loaded, {len(cube)} facts in snapshot.")
@@ -1,6 +1,13 @@
+import sys
 from dotenv import dotenv_values
 import psycopg2
-from ddl_func import create_table_ddl, add_fk_ddl
+from ddl_func import create_table_ddl, add_missing_columns, add_fk_ddl, foreign_keys_sql, existing_fk_names, \
+    create_index_ddl, drop_index_ddl, index_name, index_is_valid_sql, create_range_partition_ddl
+from ods.rollup import build_rollup_sql
+from etl_events import events_table_ddl
+from etl_metrics import metrics_columns_ddl
+
+env = dotenv_values()
 
 
 sales_tables_ddl = {
@@ -36,7 +43,9 @@ sales_tables_ddl = {
             "quantity": "INT CONSTRAINT positive_quantity CHECK (quantity > 0)",
             "price_per_each": "NUMERIC CONSTRAINT positive_price_per_each CHECK (price_per_each > 0)",
             "total_price": "NUMERIC CONSTRAINT positive_total_price CHECK (total_price > 0)",
-            "sys_id": "BIGSERIAL PRIMARY KEY NOT NULL",
+            # Order timestamp (same as 'ts' of 'datetime_id'), it's partition key of the table
+            "order_ts": "TIMESTAMP NOT NULL",
+            "sys_id": "BIGSERIAL NOT NULL",
             "sys_created_at": "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
             "sys_updated_at": "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
             "sys_etl_meta_info_id": "BIGINT",
@@ -46,6 +55,68 @@ sales_tables_ddl = {
     }
 }
 
+# Range partitioned tables. Partitions are created by ETL before loading, see 'create_range_partition_ddl'.
+# Primary key of partitioned table has to contain partition column.
+partitioning = {
+    "sales_info": {
+        "column": "order_ts",
+        "interval": "month",
+        "primary_key": ("sys_id", "order_ts")
+    }
+}
+
+# Aggregate rollups of facts for BI, they are maintained by ETL incrementally (see ods/rollup.py)
+rollup_measures = {
+    "quantity": "sum(si.quantity)",
+    "revenue": "sum(si.total_price)",
+    "order_lines": "count(*)"
+}
+rollups = {
+    "rollup_product_day": {
+        "dimensions": {
+            "product_id": "si.product_id",
+            "year": "date_part('year', si.order_ts)::INT",
+            "month": "date_part('month', si.order_ts)::INT",
+            "day": "date_part('day', si.order_ts)::INT"
+        },
+        "measures": rollup_measures,
+        "count_measure": "order_lines",
+        # Rows estimate for choosing rollup before table is analyzed: ~20 products by ~365 days a year
+        "rows_estimate": 20 * 365
+    },
+    "rollup_address_month": {
+        "dimensions": {
+            "purchase_address_id": "si.purchase_address_id",
+            "year": "date_part('year', si.order_ts)::INT",
+            "month": "date_part('month', si.order_ts)::INT"
+        },
+        "measures": rollup_measures,
+        "count_measure": "order_lines",
+        # Almost every purchase address is unique, so it's about one row per order
+        "rows_estimate": 200000
+    }
+}
+
+rollup_tables_ddl = {
+    "rollup_product_day": {
+        "product_id": "BIGINT NOT NULL",
+        "year": "INT NOT NULL",
+        "month": "INT NOT NULL",
+        "day": "INT NOT NULL",
+        "quantity": "BIGINT NOT NULL",
+        "revenue": "NUMERIC NOT NULL",
+        "order_lines": "BIGINT NOT NULL"
+    },
+    "rollup_address_month": {
+        "purchase_address_id": "BIGINT NOT NULL",
+        "year": "INT NOT NULL",
+        "month": "INT NOT NULL",
+        "quantity": "BIGINT NOT NULL",
+        "revenue": "NUMERIC NOT NULL",
+        "order_lines": "BIGINT NOT NULL"
+    }
+}
+
 meta_info_tables_ddl = {
     "etl_meta_info": {
             "id": "BIGSERIAL PRIMARY KEY",
@@ -54,7 +125,23 @@ meta_info_tables_ddl = {
             "state": "VARCHAR NOT NULL",
             "source": "TEXT NOT NULL",
             "target": "TEXT NOT NULL",
-            "log": "TEXT"
+            "log": "TEXT",
+            **metrics_columns_ddl
+    },
+    "etl_watermark": {
+            "source": "VARCHAR PRIMARY KEY",
+            "max_source_created_at": "TIMESTAMP",
+            "max_source_updated_at": "TIMESTAMP",
+            "max_source_id": "BIGINT",
+            "sys_etl_meta_info_id": "BIGINT",
+            "sys_updated_at": "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP"
+    },
+    # Append-only ETL log, it has no foreign key to keep inserts cheap
+    "etl_event": events_table_ddl,
+    # Months left by facts moved to other month by update, incremental export rewrites them (see ods/export.py)
+    "etl_moved_fact_month": {
+            "sys_etl_meta_info_id": "BIGINT NOT NULL",
+            "month": "TIMESTAMP NOT NULL"
     }
 }
 
@@ -89,24 +176,134 @@ references = {
         ]
     }
 
+indexes = {
+    "sales_info": [
+            # Match key of facts updating and new facts routing
+            {"columns": ("source_id",)},
+            # Foreign keys used by joins of 'Orders' view
+            {"columns": ("order_id",)},
+            {"columns": ("product_id",)},
+            {"columns": ("purchase_address_id",)},
+            {"columns": ("datetime_id",)},
+            # Source timestamps grow with loading order, so BRIN is tiny and enough for range scans
+            {"columns": ("source_created_at",), "method": "brin"},
+            {"columns": ("source_updated_at",), "method": "brin"},
+            # Facts of ETL runs after the last export (ods/export.py) or cube refresh (ods/cube.py).
+            # Updates move old facts to new runs, so values don't grow with physical order as BRIN needs
+            {"columns": ("sys_etl_meta_info_id",)}
+        ],
+    "sales_date": [
+            # Covering index for BI filters by year and month
+            {"columns": ("year", "month"), "include": ("id",)}
+        ],
+    "etl_meta_info": [
+            # Unfinished ETL runs only
+            {"columns": ("state",), "where": "state <> 'finished'"}
+        ],
+    "etl_event": [
+            {"columns": ("etl_meta_info_id",)}
+        ]
+}
+
+def migrate_facts_to_partitioned(cur) -> int:
+    """
+    Migrates fact table 'sales_info' created before partitioning (plain table without 'order_ts'):
+    CREATE TABLE IF NOT EXISTS doesn't change existing table. Old table is renamed, its primary key and indexes
+    are dropped (their names are needed by new table), partitioned table with partitions of all months is created
+    and filled by old facts with 'order_ts' taken from 'sales_date', then old table is dropped.
+    'sys_id' values are kept and its sequence continues after them. View 'Orders' depends on old table, so it's
+    dropped and has to be created again. Everything is done in transaction of cursor, failed migration changes nothing.
+    :return: count of migrated facts, None if table is already partitioned or doesn't exist
+    """
+    cur.execute("""
+        SELECT to_regclass('sales_info') IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('sales_info'))
+    """)
+    if not cur.fetchone()[0]:
+        return None
+    fact_partitioning = partitioning['sales_info']
+    cur.execute("DROP VIEW IF EXISTS Orders")
+    cur.execute("ALTER TABLE sales_info RENAME TO sales_info_unpartitioned")
+    cur.execute("""
+        SELECT conname FROM pg_constraint
+        WHERE conrelid = 'sales_info_unpartitioned'::regclass AND contype IN ('p', 'u', 'x')
+    """)
+    for (constraint,) in cur.fetchall():
+        cur.execute(f"ALTER TABLE sales_info_unpartitioned DROP CONSTRAINT {constraint}")
+    cur.execute("""
+        SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = 'sales_info_unpartitioned'::regclass
+    """)
+    for (index,) in cur.fetchall():
+        cur.execute(f"DROP INDEX {index}")
+    cur.execute(create_table_ddl(
+        'sales_info', sales_tables_ddl['sales_info'],
+        partition_by=f"RANGE ({fact_partitioning['column']})",
+        primary_key=fact_partitioning['primary_key']
+    ))
+    cur.execute(f"""
+        SELECT DISTINCT date_trunc('{fact_partitioning['interval']}', sd.ts)
+        FROM sales_info_unpartitioned old
+        JOIN sales_date sd ON sd.id = old.datetime_id
+    """)
+    for (period,) in cur.fetchall():
+        cur.execute(create_range_partition_ddl('sales_info', period, fact_partitioning['interval']))
+    columns = [column for column in sales_tables_ddl['sales_info'] if column != 'order_ts']
+    cur.execute(f"""
+        INSERT INTO sales_info ({', '.join(columns)}, order_ts)
+        SELECT {', '.join([f'old.{column}' for column in columns])}, sd.ts
+        FROM sales_info_unpartitioned old
+        JOIN sales_date sd ON sd.id = old.datetime_id
+    """)
+    rows_count = cur.rowcount
+    cur.execute("SELECT count(*) FROM sales_info_unpartitioned")
+    lost_rows_count = cur.fetchone()[0] - rows_count
+    if lost_rows_count:
+        raise Exception(f"{lost_rows_count} facts have no order date, 'sales_info' migration was rolled back")
+    cur.execute("SELECT setval(pg_get_serial_sequence('sales_info', 'sys_id'), max(sys_id)) FROM sales_info")
+    cur.execute("DROP TABLE sales_info_unpartitioned")
+    return rows_count
+
+
 if __name__ == "__main__":
+    # Run with '--concurrently' to build indexes on working database without locking writes
+    concurrently = '--concurrently' in sys.argv
     try:
         # Connect to an ods database
         connection = psycopg2.connect(
-            host=dotenv_values().get("ODS_POSTGRES_HOST"),
-            port=dotenv_values().get("ODS_POSTGRES_PORT"),
-            database=dotenv_values().get("ODS_POSTGRES_DB"),
-            user=dotenv_values().get("ODS_POSTGRES_USER"),
-            password=dotenv_values().get("ODS_POSTGRES_PASS")
+            host=env.get("ODS_POSTGRES_HOST"),
+            port=env.get("ODS_POSTGRES_PORT"),
+            database=env.get("ODS_POSTGRES_DB"),
+            user=env.get("ODS_POSTGRES_USER"),
+            password=env.get("ODS_POSTGRES_PASS")
         )
         with connection:
             with connection.cursor() as cur:
+                migrated_rows = migrate_facts_to_partitioned(cur)
+                if migrated_rows is not None:
+                    print(f"Table 'sales_info' was migrated to partitioned table, {migrated_rows} rows were copied.")
                 tables_to_create = dict(sales_tables_ddl, **meta_info_tables_ddl)
                 for table in tables_to_create:
-                    cur.execute(create_table_ddl(table, tables_to_create[table]))
+                    if table in partitioning:
+                        cur.execute(create_table_ddl(
+                            table, tables_to_create[table],
+                            partition_by=f"RANGE ({partitioning[table]['column']})",
+                            primary_key=partitioning[table]['primary_key']
+                        ))
+                    else:
+                        cur.execute(create_table_ddl(table, tables_to_create[table]))
+                    # Columns added to definition after table was created (e.g. metrics of 'etl_meta_info')
+                    added_columns = add_missing_columns(cur, table, tables_to_create[table])
+                    if added_columns:
+                        print(f"Columns {', '.join(added_columns)} were added to table '{table}'.")
                     print(f"Table '{table}' is ready to use in PostgreSQL.")
                 for referencing_table in references:
-                    cur.execute(add_fk_ddl(referencing_table, references[referencing_table]))
+                    # Only missing foreign keys are added, unnamed constraint added again would be a duplicate
+                    cur.execute(foreign_keys_sql(referencing_table))
+                    foreign_keys = cur.fetchall()
+                    missing_refs = [ref for ref in references[referencing_table]
+                                    if not existing_fk_names(foreign_keys, ref)]
+                    if missing_refs:
+                        cur.execute(add_fk_ddl(referencing_table, missing_refs))
                     referenced_tables = ', '.join([ref['referenced_table'] for ref in references[referencing_table]])
                     print(f"Table '{referencing_table}' was referenced to tables: {referenced_tables}")
                 cur.execute("""
@@ -115,7 +312,7 @@ if __name__ == "__main__":
                         so.order_id AS "Order",
                         sp.name AS "Product",
                         spa.address AS "Purchase Address",
-                        sd.ts AS "Order Full Date",
+                        si.order_ts AS "Order Full Date",
                         sd.year AS "Order Year",
                         sd.month AS "Order Month",
                         sd.day AS "Order Day",
@@ -129,5 +326,33 @@ if __name__ == "__main__":
                     JOIN sales_date sd ON si.datetime_id = sd.id
                 """)
                 print("View 'Orders' successfully defined.")
+                for table in rollup_tables_ddl:
+                    cur.execute(create_table_ddl(
+                        table, rollup_tables_ddl[table], primary_key=tuple(rollups[table]['dimensions'])
+                    ))
+                    # Initial build from existing facts, then rollup is maintained by ETL incrementally
+                    cur.execute(build_rollup_sql(table, rollups[table]))
+                    print(f"Rollup table '{table}' is ready to use, {cur.rowcount} rows were built.")
+        # CREATE INDEX CONCURRENTLY can't be executed inside a transaction block
+        connection.autocommit = concurrently
+        with connection:
+            with connection.cursor() as cur:
+                for table in indexes:
+                    for index in indexes[table]:
+                        # Indexes of partitioned tables can't be created concurrently
+                        is_concurrent = concurrently and table not in partitioning
+                        name = index_name(table, index)
+                        cur.execute(index_is_valid_sql(name))
+                        state = cur.fetchone()
+                        if state is not None and not state[0]:
+                            # Left by failed concurrent build, IF NOT EXISTS would skip it
+                            cur.execute(drop_index_ddl(table, index, is_concurrent))
+                            print(f"Invalid index '{name}' on table '{table}' was dropped to be built again.")
+                        cur.execute(create_index_ddl(table, index, is_concurrent))
+                        cur.execute(index_is_valid_sql(name))
+                        if not cur.fetchone()[0]:
+                            print(f"Index '{name}' on table '{table}' is INVALID, run the script again.")
+                            continue
+                        print(f"Index '{name}' on table '{table}' is ready to use.")
     except (Exception, psycopg2.Error) as error:
         print("Error while creating tables: ", error)
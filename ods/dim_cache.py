@@ -0,0 +1,123 @@
+import os
+import pickle
+import random
+from collections import OrderedDict
+from psycopg2.extras import execute_values
+
+
+class DimensionKeyCache:
+    """
+    Cache of surrogate ids of ODS dimension tables (natural key -> id) with LRU eviction, persisted between runs.
+    Missing keys are resolved by 'INSERT ... ON CONFLICT DO NOTHING RETURNING' and lookup by UNIQUE column,
+    so dimension tables are never scanned.
+    Ids resolved in transaction are pending until 'commit' is called after database commit,
+    'rollback' forgets them (they may not exist in database).
+
+    Example
+        cache = DimensionKeyCache.load('dim_keys.pickle', db='ods@localhost:5432')
+        with connection:
+            with connection.cursor() as cur:
+                ids = cache.resolve(cur, 'sales_product', 'name', ['iPhone', 'Google Phone'])
+        cache.commit()
+        cache.save()
+    """
+
+    def __init__(self, max_size: int = 1000000, path: str = None, db: str = None):
+        # max_size is a limit of cached keys per dimension table
+        self.max_size = max_size
+        self.path = path
+        self.db = db
+        self._keys = {}
+        self._pending = {}
+
+    @classmethod
+    def load(cls, path: str, max_size: int = 1000000, db: str = None):
+        cache = cls(max_size, path, db)
+        if path and os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    state = pickle.load(f)
+                # Cache of other database is useless
+                if state.get('db') == db:
+                    cache._keys = state.get('keys', {})
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+        return cache
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'db': self.db, 'keys': self._keys}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def validate(self, cur, dim_table: str, key_column: str, sample_size: int = 1000):
+        """
+        Drops cached keys of dimension table, if table was rebuilt. Random sample of cached (natural key, id) pairs
+        is checked against table by primary key: after TRUNCATE and reload ids are missing (identity was not
+        restarted) or belong to other keys (it was), so any mismatch means the whole cache of table is stale.
+        :param key_column: UNIQUE column with natural key
+        :param sample_size: count of checked pairs, lookups by primary key are cheap
+        """
+        keys = self._keys.get(dim_table)
+        if not keys:
+            return
+        sample = dict(random.sample(list(keys.items()), min(sample_size, len(keys))))
+        cur.execute(f"SELECT id, {key_column} FROM {dim_table} WHERE id = ANY(%s)", (list(sample.values()),))
+        found = dict(cur.fetchall())
+        if any(found.get(dim_id) != val for val, dim_id in sample.items()):
+            del self._keys[dim_table]
+
+    def resolve(self, cur, dim_table: str, key_column: str, values, extra_columns: dict = None) -> dict:
+        """
+        Returns surrogate ids for natural keys, inserting missing keys in dimension table.
+        :param cur: cursor of ODS transaction
+        :param dim_table: dimension table name
+        :param key_column: UNIQUE column with natural key
+        :param values: distinct natural keys
+        :param extra_columns: dict {column: function(natural key) -> value} for other columns of new dimension rows
+        :return: dict {natural key: id}
+        """
+        keys = self._keys.setdefault(dim_table, OrderedDict())
+        pending = self._pending.setdefault(dim_table, {})
+        result = {}
+        missing = []
+        for val in values:
+            if val in keys:
+                keys.move_to_end(val)
+                result[val] = keys[val]
+            elif val in pending:
+                result[val] = pending[val]
+            else:
+                missing.append(val)
+        if missing:
+            extra_columns = extra_columns or {}
+            columns = ', '.join([key_column, *extra_columns])
+            found = dict(execute_values(
+                cur,
+                f"INSERT INTO {dim_table} ({columns}) VALUES %s "
+                f"ON CONFLICT ({key_column}) DO NOTHING RETURNING {key_column}, id",
+                [(val, *[func(val) for func in extra_columns.values()]) for val in missing],
+                page_size=10000,
+                fetch=True
+            ))
+            # Keys which already were in table, but not in cache
+            existing = [val for val in missing if val not in found]
+            if existing:
+                cur.execute(f"SELECT {key_column}, id FROM {dim_table} WHERE {key_column} = ANY(%s)", (existing,))
+                found.update(cur.fetchall())
+            pending.update(found)
+            result.update(found)
+        return result
+
+    def commit(self):
+        for dim_table, pending in self._pending.items():
+            keys = self._keys.setdefault(dim_table, OrderedDict())
+            keys.update(pending)
+            while len(keys) > self.max_size:
+                keys.popitem(last=False)
+        self._pending = {}
+
+    def rollback(self):
+        self._pending = {}
@@ -1,12 +1,41 @@
 from dotenv import dotenv_values
 import psycopg2
-from ddl_func import create_table_ddl
+from ddl_func import create_table_ddl, create_range_partition_ddl, bulk_load_ddl, foreign_keys_sql
 from stage.db_structure import table_ddl
-from psycopg2.extras import execute_values
+from ods.db_structure import meta_info_tables_ddl, partitioning, rollups, sales_tables_ddl, references, indexes
+from ods.rollup import apply_rollup_delta_sql, delete_empty_rollup_rows_sql
+from psycopg2.extras import execute_values, Json
+from ods.dim_cache import DimensionKeyCache
+from ods.olap import ETL_RUN_TIMEOUT
+from etl_events import EtlEventLog
+from etl_metrics import EtlProfiler, export_run_metrics
+from etl_bulk import bulk_load
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import datetime
+import os
+import sys
+import threading
 
-stage_source_table_name = dotenv_values().get("STAGE_SALES_SOURCE_TABLE")
+env = dotenv_values()
+
+stage_source_table_name = env.get("STAGE_SALES_SOURCE_TABLE")
 stage_source_table_ddl = table_ddl.get(stage_source_table_name)
+# How source rows are moved from stage to ODS temp table:
+# 'values' - fetching by python and inserting by execute_values, 'copy' - streaming stage COPY TO into ODS COPY FROM
+TRANSFER_MODE = env.get("ODS_TRANSFER_MODE") or 'values'
+TRANSFER_FETCH_SIZE = 50000
+# Dimension surrogate ids cache: file is kept between runs, size is a limit of cached keys per dimension table
+DIM_CACHE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dim_keys_cache.pickle')
+DIM_CACHE_SIZE = int(env.get("ODS_DIM_CACHE_SIZE") or 1000000)
+# Increments up to this count of rows get fact foreign keys resolved in python (no joins with dimension tables)
+PY_RESOLVE_MAX_ROWS = int(env.get("ODS_PY_RESOLVE_MAX_ROWS") or 100000)
+# Directory of Prometheus node_exporter textfile collector, metrics of the last run are written there if it's set
+METRICS_TEXTFILE_DIR = env.get("METRICS_TEXTFILE_DIR")
+# Parallel mode: increment is split in this count of disjoint ranges of source column, every range is loaded
+# by its own pair of stage and ODS connections
+WORKERS = int(env.get("ODS_WORKERS") or 1)
+PARALLEL_RANGE_COLUMN = env.get("ODS_PARALLEL_RANGE_COLUMN") or 'id'
 
 class EtlError(Exception):
     pass
@@ -26,6 +55,30 @@ def conn_inf(connection: psycopg2._psycopg.connection):
         f"DB: {connection.info.dbname}"
 
 
+def stage_connect() -> psycopg2._psycopg.connection:
+    return psycopg2.connect(
+        host=env.get("STAGE_POSTGRES_HOST"),
+        port=env.get("STAGE_POSTGRES_PORT"),
+        database=env.get("STAGE_POSTGRES_DB"),
+        user=env.get("STAGE_POSTGRES_USER"),
+        password=env.get("STAGE_POSTGRES_PASS")
+    )
+
+
+def ods_connect() -> psycopg2._psycopg.connection:
+    return psycopg2.connect(
+        host=env.get("ODS_POSTGRES_HOST"),
+        port=env.get("ODS_POSTGRES_PORT"),
+        database=env.get("ODS_POSTGRES_DB"),
+        user=env.get("ODS_POSTGRES_USER"),
+        password=env.get("ODS_POSTGRES_PASS")
+    )
+
+
+# ETL log, events are written by background thread with its own connection
+events = EtlEventLog(ods_connect, 'etl_event')
+
+
 def insert_meta(
         connection: psycopg2._psycopg.connection,
         source: str,
@@ -35,6 +88,14 @@ def insert_meta(
 ):
     try:
         with connection.cursor() as cur:
+            # Runs left in 'processing' by crashed ETL processes are closed, see 'finished_etl_meta_info_id'
+            cur.execute(
+                f"""
+                UPDATE {meta_table} SET end_date = now(), state = 'error'
+                WHERE state = 'processing' AND start_date <= LOCALTIMESTAMP - make_interval(secs => %s)
+                """,
+                (ETL_RUN_TIMEOUT,)
+            )
             cur.execute(
                 f"""
                 INSERT INTO {meta_table} (end_date, state, source, target, log)
@@ -56,26 +117,87 @@ def update_meta_info(
         datetime: datetime.datetime,
         etl_log_message: str,
         is_finished=False,
-        is_error=False):
+        is_error=False,
+        phase='etl',
+        rows_count=None,
+        duration=None,
+        metrics=None):
+    # Messages are appended to events table by background writer, meta info row is updated only on state change.
+    # 'metrics' are values of metrics columns (see etl_metrics.py), they are saved with final state.
+    level = 'error' if is_error else 'info'
+    events.log(etl_meta_info_id, phase, level, etl_log_message, rows_count, duration, ts=datetime)
+    if is_error:
+        events.flush()
+    if not (is_finished or is_error):
+        return
     try:
         with connection.cursor() as cur:
-            sql_statement = f"UPDATE {meta_table} SET \n"
-            # Get current 'log' value of meta info.
-            cur.execute(f"SELECT log FROM {meta_table} WHERE id = {etl_meta_info_id}")
-            log = f"{cur.fetchone()[0]}\n[{datetime}] {etl_log_message}"
-            # Update 'log' depends on status
-            if is_finished:
-                sql_statement += "end_date = now(), state = 'finished', \n"
-            if is_error:
-                sql_statement += "end_date = now(), state = 'error', \n"
-            # Appending log and where clause in sql statement for proper etl_meta_info_id
-            sql_statement += f"log = '{log}' \nWHERE id = {etl_meta_info_id};"
-            cur.execute(sql_statement)
+            state = 'error' if is_error else 'finished'
+            metrics = {column: Json(val) if isinstance(val, dict) else val for column, val in (metrics or {}).items()}
+            metrics_sql = ''.join([f", {column} = %s" for column in metrics])
+            cur.execute(
+                f"UPDATE {meta_table} SET end_date = now(), state = '{state}'{metrics_sql} WHERE id = {etl_meta_info_id}",
+                list(metrics.values())
+            )
         connection.commit()
     except psycopg2.Error as error:  # error.diag.message_primary
         raise UpdateEtlMetaError(f"While updating etl meta error occured: {error.diag.message_primary}")
 
 
+def copy_stage_to_ods(stage_connection: psycopg2._psycopg.connection, ods_cur, select_sql: str, temp_table: str):
+    """
+    Streams result of 'select_sql' from stage into ODS table: stage 'COPY ... TO STDOUT' is written to OS pipe
+    in background thread and ODS 'COPY ... FROM STDIN' reads it. Pipe buffer is bounded, so memory usage doesn't
+    depend on count of rows and rows never become python objects.
+    :return: count of copied rows
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def produce():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe_in, stage_connection.cursor() as stage_cur:
+                stage_cur.copy_expert(f"COPY ({select_sql}) TO STDOUT", pipe_in)
+        except Exception as error:
+            errors.append(error)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as pipe_out:
+            ods_cur.copy_expert(f"COPY {temp_table} FROM STDIN", pipe_out)
+    finally:
+        producer.join()
+    if errors:
+        raise errors[0]
+    return ods_cur.rowcount
+
+
+def load_temp_table(stage_connection: psycopg2._psycopg.connection, ods_cur, select_sql: str, mode='values'):
+    """
+    Creates (or empties) temp table like stage source table in ODS session and loads result of 'select_sql' into it.
+    :return: count of loaded rows
+    """
+    ods_cur.execute(create_table_ddl(stage_source_table_name, stage_source_table_ddl, is_temp=True))
+    ods_cur.execute(f"TRUNCATE {stage_source_table_name}")
+    match mode:
+        case 'copy':
+            return copy_stage_to_ods(stage_connection, ods_cur, select_sql, stage_source_table_name)
+        case 'values':
+            rows_count = 0
+            with stage_connection.cursor() as stage_cur:
+                stage_cur.execute(select_sql)
+                while True:
+                    rows = stage_cur.fetchmany(TRANSFER_FETCH_SIZE)
+                    if not rows:
+                        break
+                    execute_values(ods_cur, f"INSERT INTO {stage_source_table_name} VALUES %s", rows)
+                    rows_count += len(rows)
+            return rows_count
+        case _:
+            raise EtlError(f"transfer mode '{mode}' is not supported.")
+
+
 stage_ods_dim_map = {
         # ODS and Stage dim names mapping. Using info from scripts db_structure.py of ods and stage dirs
         'sales_date': {'ods': 'ts', 'stage': 'order_date', 'fact_id_col': 'datetime_id'},
@@ -84,6 +206,10 @@ stage_ods_dim_map = {
                                    'fact_id_col': 'purchase_address_id'},
         'sales_order': {'ods': 'order_id', 'stage': 'order_id', 'fact_id_col': 'order_id'}
     }
+# Values of additional columns of new dimension rows, computed from natural key
+dim_extra_columns = {
+    'sales_date': {'year': lambda ts: ts.year, 'month': lambda ts: ts.month, 'day': lambda ts: ts.day}
+}
 temp = [(f'{dim_table}.id', stage_ods_dim_map[dim_table]['fact_id_col']) for dim_table in
                                 stage_ods_dim_map]
 dim_ids = ", ".join([item[0] for item in temp])
@@ -91,309 +217,873 @@ fact_col_ids = ", ".join([item[1] for item in temp])
 dim_ids_aliases = ", \n".join([f"{item[0]} {item[1]}" for item in temp])
 
 
-if __name__ == '__main__':
-    try:
-        print("Connecting...")
-        try:
-            stage_connection = psycopg2.connect(
-                host=dotenv_values().get("STAGE_POSTGRES_HOST"),
-                port=dotenv_values().get("STAGE_POSTGRES_PORT"),
-                database=dotenv_values().get("STAGE_POSTGRES_DB"),
-                user=dotenv_values().get("STAGE_POSTGRES_USER"),
-                password=dotenv_values().get("STAGE_POSTGRES_PASS")
+# Fact value columns updated from source: {fact column: source column}
+fact_value_columns = {
+    'order_ts': 'order_date',
+    'quantity': 'quantity_ordered',
+    'price_per_each': 'price_per_each',
+    'total_price': 'total_price'
+}
+# Source column with values of fact partition key
+stage_partition_column = 'order_date'
+# MERGE is supported since PostgreSQL 15
+MERGE_MIN_SERVER_VERSION = 150000
+# NOT VALID foreign keys of partitioned tables are supported since PostgreSQL 18
+PARTITIONED_NOT_VALID_FK_MIN_SERVER_VERSION = 180000
+
+
+def update_source_sql() -> str:
+    # Source rows of source temp table with resolved dimension ids, they give new values of facts
+    joins = " \n".join(
+        [f'JOIN {item} ON {item}.{stage_ods_dim_map[item]["ods"]} = t.{stage_ods_dim_map[item]["stage"]}'
+         for item in stage_ods_dim_map])
+    return f"""
+        SELECT 
+            {dim_ids_aliases},
+            t.order_date,
+            t.quantity_ordered,
+            t.price_per_each,
+            t.price_per_each * t.quantity_ordered as total_price,
+            t.updated_at,
+            t.id 
+        FROM {stage_source_table_name} as t 
+        {joins}
+    """
+
+
+def update_columns() -> tuple:
+    # Updated fact columns and columns of 'update_source_sql' with their new values, in the same order
+    fact_cols = [stage_ods_dim_map[dim_table]['fact_id_col'] for dim_table in stage_ods_dim_map]
+    source_cols = fact_cols + list(fact_value_columns.values())
+    return fact_cols + list(fact_value_columns), source_cols
+
+
+def is_changed_sql() -> str:
+    # Condition of fact 'sales_info' which values differ from values of its source row 'source'
+    fact_cols, source_cols = update_columns()
+    return f"({', '.join([f'sales_info.{col}' for col in fact_cols])}) IS DISTINCT FROM " \
+           f"({', '.join([f'source.{col}' for col in source_cols])})"
+
+
+def update_facts_sql(sys_etl_meta_info_id: int, server_version: int) -> str:
+    """
+    Generates set-based statement updating facts by source temp table: MERGE for PostgreSQL 15+,
+    'UPDATE ... FROM' for older servers. Facts which values are not changed are skipped.
+    :param sys_etl_meta_info_id: id of current ETL meta info
+    :param server_version: server version in format of connection.server_version (e.g. 150002)
+    :return: sql
+    """
+    fact_cols, source_cols = update_columns()
+    set_list = ", \n".join(
+        [f"{fact_col} = source.{source_col}" for fact_col, source_col in zip(fact_cols, source_cols)] +
+        ["source_updated_at = source.updated_at", f"sys_etl_meta_info_id = {sys_etl_meta_info_id}"]
+    )
+    if server_version >= MERGE_MIN_SERVER_VERSION:
+        return f"""
+            MERGE INTO sales_info
+            USING ({update_source_sql()}) source
+            ON sales_info.source_id = source.id
+            WHEN MATCHED AND {is_changed_sql()} THEN
+                UPDATE SET {set_list}
+        """
+    return f"""
+        UPDATE sales_info 
+        SET {set_list}
+        FROM ({update_source_sql()}) source
+        WHERE sales_info.source_id = source.id
+            AND {is_changed_sql()}
+    """
+
+
+def changed_facts_sql() -> str:
+    """
+    Generates statement collecting source ids of facts, which are going to be changed by 'update_facts_sql',
+    in temp table 'changed_facts' (it's dropped on commit). Facts inserted by the same run and facts with the same
+    values are not there, so rollup deltas are computed only for really changed facts.
+    Months of facts before and after update are kept too: facts moved to other month leave the old one.
+    :return: sql
+    """
+    return f"""
+        CREATE TEMP TABLE changed_facts ON COMMIT DROP AS
+        SELECT
+            sales_info.source_id,
+            date_trunc('month', sales_info.order_ts) AS old_month,
+            date_trunc('month', source.order_date) AS new_month
+        FROM ({update_source_sql()}) source
+        JOIN sales_info ON sales_info.source_id = source.id
+        WHERE {is_changed_sql()}
+    """
+
+
+def watermark_source(stage_connection: psycopg2._psycopg.connection) -> str:
+    # Key of source in watermark table
+    return f"{stage_connection.info.host}:{stage_connection.info.port}/{stage_connection.info.dbname}" \
+           f"/{stage_source_table_name}"
+
+
+def load_watermark(ods_cur, source: str) -> tuple:
+    """
+    Reads high-water marks of source from watermark table by primary key.
+    If table or source record is missing, they are created and rebuilt from fact table (full scan, only once).
+    :return: tuple (max source created_at, max source updated_at, max source id)
+    """
+    ods_cur.execute("SELECT to_regclass('etl_watermark') IS NOT NULL")
+    if not ods_cur.fetchone()[0]:
+        ods_cur.execute(create_table_ddl('etl_watermark', meta_info_tables_ddl['etl_watermark']))
+    ods_cur.execute(
+        "SELECT max_source_created_at, max_source_updated_at, max_source_id FROM etl_watermark WHERE source = %s",
+        (source,)
+    )
+    watermark = ods_cur.fetchone()
+    if watermark is None:
+        ods_cur.execute("""
+            INSERT INTO etl_watermark (source, max_source_created_at, max_source_updated_at, max_source_id)
+            SELECT %s, max(source_created_at), max(source_updated_at), max(source_id) FROM sales_info
+            RETURNING max_source_created_at, max_source_updated_at, max_source_id
+        """, (source,))
+        watermark = ods_cur.fetchone()
+    return watermark
+
+
+def save_watermark(ods_cur, source: str, sys_etl_meta_info_id: int, marks: tuple = None):
+    # Moves high-water marks of source forward by records of source temp table. Should be called in fact load transaction.
+    # In parallel mode temp tables belong to workers, so marks (max created_at, max updated_at, max id) are given.
+    if marks is not None:
+        ods_cur.execute("""
+            UPDATE etl_watermark w SET
+                max_source_created_at = GREATEST(w.max_source_created_at, %s),
+                max_source_updated_at = GREATEST(w.max_source_updated_at, %s),
+                max_source_id = GREATEST(w.max_source_id, %s),
+                sys_etl_meta_info_id = %s,
+                sys_updated_at = now()
+            WHERE w.source = %s
+        """, (*marks, sys_etl_meta_info_id, source))
+        return
+    ods_cur.execute(f"""
+        UPDATE etl_watermark w SET
+            max_source_created_at = GREATEST(w.max_source_created_at, t.max_created_at),
+            max_source_updated_at = GREATEST(w.max_source_updated_at, t.max_updated_at),
+            max_source_id = GREATEST(w.max_source_id, t.max_id),
+            sys_etl_meta_info_id = %s,
+            sys_updated_at = now()
+        FROM (
+            SELECT max(created_at) max_created_at, max(updated_at) max_updated_at, max(id) max_id
+            FROM {stage_source_table_name}
+        ) t
+        WHERE w.source = %s
+    """, (sys_etl_meta_info_id, source))
+
+
+def change_capture_sql(stage_cur, max_source_created_at, max_source_updated_at) -> str:
+    """
+    Generates query selecting source records created or updated after watermarks in one pass.
+    Without watermarks (empty fact table) all source records are selected.
+    """
+    conditions = []
+    params = []
+    if max_source_created_at:
+        conditions.append("created_at > %s")
+        params.append(max_source_created_at)
+    if max_source_updated_at:
+        conditions.append("updated_at > %s")
+        params.append(max_source_updated_at)
+    if not conditions:
+        return f"SELECT * FROM {stage_source_table_name}"
+    return stage_cur.mogrify(
+        f"SELECT * FROM {stage_source_table_name} WHERE {' OR '.join(conditions)}", params
+    ).decode()
+
+
+def insert_facts_sql(sys_etl_meta_info_id: int) -> str:
+    # Inserts facts of source temp table, which are not in fact table yet, joining dimension tables
+    joins = " \n".join(
+        [f'JOIN {item} ON {item}.{stage_ods_dim_map[item]["ods"]} = t.{stage_ods_dim_map[item]["stage"]}' for
+         item in stage_ods_dim_map])
+    return f"""
+        INSERT INTO sales_info (
+            {fact_col_ids}, order_ts, quantity, price_per_each, total_price,
+            source_id, source_created_at, source_updated_at,
+            sys_etl_meta_info_id
+        )
+        SELECT DISTINCT
+            {dim_ids},
+            t.order_date,
+            quantity_ordered,
+            price_per_each,
+            price_per_each * quantity_ordered,
+            t.id,
+            t.created_at,
+            t.updated_at,
+            {sys_etl_meta_info_id}
+        FROM {stage_source_table_name} as t 
+        {joins}
+        WHERE NOT EXISTS (SELECT 1 FROM sales_info si WHERE si.source_id = t.id)
+    """
+
+
+def apply_rollup_deltas(ods_cur, where: str, sign=1):
+    # Applies aggregates of facts matching condition to all rollup tables as delta (no rebuild)
+    for rollup_table, rollup in rollups.items():
+        ods_cur.execute(apply_rollup_delta_sql(rollup_table, rollup, where, sign))
+        if sign < 0:
+            continue
+        ods_cur.execute(delete_empty_rollup_rows_sql(rollup_table, rollup))
+
+
+def create_moved_fact_months(ods_cur):
+    # Table of months left by moved facts for databases created before it, see 'save_moved_fact_months'
+    ods_cur.execute(create_table_ddl('etl_moved_fact_month', meta_info_tables_ddl['etl_moved_fact_month']))
+
+
+def save_moved_fact_months(ods_cur, sys_etl_meta_info_id: int) -> int:
+    """
+    Saves months left by facts of 'changed_facts' moved to other month: their facts are not selected
+    by ETL run id anymore, so incremental export finds them in 'etl_moved_fact_month'.
+    Table is created before load by run transaction (see 'create_moved_fact_months'), not by parallel workers.
+    :return: count of saved months
+    """
+    ods_cur.execute("""
+        INSERT INTO etl_moved_fact_month (sys_etl_meta_info_id, month)
+        SELECT DISTINCT %s, old_month
+        FROM changed_facts
+        WHERE old_month <> new_month
+    """, (sys_etl_meta_info_id,))
+    return ods_cur.rowcount
+
+
+def update_facts(ods_cur, sys_etl_meta_info_id: int, server_version: int, profiler: EtlProfiler) -> int:
+    """
+    Updates changed facts by source temp table and applies rollup deltas of them: old values of changed facts
+    are subtracted before update and new values are added after it. Should be called in fact load transaction.
+    :return: count of updated facts
+    """
+    with profiler.phase('rollup_update'):
+        ods_cur.execute(changed_facts_sql())
+        count_changed = ods_cur.rowcount
+        if not count_changed:
+            return 0
+        changed_facts = "si.source_id IN (SELECT source_id FROM changed_facts)"
+        apply_rollup_deltas(ods_cur, changed_facts, sign=-1)
+        save_moved_fact_months(ods_cur, sys_etl_meta_info_id)
+    with profiler.phase('fact_update') as stat:
+        ods_cur.execute(update_facts_sql(sys_etl_meta_info_id, server_version))
+        count_updated = stat['rows'] = ods_cur.rowcount
+    with profiler.phase('rollup_update'):
+        apply_rollup_deltas(ods_cur, changed_facts)
+    return count_updated
+
+
+def fact_partition_periods(ods_cur) -> list:
+    # Periods of fact table partitions needed for source temp table
+    fact_partitioning = partitioning.get('sales_info')
+    if not fact_partitioning:
+        return []
+    ods_cur.execute(f"""
+        SELECT DISTINCT date_trunc('{fact_partitioning['interval']}', {stage_partition_column})
+        FROM {stage_source_table_name}
+        WHERE {stage_partition_column} IS NOT NULL
+    """)
+    return [row[0] for row in ods_cur.fetchall()]
+
+
+def create_fact_partitions(ods_cur, periods: list = None) -> list:
+    """
+    Creates missing partitions of fact table for all periods of source temp table, so facts can be inserted
+    (or moved by update) without errors.
+    :param periods: periods of partitions (parallel mode), by default they are selected from source temp table
+    :return: names of checked partitions
+    """
+    fact_partitioning = partitioning.get('sales_info')
+    if not fact_partitioning:
+        return []
+    if periods is None:
+        periods = fact_partition_periods(ods_cur)
+    for period in periods:
+        ods_cur.execute(create_range_partition_ddl('sales_info', period, fact_partitioning['interval']))
+    return periods
+
+
+def dimension_values(ods_cur, ods_table: str) -> list:
+    # Distinct natural keys of dimension in source temp table
+    stage_column = stage_ods_dim_map[ods_table]['stage']
+    ods_cur.execute(
+        f"SELECT DISTINCT {stage_column} FROM {stage_source_table_name} WHERE {stage_column} IS NOT NULL")
+    return [row[0] for row in ods_cur.fetchall()]
+
+
+def refresh_dimensions(ods_cur, dim_cache: DimensionKeyCache, profiler: EtlProfiler = None,
+                       values: dict = None) -> dict:
+    """
+    Inserts new values of source temp table in ODS dimension tables and resolves their surrogate ids.
+    Dimension tables are not scanned: ids come from cache or 'INSERT ... ON CONFLICT DO NOTHING RETURNING'.
+    :param profiler: every dimension table is profiled as phase 'dim_<table>'
+    :param values: dict {dimension table: natural keys} (parallel mode), by default keys are selected
+    from source temp table
+    :return: dict {dimension table: {natural key: id}}
+    """
+    profiler = profiler or EtlProfiler()
+    dim_keys = {}
+    for ods_table, dim in stage_ods_dim_map.items():
+        with profiler.phase(f"dim_{ods_table}") as stat:
+            keys = dimension_values(ods_cur, ods_table) if values is None else values[ods_table]
+            dim_keys[ods_table] = dim_cache.resolve(
+                ods_cur, ods_table, dim['ods'], keys, dim_extra_columns.get(ods_table)
             )
-            print("Stage connected sucessfully.")
-        except psycopg2.Error as error:
-            raise StartEtlError(f"While stage connecting error occurred: \n{error}\n")
+            stat['rows'] = len(dim_keys[ods_table])
+    return dim_keys
+
+
+def insert_facts_resolved(ods_cur, dim_keys: dict, sys_etl_meta_info_id: int) -> int:
+    # Inserts facts of source temp table, which are not in fact table yet,
+    # resolving foreign keys in python by ids from 'refresh_dimensions'
+    dim_tables = list(stage_ods_dim_map)
+    stage_dims = ", ".join([f"t.{stage_ods_dim_map[dim_table]['stage']}" for dim_table in dim_tables])
+    ods_cur.execute(f"""
+        SELECT {stage_dims}, t.order_date, t.quantity_ordered, t.price_per_each, t.id, t.created_at, t.updated_at
+        FROM {stage_source_table_name} as t
+        WHERE NOT EXISTS (SELECT 1 FROM sales_info si WHERE si.source_id = t.id)
+    """)
+    facts = []
+    for row in ods_cur.fetchall():
+        ids = [dim_keys[dim_table].get(val) for dim_table, val in zip(dim_tables, row)]
+        # Same as inner join: source rows without dimension value are skipped
+        if None in ids:
+            continue
+        order_ts, quantity, price_per_each, source_id, source_created_at, source_updated_at = row[len(dim_tables):]
+        facts.append((
+            *ids, order_ts, quantity, price_per_each, price_per_each * quantity,
+            source_id, source_created_at, source_updated_at, sys_etl_meta_info_id
+        ))
+    execute_values(
+        ods_cur,
+        f"""
+        INSERT INTO sales_info (
+            {fact_col_ids}, order_ts, quantity, price_per_each, total_price,
+            source_id, source_created_at, source_updated_at,
+            sys_etl_meta_info_id
+        ) VALUES %s
+        """,
+        facts,
+        page_size=10000
+    )
+    return len(facts)
+
+
+def load_dim_cache(ods_connection: psycopg2._psycopg.connection) -> DimensionKeyCache:
+    # Cache of dimension ids from previous runs, it's dropped for rebuilt dimension tables
+    dim_cache = DimensionKeyCache.load(DIM_CACHE_PATH, DIM_CACHE_SIZE, conn_inf(ods_connection))
+    with ods_connection:
+        with ods_connection.cursor() as ods_cur:
+            for ods_table, dim in stage_ods_dim_map.items():
+                dim_cache.validate(ods_cur, ods_table, dim['ods'])
+    return dim_cache
+
 
+def bulk_tables_ddl(connection: psycopg2._psycopg.connection) -> list:
+    """
+    Bulk mode suspends constraints and indexes of fact table only: UNIQUE keys of dimension tables are needed
+    by 'ON CONFLICT' of dimension inserts and primary keys of rollups by their upserts.
+    Foreign keys are dropped by their names in database: constraints added without names may be named otherwise.
+    """
+    with connection:
+        with connection.cursor() as cur:
+            cur.execute(foreign_keys_sql('sales_info'))
+            foreign_keys = cur.fetchall()
+    return [
+        bulk_load_ddl(
+            'sales_info', sales_tables_ddl['sales_info'], references['sales_info'], (), indexes['sales_info'],
+            not_valid='sales_info' not in partitioning
+            or connection.server_version >= PARTITIONED_NOT_VALID_FK_MIN_SERVER_VERSION,
+            foreign_keys=foreign_keys
+        )
+    ]
+
+
+def increment_ranges(stage_cur, select_sql: str, column: str, count: int) -> list:
+    """
+    Splits source increment in up to 'count' disjoint ranges of column with close counts of rows (by ntile).
+    The first range has no lower bound and the last one has no upper bound, so ranges cover all increment rows.
+    :return: list of queries selecting rows of ranges, empty list for empty increment
+    """
+    stage_cur.execute(f"""
+        SELECT min({column})
+        FROM (SELECT {column}, ntile({count}) OVER (ORDER BY {column}) part FROM ({select_sql}) s) parts
+        GROUP BY part
+    """)
+    # Equal bounds (e.g. many rows with the same created_at) give one range
+    bounds = sorted(set([row[0] for row in stage_cur.fetchall()]))
+    queries = []
+    for i, lower in enumerate(bounds):
+        conditions = []
+        params = []
+        if i > 0:
+            conditions.append(f"{column} >= %s")
+            params.append(lower)
+        if i < len(bounds) - 1:
+            conditions.append(f"{column} < %s")
+            params.append(bounds[i + 1])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        queries.append(stage_cur.mogrify(f"SELECT * FROM ({select_sql}) s{where}", params).decode())
+    return queries
+
+
+def load_range(
+        stage_connection: psycopg2._psycopg.connection,
+        ods_connection: psycopg2._psycopg.connection,
+        range_sql: str,
+        profiler: EtlProfiler) -> dict:
+    """
+    The first step of parallel mode worker: loads range of increment in temp table of worker ODS session
+    and collects what coordinator needs from it. Temp table stays in session for 'load_range_facts'.
+    :return: dict with count of rows, natural keys of dimensions, fact partition periods and
+    watermarks (max created_at, max updated_at, max id) of range
+    """
+    with stage_connection, ods_connection:
+        with ods_connection.cursor() as ods_cur:
+            with profiler.phase('temp_load') as stat:
+                rows_count = stat['rows'] = load_temp_table(stage_connection, ods_cur, range_sql, TRANSFER_MODE)
+            ods_cur.execute(f"SELECT max(created_at), max(updated_at), max(id) FROM {stage_source_table_name}")
+            marks = ods_cur.fetchone()
+            return {
+                'rows_count': rows_count,
+                'dimension_values': {ods_table: dimension_values(ods_cur, ods_table) for ods_table in stage_ods_dim_map},
+                'periods': fact_partition_periods(ods_cur),
+                'marks': marks
+            }
+
+
+def load_range_facts(
+        ods_connection: psycopg2._psycopg.connection,
+        dim_keys: dict,
+        sys_etl_meta_info_id: int,
+        rows_count: int,
+        with_update: bool,
+        profiler: EtlProfiler) -> tuple:
+    """
+    The second step of parallel mode worker: inserts new facts of worker temp table and updates changed ones
+    in one transaction. Facts are inserted in parallel with other workers. Rollup deltas and updates are made
+    under transaction advisory lock: rollup rows are shared by all workers, concurrent upserts of them would
+    wait for each other anyway and could deadlock.
+    :param with_update: fact table was not empty before run, so there may be facts to update
+    :return: tuple (count of inserted facts, count of updated facts or None)
+    """
+    count_updated = None
+    with ods_connection:
+        with ods_connection.cursor() as ods_cur:
+            with profiler.phase('fact_insert') as stat:
+                if rows_count <= PY_RESOLVE_MAX_ROWS:
+                    count_insert = insert_facts_resolved(ods_cur, dim_keys, sys_etl_meta_info_id)
+                else:
+                    ods_cur.execute(insert_facts_sql(sys_etl_meta_info_id))
+                    count_insert = ods_cur.rowcount
+                stat['rows'] = count_insert
+            with profiler.phase('rollup_lock'):
+                ods_cur.execute("SELECT pg_advisory_xact_lock(hashtext('ods_rollups'))")
+            if count_insert:
+                with profiler.phase('rollup_insert'):
+                    apply_rollup_deltas(
+                        ods_cur,
+                        f"si.sys_etl_meta_info_id = {sys_etl_meta_info_id} "
+                        f"AND si.source_id IN (SELECT id FROM {stage_source_table_name})"
+                    )
+            if with_update:
+                count_updated = update_facts(ods_cur, sys_etl_meta_info_id, ods_connection.server_version, profiler)
+    return count_insert, count_updated
+
+
+def run_etl(
+        stage_connection: psycopg2._psycopg.connection,
+        ods_connection: psycopg2._psycopg.connection,
+        ods_connection_meta: psycopg2._psycopg.connection,
+        dim_cache: DimensionKeyCache,
+        save_dim_cache=True) -> int:
+    """
+    Runs one ODS ETL increment: new and updated stage rows after watermark are loaded in ODS.
+    Connections may be reused by next runs (daemon mode), temp table is truncated by every run.
+    :param save_dim_cache: save dimension ids cache to file after run (daemon saves it periodically instead)
+    :return: count of source rows in increment
+    """
+    # Phases: 'extract', 'temp_load', 'dim_<table>', 'partitions', 'fact_insert', 'fact_update', 'rollup_insert',
+    # 'rollup_update', 'watermark'
+    profiler = EtlProfiler()
+    with ods_connection_meta:
+        # Extracting new and updated source records in one pass
         try:
-            ods_connection = psycopg2.connect(
-                host=dotenv_values().get("ODS_POSTGRES_HOST"),
-                port=dotenv_values().get("ODS_POSTGRES_PORT"),
-                database=dotenv_values().get("ODS_POSTGRES_DB"),
-                user=dotenv_values().get("ODS_POSTGRES_USER"),
-                password=dotenv_values().get("ODS_POSTGRES_PASS")
-            )
-            ods_connection_meta = psycopg2.connect(
-                host=dotenv_values().get("ODS_POSTGRES_HOST"),
-                port=dotenv_values().get("ODS_POSTGRES_PORT"),
-                database=dotenv_values().get("ODS_POSTGRES_DB"),
-                user=dotenv_values().get("ODS_POSTGRES_USER"),
-                password=dotenv_values().get("ODS_POSTGRES_PASS")
+            sys_etl_meta_info_id = insert_meta(
+                ods_connection_meta, conn_inf(stage_connection), conn_inf(ods_connection),
+                'etl_meta_info', datetime.datetime.now(datetime.timezone.utc)
             )
-            print("ODS connected sucessfully.")
-        except psycopg2.Error as error:  # error.diag.message_primary
-            raise StartEtlError(f"While ODS connecting error occured: {error.diag.message_primary}")
 
-        # ETLing new source records
-        with ods_connection_meta:
-            try:
-                sys_etl_meta_info_id = insert_meta(
-                    ods_connection_meta, conn_inf(stage_connection), conn_inf(ods_connection),
-                    'etl_meta_info', datetime.datetime.now(datetime.timezone.utc)
-                )
+            with stage_connection, ods_connection:
+                with stage_connection.cursor() as stage_cur, ods_connection.cursor() as ods_cur:
+                    update_meta_info(
+                        ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                        datetime.datetime.now(datetime.timezone.utc),
+                        "Selecting new and updated source data...",
+                        phase='extract'
+                    )
+
+                    with profiler.phase('extract'):
+                        source = watermark_source(stage_connection)
+                        max_source_created_at, max_source_updated_at, _ = load_watermark(ods_cur, source)
+                        create_moved_fact_months(ods_cur)
+
+                        select_sql = change_capture_sql(stage_cur, max_source_created_at, max_source_updated_at)
+
+                    # Loading source data in temp table like source.
+                    # It's used to insert and update values using PostgreSQL, not python
+                    with profiler.phase('temp_load') as stat:
+                        source_rows_count = load_temp_table(stage_connection, ods_cur, select_sql, TRANSFER_MODE)
+                        stat['rows'] = source_rows_count
 
-                with stage_connection, ods_connection:
-                    with stage_connection.cursor() as stage_cur, ods_connection.cursor() as ods_cur:
+                    if source_rows_count != 0:
                         update_meta_info(
                             ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
                             datetime.datetime.now(datetime.timezone.utc),
-                            "Selecting new source data..."
+                            f"Selecting new and updated source data finished: collected {source_rows_count} rows "
+                            f"in temp table in target (transfer mode '{TRANSFER_MODE}'). "
+                            "Target dimension tables updating by new values...",
+                            phase='extract', rows_count=source_rows_count, duration=profiler.seconds('temp_load')
                         )
 
-                        ods_cur.execute("SELECT max(source_created_at) FROM sales_info")
-                        max_source_created_at = ods_cur.fetchall()[0][0]
+                        # Starting ODS dimension tables updating by new values.
+                        dim_keys = refresh_dimensions(ods_cur, dim_cache, profiler)
+                        # Fact table partitions for all periods of source data
+                        with profiler.phase('partitions') as stat:
+                            partition_periods = create_fact_partitions(ods_cur)
+                            stat['rows'] = len(partition_periods)
 
-                        if max_source_created_at:
-                            stage_cur.execute(f"SELECT * FROM {stage_source_table_name} WHERE created_at > %s",
-                                              (max_source_created_at,))
-                        else:
-                            stage_cur.execute(f"SELECT * FROM {stage_source_table_name}")
-
-
-                        if stage_cur.rowcount != 0:
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                f"Selecting new source data finished: collected {stage_cur.rowcount} rows. "
-                                f"Trying to create temp table in target for source data."
-                            )
-
-                            # Creating temp table like source. It's used to insert new values using PostgreSQL, not python
-                            ods_cur.execute(create_table_ddl(stage_source_table_name, stage_source_table_ddl, is_temp=True))
-                            while True:
-                                rows = stage_cur.fetchmany(50000)
-                                if not rows:
-                                    break
-                                execute_values(ods_cur, f"INSERT INTO {stage_source_table_name} VALUES %s", rows)
-
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                "Temp table in target for source data was created succesfully. "
-                                "Target dimension tables updating by new values..."
-                            )
+                        update_meta_info(
+                            ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                            datetime.datetime.now(datetime.timezone.utc),
+                            "Target dimension tables were updated successfully. "
+                            f"Target fact table partitions are ready for {len(partition_periods)} periods.",
+                            phase='extract'
+                        )
+            # Ids resolved in committed transaction can be cached
+            dim_cache.commit()
+        except (InsertEtlMetaError, UpdateEtlMetaError) as e:
+            dim_cache.rollback()
+            raise e
+        except Exception as e:
+            dim_cache.rollback()
+            update_meta_info(
+                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                datetime.datetime.now(datetime.timezone.utc),
+                f"Error while trying to extract source data:{e}",
+                is_error=True, phase='extract', metrics=profiler.meta_values()
+            )
+            export_run_metrics(METRICS_TEXTFILE_DIR, 'ods', profiler, success=False)
+            raise EtlError
 
-                            # Starting ODS dimension tables updating by new values.
-                            for ods_table in stage_ods_dim_map:
-                                # Selecting values from stage, which are not represented in ods dim tables
-                                sqltemp = f"""
-                                    SELECT stage.dim
-                                    FROM (
-                                        SELECT DISTINCT {stage_ods_dim_map[ods_table]['stage']} as dim 
-                                        FROM {stage_source_table_name}
-                                    ) stage
-                                    LEFT JOIN (
-                                        SELECT DISTINCT {stage_ods_dim_map[ods_table]['ods']} as dim 
-                                        FROM {ods_table}
-                                    ) ods 
-                                    USING (dim)
-                                    WHERE ods.dim IS NULL
-                                """
-                                # Inserting new values in ODS dim tables
-                                ods_cur.execute(sqltemp)
-                                execute_values(
+        # ETL: insert new records (source ids, which are not in fact table)
+        try:
+            if source_rows_count != 0:
+                update_meta_info(
+                    ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                    datetime.datetime.now(datetime.timezone.utc),
+                    "Inserting new values in target fact table...",
+                    phase='insert'
+                )
+                with ods_connection:
+                    with ods_connection.cursor() as ods_cur:
+                        with profiler.phase('fact_insert') as stat:
+                            if source_rows_count <= PY_RESOLVE_MAX_ROWS:
+                                count_insert = insert_facts_resolved(ods_cur, dim_keys, sys_etl_meta_info_id)
+                            else:
+                                ods_cur.execute(insert_facts_sql(sys_etl_meta_info_id))
+                                count_insert = ods_cur.rowcount
+                            stat['rows'] = count_insert
+                        # New facts are added to rollups in the same transaction
+                        if count_insert:
+                            with profiler.phase('rollup_insert'):
+                                apply_rollup_deltas(
                                     ods_cur,
-                                    f"INSERT INTO {ods_table} ({stage_ods_dim_map[ods_table]['ods']}{', year, month, day' if ods_table == 'sales_date' else ''}) VALUES %s",
-                                    [(val[0], val[0].year, val[0].month, val[0].day) for val in ods_cur.fetchall()] if ods_table == 'sales_date'
-                                    else ods_cur.fetchall()
-                                )
-
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                "Target dimension tables were updated successfully. Inserting new values in target fact table..."
-                            )
-
-                            # Inserting new values in ODS fact table.
-                            joins = " \n".join(
-                                [f'JOIN {item} ON {item}.{stage_ods_dim_map[item]["ods"]} = t.{stage_ods_dim_map[item]["stage"]}' for
-                                 item in stage_ods_dim_map])
-                            ods_cur.execute(f"""
-                                INSERT INTO sales_info (
-                                    {fact_col_ids}, quantity, price_per_each, total_price,
-                                    source_id, source_created_at, source_updated_at,
-                                    sys_etl_meta_info_id
+                                    f"si.sys_etl_meta_info_id = {sys_etl_meta_info_id} "
+                                    f"AND si.source_id IN (SELECT id FROM {stage_source_table_name})"
                                 )
-                                SELECT DISTINCT
-                                    {dim_ids},
-                                    quantity_ordered,
-                                    price_per_each,
-                                    price_per_each * quantity_ordered,
-                                    t.id,
-                                    t.created_at,
-                                    t.updated_at,
-                                    {sys_etl_meta_info_id}
-                                FROM {stage_source_table_name} as t 
-                                {joins}
-                            """)
-                            count_insert = ods_cur.rowcount
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                f"Inserting new values in target fact table finished: {count_insert} new facts."
-                            )
-                        else:
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                "No new data."
-                            )
-            except (InsertEtlMetaError, UpdateEtlMetaError) as e:
-                raise e
-            except Exception as e:
                 update_meta_info(
                     ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
                     datetime.datetime.now(datetime.timezone.utc),
-                    f"Error while trying to ETL new data:{e}",
-                    is_error=True
+                    f"Inserting new values in target fact table finished: {count_insert} new facts.",
+                    phase='insert', rows_count=count_insert, duration=profiler.seconds('fact_insert')
                 )
-                raise EtlError
-
-            try:
+            else:
                 update_meta_info(
                     ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
                     datetime.datetime.now(datetime.timezone.utc),
-                    "Selecting source data to be updated..."
+                    "No new data.",
+                    phase='insert', rows_count=0
                 )
+        except (InsertEtlMetaError, UpdateEtlMetaError) as e:
+            raise e
+        except Exception as e:
+            update_meta_info(
+                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                datetime.datetime.now(datetime.timezone.utc),
+                f"Error while trying to ETL new data:{e}",
+                is_error=True, phase='insert', metrics=profiler.meta_values(source_rows_count)
+            )
+            export_run_metrics(METRICS_TEXTFILE_DIR, 'ods', profiler, source_rows_count, success=False)
+            raise EtlError
 
-                # ETL: update old records
-                with stage_connection, ods_connection:
-                    with stage_connection.cursor() as stage_cur, ods_connection.cursor() as ods_cur:
-                        ods_cur.execute("SELECT max(source_updated_at) FROM sales_info")
-                        max_source_updated_at = ods_cur.fetchall()[0][0]
-
+        # ETL: update old records (source ids, which are in fact table).
+        # Facts inserted just now are not changed by update, so they are skipped.
+        try:
+            if source_rows_count != 0:
+                with ods_connection:
+                    with ods_connection.cursor() as ods_cur:
+                        count_updated = None
+                        # Empty fact table before this run means that there is nothing to update
                         if max_source_updated_at:
-                            stage_cur.execute(f"SELECT * FROM {stage_source_table_name} WHERE updated_at > %s",
-                                              (max_source_updated_at,))
-
-                        if stage_cur.rowcount not in (0, -1):
                             update_meta_info(
                                 ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
                                 datetime.datetime.now(datetime.timezone.utc),
-                                f"Selecting source data to be updated finished: collected {stage_cur.rowcount}. "
-                                f"Trying to create temp table in target for source data."
+                                "Updating values in target fact table...",
+                                phase='update'
                             )
+                            # Updating new values in ODS fact table (only facts with changed values),
+                            # rollups get delta of them: old values are subtracted, new values are added
+                            count_updated = update_facts(
+                                ods_cur, sys_etl_meta_info_id, ods_connection.server_version, profiler)
+                        # Watermarks are moved in the same transaction as the last fact load
+                        with profiler.phase('watermark'):
+                            save_watermark(ods_cur, source, sys_etl_meta_info_id)
+                update_meta_info(
+                    ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                    datetime.datetime.now(datetime.timezone.utc),
+                    "No data to update." if count_updated is None else
+                    f"Updating values in target fact table finished: {count_updated} facts.",
+                    phase='update', rows_count=count_updated, duration=profiler.seconds('fact_update')
+                )
+            else:
+                update_meta_info(
+                    ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                    datetime.datetime.now(datetime.timezone.utc),
+                    "No data to update.",
+                    phase='update', rows_count=0
+                )
+        except (InsertEtlMetaError, UpdateEtlMetaError) as e:
+            raise e
+        except Exception as e:
+            update_meta_info(
+                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                datetime.datetime.now(datetime.timezone.utc),
+                f"Error while trying to update data:{e}",
+                is_error=True, phase='update', metrics=profiler.meta_values(source_rows_count)
+            )
+            export_run_metrics(METRICS_TEXTFILE_DIR, 'ods', profiler, source_rows_count, success=False)
+            raise EtlError
 
-                            # Creating temp table like source. It's used to insert new values using PostgreSQL, not python
-                            ods_cur.execute(create_table_ddl(stage_source_table_name, stage_source_table_ddl, is_temp=True))
-                            while True:
-                                rows = stage_cur.fetchmany(50000)
-                                if not rows:
-                                    break
-                                execute_values(ods_cur, f"INSERT INTO {stage_source_table_name} VALUES %s", rows)
+        update_meta_info(
+            ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+            datetime.datetime.now(datetime.timezone.utc),
+            f"ETL finished.",
+            is_finished=True, metrics=profiler.meta_values(source_rows_count)
+        )
+        export_run_metrics(METRICS_TEXTFILE_DIR, 'ods', profiler, source_rows_count)
+        if save_dim_cache:
+            dim_cache.save()
+    return source_rows_count
 
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                "Temp table in target for source data was created succesfully. "
-                                "Target dimension tables updating by new values..."
-                            )
 
-                            # Starting ODS dimension tables updating by new values.
-                            for ods_table in stage_ods_dim_map:
-                                # Selecting values from stage, which are not represented in ods dim tables
-                                sqltemp = f"""
-                                    SELECT stage.dim
-                                    FROM (
-                                        SELECT DISTINCT {stage_ods_dim_map[ods_table]['stage']} as dim 
-                                        FROM {stage_source_table_name}
-                                    ) stage
-                                    LEFT JOIN (
-                                        SELECT DISTINCT {stage_ods_dim_map[ods_table]['ods']} as dim 
-                                        FROM {ods_table}
-                                    ) ods 
-                                    USING (dim)
-                                    WHERE ods.dim IS NULL
-                                """
-                                # Inserting new values in ODS dim tables
-                                ods_cur.execute(sqltemp)
-                                execute_values(
-                                    ods_cur,
-                                    f"""
-                                    INSERT INTO {ods_table} 
-                                    ({stage_ods_dim_map[ods_table]['ods']}{', year, month, day' if ods_table == 'sales date' else ''}) 
-                                    VALUES %s
-                                    """,
-                                    [(val, val.year, val.month, val.day) for val in ods_cur.fetchall()] if ods_table == 'sales date'
-                                    else ods_cur.fetchall()
-                                )
+def run_etl_parallel(
+        stage_connection: psycopg2._psycopg.connection,
+        ods_connection: psycopg2._psycopg.connection,
+        ods_connection_meta: psycopg2._psycopg.connection,
+        dim_cache: DimensionKeyCache,
+        workers: list,
+        range_column=PARALLEL_RANGE_COLUMN,
+        save_dim_cache=True) -> int:
+    """
+    Runs one ODS ETL increment in parallel: increment is split in disjoint ranges of 'range_column' ('id' or
+    'created_at'), every range is extracted, loaded in temp table and inserted in fact table by its worker thread
+    with its own connections. Dimension tables and fact partitions are updated only by coordinator ('ods_connection')
+    between these steps, so workers never insert the same UNIQUE keys. Run has one meta info record.
+    If a worker fails, facts of other workers stay committed (with their rollup deltas), but watermarks are not moved:
+    next run selects the same rows again, inserted facts are skipped by insert and not changed by update.
+    :param workers: list of tuples (stage connection, ODS connection), one range per worker
+    :param range_column: source column to split increment by
+    :param save_dim_cache: save dimension ids cache to file after run
+    :return: count of source rows in increment
+    """
+    if range_column not in ('id', 'created_at'):
+        raise EtlError(f"range column '{range_column}' is not supported.")
+    # Phases are the same as in 'run_etl' and 'rollup_lock' (waiting of workers for each other),
+    # time of worker phases is summed over workers
+    profiler = EtlProfiler()
+    with ods_connection_meta:
+        try:
+            sys_etl_meta_info_id = insert_meta(
+                ods_connection_meta, conn_inf(stage_connection), conn_inf(ods_connection),
+                'etl_meta_info', datetime.datetime.now(datetime.timezone.utc)
+            )
+            update_meta_info(
+                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                datetime.datetime.now(datetime.timezone.utc),
+                f"Selecting new and updated source data by {len(workers)} workers (ranges of {range_column})...",
+                phase='extract'
+            )
+            with stage_connection, ods_connection:
+                with stage_connection.cursor() as stage_cur, ods_connection.cursor() as ods_cur:
+                    with profiler.phase('extract'):
+                        source = watermark_source(stage_connection)
+                        max_source_created_at, max_source_updated_at, _ = load_watermark(ods_cur, source)
+                        create_moved_fact_months(ods_cur)
+                        select_sql = change_capture_sql(stage_cur, max_source_created_at, max_source_updated_at)
+                        range_sqls = increment_ranges(stage_cur, select_sql, range_column, len(workers))
 
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                "Target dimension tables were updated successfully. Updating values in target fact table..."
-                            )
+            with ThreadPoolExecutor(max_workers=len(workers)) as pool:
+                ranges = list(pool.map(
+                    lambda worker, range_sql: load_range(*worker, range_sql, profiler), workers, range_sqls
+                ))
+            source_rows_count = sum([item['rows_count'] for item in ranges])
 
-                            # Updating new values in ODS fact table.
-                            joins = " \n".join(
-                                [f'JOIN {item} ON {item}.{stage_ods_dim_map[item]["ods"]} = t.{stage_ods_dim_map[item]["stage"]}'
-                                 for
-                                 item in stage_ods_dim_map])
-                            sqltemp = f"""
-                                WITH source as (
-                                    SELECT 
-                                        {dim_ids_aliases},
-                                        quantity_ordered,
-                                        price_per_each,
-                                        price_per_each * quantity_ordered as total_price,
-                                        t.updated_at,
-                                        {sys_etl_meta_info_id} as sys_etl_meta_info_id,
-                                        t.id 
-                                    FROM {stage_source_table_name} as t 
-                                    {joins}
-                                )
-                                UPDATE sales_info 
-                                SET (
-                                    {fact_col_ids}, 
-                                    quantity, 
-                                    price_per_each, 
-                                    total_price,
-                                    source_updated_at,
-                                    sys_etl_meta_info_id
-                                ) = (
-                                    SELECT 
-                                        {fact_col_ids},
-                                        quantity_ordered,
-                                        price_per_each,
-                                        total_price,
-                                        updated_at,
-                                        sys_etl_meta_info_id
-                                    FROM source
-                                    WHERE source.id = sales_info.source_id
-                                )
-                                WHERE sales_info.source_id IN (SELECT id FROM source)
-                            """
-                            ods_cur.execute(sqltemp)
-                            count_updated = ods_cur.rowcount
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                f"Updating values in target fact table finished: {count_updated} facts."
-                            )
-                        else:
-                            update_meta_info(
-                                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
-                                datetime.datetime.now(datetime.timezone.utc),
-                                "No data to update."
-                            )
-            except (InsertEtlMetaError, UpdateEtlMetaError) as e:
-                raise e
-            except Exception as e:
+            if source_rows_count != 0:
                 update_meta_info(
                     ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
                     datetime.datetime.now(datetime.timezone.utc),
-                    f"Error while trying to update data:{e}",
-                    is_error=True,
+                    f"Selecting new and updated source data finished: collected {source_rows_count} rows "
+                    f"in temp tables of {len(ranges)} workers (transfer mode '{TRANSFER_MODE}'). "
+                    "Target dimension tables updating by new values...",
+                    phase='extract', rows_count=source_rows_count, duration=profiler.seconds('temp_load')
                 )
-                raise EtlError
+                values = {
+                    ods_table: list(set().union(*[item['dimension_values'][ods_table] for item in ranges]))
+                    for ods_table in stage_ods_dim_map
+                }
+                with ods_connection:
+                    with ods_connection.cursor() as ods_cur:
+                        dim_keys = refresh_dimensions(ods_cur, dim_cache, profiler, values)
+                        with profiler.phase('partitions') as stat:
+                            partition_periods = create_fact_partitions(
+                                ods_cur, sorted(set().union(*[item['periods'] for item in ranges])))
+                            stat['rows'] = len(partition_periods)
+                update_meta_info(
+                    ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                    datetime.datetime.now(datetime.timezone.utc),
+                    "Target dimension tables were updated successfully. "
+                    f"Target fact table partitions are ready for {len(partition_periods)} periods.",
+                    phase='extract'
+                )
+            dim_cache.commit()
+        except (InsertEtlMetaError, UpdateEtlMetaError) as e:
+            dim_cache.rollback()
+            raise e
+        except Exception as e:
+            dim_cache.rollback()
+            update_meta_info(
+                ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                datetime.datetime.now(datetime.timezone.utc),
+                f"Error while trying to extract source data:{e}",
+                is_error=True, phase='extract', metrics=profiler.meta_values()
+            )
+            export_run_metrics(METRICS_TEXTFILE_DIR, 'ods', profiler, success=False)
+            raise EtlError
 
+        # ETL: workers insert new facts and update changed ones of their ranges
+        try:
+            if source_rows_count != 0:
+                update_meta_info(
+                    ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                    datetime.datetime.now(datetime.timezone.utc),
+                    f"Inserting and updating values in target fact table by {len(ranges)} workers...",
+                    phase='insert'
+                )
+                with_update = bool(max_source_updated_at)
+                with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                    counts = list(pool.map(
+                        lambda worker, item: load_range_facts(
+                            worker[1], dim_keys, sys_etl_meta_info_id, item['rows_count'], with_update, profiler
+                        ),
+                        workers, ranges
+                    ))
+                count_insert = sum([count for count, _ in counts])
+                count_updated = sum([count for _, count in counts]) if with_update else None
+                update_meta_info(
+                    ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                    datetime.datetime.now(datetime.timezone.utc),
+                    f"Inserting new values in target fact table finished: {count_insert} new facts.",
+                    phase='insert', rows_count=count_insert, duration=profiler.seconds('fact_insert')
+                )
+                update_meta_info(
+                    ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                    datetime.datetime.now(datetime.timezone.utc),
+                    "No data to update." if count_updated is None else
+                    f"Updating values in target fact table finished: {count_updated} facts.",
+                    phase='update', rows_count=count_updated, duration=profiler.seconds('fact_update')
+                )
+                # Watermarks are moved only after all workers committed their facts
+                marks = tuple([
+                    max([item['marks'][i] for item in ranges if item['marks'][i] is not None], default=None)
+                    for i in range(3)
+                ])
+                with ods_connection:
+                    with ods_connection.cursor() as ods_cur:
+                        with profiler.phase('watermark'):
+                            save_watermark(ods_cur, source, sys_etl_meta_info_id, marks)
+            else:
+                update_meta_info(
+                    ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+                    datetime.datetime.now(datetime.timezone.utc),
+                    "No new data.",
+                    phase='insert', rows_count=0
+                )
+        except (InsertEtlMetaError, UpdateEtlMetaError) as e:
+            raise e
+        except Exception as e:
             update_meta_info(
                 ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
                 datetime.datetime.now(datetime.timezone.utc),
-                f"ETL finished.",
-                is_finished=True
+                f"Error while trying to ETL new and updated data:{e}",
+                is_error=True, phase='insert', metrics=profiler.meta_values(source_rows_count)
             )
+            export_run_metrics(METRICS_TEXTFILE_DIR, 'ods', profiler, source_rows_count, success=False)
+            raise EtlError
+
+        update_meta_info(
+            ods_connection_meta, 'etl_meta_info', sys_etl_meta_info_id,
+            datetime.datetime.now(datetime.timezone.utc),
+            f"ETL finished.",
+            is_finished=True, metrics=profiler.meta_values(source_rows_count)
+        )
+        export_run_metrics(METRICS_TEXTFILE_DIR, 'ods', profiler, source_rows_count)
+        if save_dim_cache:
+            dim_cache.save()
+    return source_rows_count
+
+
+if __name__ == '__main__':
+    try:
+        print("Connecting...")
+        try:
+            stage_connection = stage_connect()
+            print("Stage connected sucessfully.")
+        except psycopg2.Error as error:
+            raise StartEtlError(f"While stage connecting error occurred: \n{error}\n")
+
+        try:
+            ods_connection = ods_connect()
+            ods_connection_meta = ods_connect()
+            # Parallel mode: stage and ODS connections of every worker
+            workers = [(stage_connect(), ods_connect()) for _ in range(WORKERS)] if WORKERS > 1 else []
+            print("ODS connected sucessfully.")
+        except psycopg2.Error as error:  # error.diag.message_primary
+            raise StartEtlError(f"While ODS connecting error occured: {error.diag.message_primary}")
+
+        dim_cache = load_dim_cache(ods_connection)
+        # Run with '--bulk' for initial load or backfill: fact table constraints and indexes are rebuilt after load
+        is_bulk = '--bulk' in sys.argv
+        bulk_connection = ods_connect() if is_bulk else None
+        try:
+            with bulk_load(bulk_connection, bulk_tables_ddl(bulk_connection)) if is_bulk else nullcontext():
+                if workers:
+                    run_etl_parallel(stage_connection, ods_connection, ods_connection_meta, dim_cache, workers)
+                else:
+                    run_etl(stage_connection, ods_connection, ods_connection_meta, dim_cache)
+        finally:
+            if bulk_connection is not None:
+                bulk_connection.close()
 
     except StartEtlError as error:
         print(f"{error}\nETL won't be stared.")
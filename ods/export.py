@@ -0,0 +1,219 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import numpy as np
+from dotenv import dotenv_values
+import psycopg2
+from ddl_func import partition_bounds
+from ods.olap import finished_etl_meta_info_id
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+env = dotenv_values()
+
+EXPORT_DIR = env.get("ODS_EXPORT_DIR") or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'orders_export')
+# 'parquet' (needs pyarrow) or 'npz', by default Parquet is written if pyarrow is installed
+EXPORT_FORMAT = env.get("ODS_EXPORT_FORMAT") or ('parquet' if pa is not None else 'npz')
+EXPORT_FETCH_SIZE = 100000
+EXPORT_STATE_FILE = '_export_state.json'
+
+# Columns of 'Orders' view in export files and their kinds: 'int', 'float', 'timestamp' or 'dictionary'
+# (dimension strings are stored as integer codes and dictionary of distinct values)
+export_columns = {
+    "Order": "int",
+    "Product": "dictionary",
+    "Purchase Address": "dictionary",
+    "Order Full Date": "timestamp",
+    "Order Year": "int",
+    "Order Month": "int",
+    "Order Day": "int",
+    "Product Quantity": "int",
+    "Product Price": "float",
+    "Order Full Price": "float"
+}
+
+
+def partition_dir(path: str, month) -> str:
+    # Hive style partition directory, e.g. 'year=2019/month=04', readable by pyarrow.dataset and pandas
+    return os.path.join(path, f"year={month.year}", f"month={month.month:02d}")
+
+
+def select_month(cur, month) -> dict:
+    """
+    Selects facts of 'Orders' view of month, filter by 'Order Full Date' prunes fact table partitions.
+    :return: dict {column: list of values}
+    """
+    start, end = partition_bounds(month, 'month')
+    columns = ', '.join([f'coalesce("{column}", 0)' if kind == 'int' else f'"{column}"'
+                         for column, kind in export_columns.items()])
+    cur.execute(f"""
+        SELECT {columns}
+        FROM Orders
+        WHERE "Order Full Date" >= %s AND "Order Full Date" < %s
+    """, (start, end))
+    data = {column: [] for column in export_columns}
+    while rows := cur.fetchmany(EXPORT_FETCH_SIZE):
+        for column, values in zip(export_columns, zip(*rows)):
+            data[column].extend(values)
+    return data
+
+
+def write_parquet(file: str, data: dict):
+    arrays = []
+    for column, kind in export_columns.items():
+        match kind:
+            case 'dictionary':
+                arrays.append(pa.array(data[column], pa.string()).dictionary_encode())
+            case 'timestamp':
+                arrays.append(pa.array(data[column], pa.timestamp('us')))
+            case 'int':
+                arrays.append(pa.array(data[column], pa.int64()))
+            case 'float':
+                # NUMERIC values come as Decimal
+                arrays.append(pa.array([None if val is None else float(val) for val in data[column]], pa.float64()))
+    pq.write_table(pa.table(arrays, names=list(export_columns)), file)
+
+
+def write_npz(file: str, data: dict):
+    # Dictionary column is saved as '<column>' with int32 codes and '<column>.dictionary' with distinct values
+    arrays = {}
+    for column, kind in export_columns.items():
+        match kind:
+            case 'dictionary':
+                dictionary, codes = np.unique(np.array(data[column], dtype='str'), return_inverse=True)
+                arrays[column] = codes.astype('int32')
+                arrays[f"{column}.dictionary"] = dictionary
+            case 'timestamp':
+                arrays[column] = np.array(data[column], dtype='datetime64[us]')
+            case 'int':
+                arrays[column] = np.array(data[column], dtype='int64')
+            case 'float':
+                arrays[column] = np.array(data[column], dtype='float64')
+    np.savez(file, **arrays)
+
+
+def read_npz(file: str) -> dict:
+    """
+    Reads '.npz' partition with decoded dictionary columns.
+    :return: dict {column: NumPy array}
+    """
+    with np.load(file) as npz:
+        return {
+            column: npz[f"{column}.dictionary"][npz[column]] if kind == 'dictionary' else npz[column]
+            for column, kind in export_columns.items()
+        }
+
+
+def load_state(path: str) -> dict:
+    state_path = os.path.join(path, EXPORT_STATE_FILE)
+    if not os.path.isfile(state_path):
+        return {'last_etl_meta_info_id': 0, 'format': None}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: dict):
+    tmp_path = os.path.join(path, f"{EXPORT_STATE_FILE}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(path, EXPORT_STATE_FILE))
+
+
+def export_orders(connection: psycopg2._psycopg.connection, path: str = EXPORT_DIR, fmt: str = EXPORT_FORMAT,
+                  full=False) -> dict:
+    """
+    Exports denormalized 'Orders' facts to columnar files partitioned by order year and month.
+    Export is incremental: only partitions (months) with facts of ETL runs finished after the last export
+    ('sys_etl_meta_info_id') are rewritten, and months left by facts moved to other month by these runs
+    ('etl_moved_fact_month').
+    Every partition file is replaced atomically, export state is saved after all partitions, so interrupted
+    export is repeated by next one.
+    :param fmt: 'parquet' (pyarrow) or 'npz' (NumPy), changing format makes full export
+    :param full: rewrite all partitions
+    :return: dict with last exported ETL run id and exported partitions {partition dir: rows}
+    """
+    if fmt == 'parquet' and pa is None:
+        raise ValueError("'pyarrow' package is required for Parquet export, use 'npz' format")
+    if fmt not in ('parquet', 'npz'):
+        raise ValueError(f"export format '{fmt}' is not supported")
+    state = load_state(path)
+    if full or state['format'] != fmt:
+        for partition in glob.glob(os.path.join(path, 'year=*')):
+            shutil.rmtree(partition)
+        state = {'last_etl_meta_info_id': 0, 'format': fmt}
+
+    with connection:
+        with connection.cursor() as cur:
+            max_etl_meta_info_id = finished_etl_meta_info_id(cur)
+            if max_etl_meta_info_id <= state['last_etl_meta_info_id']:
+                return {'last_etl_meta_info_id': state['last_etl_meta_info_id'], 'partitions': {}}
+            etl_runs = (state['last_etl_meta_info_id'], max_etl_meta_info_id)
+            cur.execute("""
+                SELECT DISTINCT date_trunc('month', order_ts)
+                FROM sales_info
+                WHERE sys_etl_meta_info_id > %s AND sys_etl_meta_info_id <= %s
+            """, etl_runs)
+            months = set([row[0] for row in cur.fetchall()])
+            # Table is missing in databases created before it until ETL or db_structure.py is run
+            cur.execute("SELECT to_regclass('etl_moved_fact_month') IS NOT NULL")
+            if cur.fetchone()[0]:
+                cur.execute("""
+                    SELECT DISTINCT month
+                    FROM etl_moved_fact_month
+                    WHERE sys_etl_meta_info_id > %s AND sys_etl_meta_info_id <= %s
+                """, etl_runs)
+                months.update([row[0] for row in cur.fetchall()])
+            months = sorted(months)
+
+    partitions = {}
+    for month in months:
+        # Every month is read in its own transaction, so long export doesn't hold one snapshot
+        with connection:
+            with connection.cursor() as cur:
+                data = select_month(cur, month)
+        directory = partition_dir(path, month)
+        os.makedirs(directory, exist_ok=True)
+        file = os.path.join(directory, f"orders.{fmt}")
+        tmp_file = os.path.join(directory, f"orders.tmp.{fmt}")
+        if fmt == 'parquet':
+            write_parquet(tmp_file, data)
+        else:
+            write_npz(tmp_file, data)
+        os.replace(tmp_file, file)
+        partitions[os.path.relpath(directory, path)] = len(data["Order"])
+
+    state['last_etl_meta_info_id'] = max_etl_meta_info_id
+    os.makedirs(path, exist_ok=True)
+    save_state(path, state)
+    return {'last_etl_meta_info_id': max_etl_meta_info_id, 'partitions': partitions}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Exports 'Orders' to columnar files partitioned by month.")
+    parser.add_argument("--path", default=EXPORT_DIR, help="export directory")
+    parser.add_argument("--format", default=EXPORT_FORMAT, choices=("parquet", "npz"))
+    parser.add_argument("--full", action="store_true", help="rewrite all partitions")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        host=env.get("ODS_POSTGRES_HOST"),
+        port=env.get("ODS_POSTGRES_PORT"),
+        database=env.get("ODS_POSTGRES_DB"),
+        user=env.get("ODS_POSTGRES_USER"),
+        password=env.get("ODS_POSTGRES_PASS")
+    )
+    try:
+        result = export_orders(connection, args.path, args.format, args.full)
+    finally:
+        connection.close()
+    for partition, rows in result['partitions'].items():
+        print(f"{partition}: {rows} rows")
+    print(f"Orders exported up to ETL run {result['last_etl_meta_info_id']}, "
+          f"{len(result['partitions'])} partitions rewritten.")
@@ -0,0 +1,286 @@
+import pickle
+from datetime import datetime
+from collections import OrderedDict
+from dotenv import dotenv_values
+import psycopg2
+from ddl_func import partition_bounds
+from ods.db_structure import rollups
+
+env = dotenv_values()
+
+# ETL run, which is in state 'processing' longer than this (seconds), is considered as crashed
+ETL_RUN_TIMEOUT = int(env.get("ODS_ETL_RUN_TIMEOUT") or 6 * 3600)
+
+# Dimensions of 'Orders' star schema. '{t}' is alias of fact table ('si') or rollup table ('r').
+#   - expression: SQL expression of dimension over fact table
+#   - join: join of dimension table needed by expression
+#   - rollup_key: rollup column needed to get dimension from rollup table
+#   - rollup_expression: SQL expression of dimension over rollup table
+olap_dimensions = {
+    "Order": {
+        "expression": "so.order_id",
+        "join": "JOIN sales_order so ON {t}.order_id = so.id"
+    },
+    "Product": {
+        "expression": "sp.name",
+        "join": "JOIN sales_product sp ON {t}.product_id = sp.id",
+        "rollup_key": "product_id",
+        "rollup_expression": "sp.name"
+    },
+    "Purchase Address": {
+        "expression": "spa.address",
+        "join": "JOIN sales_purchase_address spa ON {t}.purchase_address_id = spa.id",
+        "rollup_key": "purchase_address_id",
+        "rollup_expression": "spa.address"
+    },
+    "Order Full Date": {
+        "expression": "si.order_ts"
+    },
+    "Order Year": {
+        "expression": "date_part('year', si.order_ts)::INT",
+        "rollup_key": "year",
+        "rollup_expression": "r.year"
+    },
+    "Order Month": {
+        "expression": "date_part('month', si.order_ts)::INT",
+        "rollup_key": "month",
+        "rollup_expression": "r.month"
+    },
+    "Order Day": {
+        "expression": "date_part('day', si.order_ts)::INT",
+        "rollup_key": "day",
+        "rollup_expression": "r.day"
+    }
+}
+
+# Measures: aggregate over fact table and (for additive measures) over rollup table.
+# Both expressions give the same type and 0 for empty selection, so result doesn't depend on chosen table
+# (sum of BIGINT is NUMERIC).
+olap_measures = {
+    "Product Quantity": {
+        "expression": "coalesce(sum(si.quantity), 0)::BIGINT",
+        "rollup_expression": "coalesce(sum(r.quantity), 0)::BIGINT"
+    },
+    "Order Full Price": {
+        "expression": "coalesce(sum(si.total_price), 0)",
+        "rollup_expression": "coalesce(sum(r.revenue), 0)"
+    },
+    "Order Lines": {"expression": "count(*)", "rollup_expression": "coalesce(sum(r.order_lines), 0)::BIGINT"},
+    "Product Price": {"expression": "avg(si.price_per_each)"}
+}
+
+filter_operators = ('=', '!=', '<', '<=', '>', '>=', 'in', 'between')
+
+
+class OlapQueryError(Exception):
+    pass
+
+
+def choose_rollup(dimensions: set, measures: list, rollup_rows: dict = None):
+    """
+    Returns smallest rollup table which has all dimensions and measures of query or None.
+    Count of dimensions doesn't tell size of rollup (e.g. almost every purchase address is unique),
+    so rollups are compared by rows: 'rollup_rows' (see 'rollup_table_rows') or 'rows_estimate' of rollup definition.
+    :param rollup_rows: dict {rollup table: count of rows}
+    """
+    if any('rollup_expression' not in olap_measures[measure] for measure in measures):
+        return None
+    rollup_rows = rollup_rows or {}
+    candidates = [
+        rollup_table for rollup_table, rollup in rollups.items()
+        if all(olap_dimensions[dim].get('rollup_key') in rollup['dimensions'] for dim in dimensions)
+    ]
+    return min(
+        candidates,
+        key=lambda rollup_table: rollup_rows.get(rollup_table, rollups[rollup_table]['rows_estimate']),
+        default=None
+    )
+
+
+def rollup_table_rows(cur) -> dict:
+    """
+    Counts of rows of rollup tables estimated by planner statistics (no scan). Tables never analyzed are skipped.
+    :return: dict {rollup table: count of rows}
+    """
+    cur.execute("""
+        SELECT relname, reltuples
+        FROM pg_class
+        WHERE oid IN (SELECT to_regclass(name) FROM unnest(%s::TEXT[]) name) AND reltuples >= 0
+    """, (list(rollups),))
+    return {name: rows for name, rows in cur.fetchall()}
+
+
+def compile_query(dimensions: list, measures: list, filters: list = None, rollup_rows: dict = None) -> tuple:
+    """
+    Compiles OLAP query to SQL. Query is answered by rollup table if possible, otherwise by fact table.
+    Filters of fact query by year (and month) are added as range of 'order_ts' too, for partition pruning.
+    :param dimensions: dimension names to group by, see 'olap_dimensions'
+    :param measures: measure names, see 'olap_measures'
+    :param filters: list of tuples (dimension, operator, value), see 'filter_operators'.
+    Value of 'in' is a list, value of 'between' is a tuple (from, to).
+    :param rollup_rows: counts of rows of rollup tables for choosing rollup, see 'choose_rollup'
+    :return: tuple (sql, params)
+
+    Example
+        in:
+            - dimensions=["Product"]
+            - measures=["Order Full Price"]
+            - filters=[("Order Year", "=", 2019)]
+        out:
+            ("SELECT sp.name, coalesce(sum(r.revenue), 0) FROM rollup_product_day r
+              JOIN sales_product sp ON r.product_id = sp.id WHERE r.year = %s GROUP BY 1 ORDER BY 1", [2019])
+    """
+    filters = filters or []
+    for dim in list(dimensions) + [item[0] for item in filters]:
+        if dim not in olap_dimensions:
+            raise OlapQueryError(f"Unknown dimension '{dim}'")
+    for measure in measures:
+        if measure not in olap_measures:
+            raise OlapQueryError(f"Unknown measure '{measure}'")
+    for _, operator, _ in filters:
+        if operator not in filter_operators:
+            raise OlapQueryError(f"Unknown filter operator '{operator}'")
+
+    used_dimensions = set(dimensions) | {item[0] for item in filters}
+    rollup_table = choose_rollup(used_dimensions, measures, rollup_rows)
+    alias = 'r' if rollup_table else 'si'
+    expression_key = 'rollup_expression' if rollup_table else 'expression'
+
+    def dim_expression(dim):
+        return olap_dimensions[dim][expression_key].format(t=alias)
+
+    joins = []
+    for dim in olap_dimensions:
+        if dim in used_dimensions and olap_dimensions[dim].get('join'):
+            joins.append(olap_dimensions[dim]['join'].format(t=alias))
+
+    conditions = []
+    params = []
+    for dim, operator, value in filters:
+        match operator:
+            case 'in':
+                conditions.append(f"{dim_expression(dim)} = ANY(%s)")
+                params.append(list(value))
+            case 'between':
+                conditions.append(f"{dim_expression(dim)} BETWEEN %s AND %s")
+                params.extend(value)
+            case _:
+                conditions.append(f"{dim_expression(dim)} {operator} %s")
+                params.append(value)
+    if not rollup_table:
+        conditions, params = add_partition_pruning(filters, conditions, params)
+
+    select = [dim_expression(dim) for dim in dimensions] + \
+             [olap_measures[measure][expression_key] for measure in measures]
+    sql = f"SELECT {', '.join(select)} \nFROM {rollup_table or 'sales_info'} {alias}"
+    if joins:
+        sql += " \n" + " \n".join(joins)
+    if conditions:
+        sql += f" \nWHERE {' AND '.join(conditions)}"
+    if dimensions:
+        group_by = ', '.join([str(i) for i in range(1, len(dimensions) + 1)])
+        sql += f" \nGROUP BY {group_by} \nORDER BY {group_by}"
+    return sql, params
+
+
+def add_partition_pruning(filters: list, conditions: list, params: list) -> tuple:
+    # Equality filters by year (and month) are duplicated as 'order_ts' range, so planner can prune partitions
+    equal = {dim: value for dim, operator, value in filters if operator == '='}
+    if "Order Year" not in equal:
+        return conditions, params
+    year = int(equal["Order Year"])
+    if "Order Month" in equal:
+        start, end = partition_bounds(datetime(year, int(equal["Order Month"]), 1), 'month')
+    else:
+        start, end = partition_bounds(datetime(year, 1, 1), 'year')
+    return conditions + ["si.order_ts >= %s AND si.order_ts < %s"], params + [start, end]
+
+
+class QueryResultCache:
+    """
+    LRU cache of OLAP query results, limited by count of entries and by size of results (pickled bytes).
+    Entries are keyed by SQL, params and ETL version, so new ETL run makes old entries unreachable
+    and they are evicted as least recently used.
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, result):
+        size = len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (result, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+def etl_version(cur) -> int:
+    """
+    Returns id of latest ETL run, which could change data: run with loaded source rows (its id is written
+    in watermark table together with facts) or run finished with error (its first phases could be committed).
+    ETL runs without new data don't change version.
+    """
+    cur.execute("""
+        SELECT max(id) FROM etl_meta_info
+        WHERE state = 'error' OR id IN (SELECT sys_etl_meta_info_id FROM etl_watermark)
+    """)
+    return cur.fetchone()[0] or 0
+
+
+def finished_etl_meta_info_id(cur, run_timeout: int = ETL_RUN_TIMEOUT) -> int:
+    """
+    Id of the last ETL run, which facts are complete: runs in progress and runs after them are excluded.
+    Run in state 'processing' longer than 'run_timeout' seconds is considered as crashed and doesn't hold back
+    later runs (its committed facts are complete as well, the rest is loaded by next runs).
+    """
+    cur.execute("""
+        SELECT coalesce(
+            (SELECT min(id) - 1 FROM etl_meta_info
+             WHERE state = 'processing' AND start_date > LOCALTIMESTAMP - make_interval(secs => %s)),
+            (SELECT max(id) FROM etl_meta_info),
+            0
+        )
+    """, (run_timeout,))
+    return cur.fetchone()[0]
+
+
+def run_query(
+        connection: psycopg2._psycopg.connection,
+        dimensions: list, measures: list, filters: list = None,
+        cache: QueryResultCache = None) -> tuple:
+    """
+    Runs OLAP query over 'Orders' star schema, see 'compile_query'.
+    :param cache: result cache, without it query is always executed
+    :return: tuple (column names, rows)
+    """
+    with connection:
+        with connection.cursor() as cur:
+            sql, params = compile_query(dimensions, measures, filters, rollup_table_rows(cur))
+            key = None
+            if cache is not None:
+                key = (sql, repr(params), etl_version(cur))
+                result = cache.get(key)
+                if result is not None:
+                    return result
+            cur.execute(sql, params)
+            result = (list(dimensions) + list(measures), cur.fetchall())
+    if cache is not None:
+        cache.put(key, result)
+    return result
@@ -0,0 +1,60 @@
+# SQL generators for aggregate rollup tables of 'sales_info'. Rollups are defined in ods/db_structure.py ('rollups'):
+#   - dimensions: {rollup column: expression over fact table 'si'}, they are primary key of rollup table
+#   - measures: {rollup column: additive aggregate over fact table 'si'}
+#   - count_measure: measure with count of facts, rollup rows with zero count are deleted
+
+
+def rollup_select_sql(rollup: dict, where: str = None, sign=1) -> str:
+    """
+    Generates query aggregating facts by rollup dimensions.
+    :param rollup: rollup definition
+    :param where: condition for facts (alias 'si')
+    :param sign: 1 to add aggregates, -1 to subtract them
+    :return: sql
+    """
+    dimensions = rollup['dimensions']
+    measures = rollup['measures']
+    columns = ", \n".join(
+        [f"{expression} AS {column}" for column, expression in dimensions.items()] +
+        [f"{sign} * {expression} AS {column}" for column, expression in measures.items()]
+    )
+    return f"""
+        SELECT {columns}
+        FROM sales_info si
+        {f'WHERE {where}' if where else ''}
+        GROUP BY {', '.join(dimensions.values())}
+    """
+
+
+def apply_rollup_delta_sql(rollup_table: str, rollup: dict, where: str, sign=1) -> str:
+    """
+    Generates statement adding (or subtracting) aggregates of facts to rollup table.
+    :param rollup_table: rollup table name
+    :param rollup: rollup definition
+    :param where: condition for facts (alias 'si'), which aggregates make delta
+    :param sign: 1 for facts appeared (or new values of facts), -1 for facts disappeared (or old values of facts)
+    :return: sql
+    """
+    dimensions = list(rollup['dimensions'])
+    measures = list(rollup['measures'])
+    updates = ", \n".join([f"{measure} = {rollup_table}.{measure} + EXCLUDED.{measure}" for measure in measures])
+    return f"""
+        INSERT INTO {rollup_table} ({', '.join(dimensions + measures)})
+        {rollup_select_sql(rollup, where, sign)}
+        ON CONFLICT ({', '.join(dimensions)}) DO UPDATE SET
+        {updates}
+    """
+
+
+def delete_empty_rollup_rows_sql(rollup_table: str, rollup: dict) -> str:
+    return f"DELETE FROM {rollup_table} WHERE {rollup['count_measure']} = 0"
+
+
+def build_rollup_sql(rollup_table: str, rollup: dict) -> str:
+    # Full build of rollup table, it's executed only for empty rollup table
+    dimensions = list(rollup['dimensions'])
+    measures = list(rollup['measures'])
+    return f"""
+        INSERT INTO {rollup_table} ({', '.join(dimensions + measures)})
+        {rollup_select_sql(rollup, f"NOT EXISTS (SELECT 1 FROM {rollup_table})")}
+    """
@@ -0,0 +1,95 @@
+from datetime import datetime
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Max count of distinct values remembered by memoized converters of one column
+MEMO_CACHE_SIZE = 65536
+
+
+def parse_timestamp_mdy_hm(val: str) -> datetime:
+    """
+    Parses timestamp in fixed format '%m/%d/%y %H:%M' (example: '04/19/19 08:46').
+    Value is rearranged to ISO format and parsed by datetime.fromisoformat, which is several times faster than
+    datetime.strptime. strptime is used only for values of other shape.
+    """
+    if len(val) == 14 and val[2] == '/' and val[5] == '/' and val[8] == ' ' and val[11] == ':':
+        # Same century pivot as strptime '%y': 69-99 -> 19xx, 00-68 -> 20xx
+        century = '20' if val[6:8] < '69' else '19'
+        return datetime.fromisoformat(f"{century}{val[6:8]}-{val[0:2]}-{val[3:5]} {val[9:14]}")
+    return datetime.strptime(val, '%m/%d/%y %H:%M')
+
+
+def compile_line_converter(converters: tuple, memo_columns=(), cache_size=MEMO_CACHE_SIZE):
+    """
+    Builds function converting CSV line (list of strings) to list of typed values.
+    Should be built once per file. Indexes of typed columns are found once, so 'str' columns are taken as is
+    (csv.reader yields strings) without a call per value. Converters of 'memo_columns' get own bounded cache
+    of converted values, which pays off for heavily repeated values that are expensive to parse (timestamps).
+    Memoizing of 'str' columns is skipped, hashing would cost more than taking value.
+    :param converters: tuple of functions, one per column
+    :param memo_columns: indexes of columns to memoize
+    :param cache_size: max count of remembered values per memoized column
+    :return: function(line) -> list
+
+    Example
+        convert = compile_line_converter((int, str), memo_columns=(0,))
+        convert(['1', 'iPhone']) -> [1, 'iPhone']
+    """
+    converters = tuple(
+        lru_cache(maxsize=cache_size)(conv) if i in memo_columns and conv is not str else conv
+        for i, conv in enumerate(converters)
+    )
+    count = len(converters)
+    typed_columns = tuple((i, conv) for i, conv in enumerate(converters) if conv is not str)
+
+    def convert(line) -> list:
+        # Extra values of line are ignored
+        values = line[:count]
+        for i, conv in typed_columns:
+            values[i] = conv(values[i])
+        return values
+
+    convert.converters = converters
+    return convert
+
+
+def numpy_column(values: tuple, dtype: str, conv) -> list:
+    """
+    Converts column of strings by one vectorized NumPy cast. NumPy parses numbers as int() and float() do,
+    column with value it can't cast (e.g. too big int) is converted by 'conv', which gives its usual result or error.
+    """
+    try:
+        return np.array(values).astype(dtype).tolist()
+    except (ValueError, OverflowError):
+        return list(map(conv, values))
+
+
+def compile_batch_converter(line_converter, numpy_dtypes: dict = None):
+    """
+    Builds function converting batch of CSV lines at once, column by column.
+    Columns from 'numpy_dtypes' are converted by NumPy vectorized casts (if NumPy is installed),
+    other columns by converters of 'line_converter' (see compile_line_converter).
+    :param line_converter: function built by compile_line_converter
+    :param numpy_dtypes: dict {column index: numpy dtype name}, for example {0: 'int64', 3: 'float64'}
+    :return: function(lines) -> list of lists
+    """
+    converters = line_converter.converters
+    numpy_dtypes = numpy_dtypes if np is not None and numpy_dtypes else {}
+
+    def convert_batch(lines) -> list:
+        if not lines:
+            return []
+        columns = list(zip(*lines))
+        converted = []
+        for i, conv in enumerate(converters):
+            if i in numpy_dtypes:
+                converted.append(numpy_column(columns[i], numpy_dtypes[i], conv))
+            else:
+                converted.append(columns[i] if conv is str else list(map(conv, columns[i])))
+        return [list(row) for row in zip(*converted)]
+
+    return convert_batch
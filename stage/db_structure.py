@@ -1,9 +1,17 @@
+import sys
 from dotenv import dotenv_values
 import psycopg2
-from ddl_func import add_fk_ddl, add_unique_constr_ddl, create_table_ddl
+from ddl_func import add_fk_ddl, foreign_keys_sql, existing_fk_names, add_unique_constr_ddl, create_table_ddl, \
+    add_missing_columns, create_index_ddl, drop_index_ddl, index_name, index_is_valid_sql, set_logged_ddl
+from etl_events import events_table_ddl
+from etl_metrics import metrics_columns_ddl
 
-source_table_name = dotenv_values().get("STAGE_SALES_SOURCE_TABLE")
-meta_data_table_name = dotenv_values().get("STAGE_POSTGRES_DB_META_TABLE")
+env = dotenv_values()
+
+source_table_name = env.get("STAGE_SALES_SOURCE_TABLE")
+meta_data_table_name = env.get("STAGE_POSTGRES_DB_META_TABLE")
+rejected_rows_table_name = env.get("STAGE_REJECTED_ROWS_TABLE") or "rejected_rows"
+events_table_name = env.get("STAGE_EVENTS_TABLE") or "etl_event"
 
 table_ddl = {
     f"{source_table_name}": {
@@ -25,8 +33,23 @@ table_ddl = {
             "state": "VARCHAR NOT NULL",
             "source": "TEXT NOT NULL",
             "target_table": "VARCHAR NOT NULL",
-            "log": "TEXT"
-    }
+            "log": "TEXT",
+            "last_committed_line": "BIGINT",
+            # Size of source file and of CSV data in it (they are different for compressed files)
+            "compressed_bytes": "BIGINT",
+            "uncompressed_bytes": "BIGINT",
+            **metrics_columns_ddl
+    },
+    f"{rejected_rows_table_name}": {
+            "id": "BIGSERIAL PRIMARY KEY",
+            "etl_meta_info_id": "BIGINT NOT NULL",
+            "line_number": "BIGINT NOT NULL",
+            "reason": "VARCHAR NOT NULL",
+            "raw_line": "TEXT",
+            "created_at": "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP"
+    },
+    # Append-only ETL log, it has no foreign key to keep inserts cheap
+    f"{events_table_name}": events_table_ddl
 }
 
 references = {
@@ -36,6 +59,13 @@ references = {
                 "referenced_table": f"{meta_data_table_name}",
                 "referenced_columns": ("id",)
             }
+        ],
+    f"{rejected_rows_table_name}": [
+            {
+                "referencing_columns": ("etl_meta_info_id",),
+                "referenced_table": f"{meta_data_table_name}",
+                "referenced_columns": ("id",)
+            }
         ]
 }
 
@@ -47,23 +77,59 @@ unique_constr = {
     #     ],
     # )
 }
+indexes = {
+    f"{source_table_name}": [
+            # Incremental filters of ODS ETL. Timestamps grow with loading order, so BRIN is tiny and enough
+            {"columns": ("created_at",), "method": "brin"},
+            {"columns": ("updated_at",), "method": "brin"}
+        ],
+    f"{meta_data_table_name}": [
+            # Looking for checkpoints of unfinished streaming ETL
+            {"columns": ("source",), "include": ("last_committed_line",), "where": "state <> 'finished'"}
+        ],
+    f"{rejected_rows_table_name}": [
+            {"columns": ("etl_meta_info_id", "line_number")}
+        ],
+    f"{events_table_name}": [
+            {"columns": ("etl_meta_info_id",)}
+        ]
+}
+
 if __name__ == '__main__':
+    # Run with '--concurrently' to build indexes on working database without locking writes
+    concurrently = '--concurrently' in sys.argv
+    # Run with '--unlogged' to make source table unlogged: loading doesn't write WAL, but table is truncated after
+    # crash (it can be reloaded from 'source_data/processed') and it's not replicated
+    unlogged = '--unlogged' in sys.argv
     try:
         connection = psycopg2.connect(
-            host=dotenv_values().get("STAGE_POSTGRES_HOST"),
-            port=dotenv_values().get("STAGE_POSTGRES_PORT"),
-            database=dotenv_values().get("STAGE_POSTGRES_DB"),
-            user=dotenv_values().get("STAGE_POSTGRES_USER"),
-            password=dotenv_values().get("STAGE_POSTGRES_PASS")
+            host=env.get("STAGE_POSTGRES_HOST"),
+            port=env.get("STAGE_POSTGRES_PORT"),
+            database=env.get("STAGE_POSTGRES_DB"),
+            user=env.get("STAGE_POSTGRES_USER"),
+            password=env.get("STAGE_POSTGRES_PASS")
         )
 
         with connection:
             with connection.cursor() as cur:
                 for table in table_ddl:
                     cur.execute(create_table_ddl(table, table_ddl[table]))
+                    # Columns added to definition after table was created (checkpoints, source sizes, metrics)
+                    added_columns = add_missing_columns(cur, table, table_ddl[table])
+                    if added_columns:
+                        print(f"Columns {', '.join(added_columns)} were added to table '{table}'.")
                     print(f"Table '{table}' is ready to use in PostgreSQL.")
+                if unlogged:
+                    cur.execute(set_logged_ddl(source_table_name, is_logged=False))
+                    print(f"Table '{source_table_name}' is unlogged.")
                 for referencing_table in references:
-                    cur.execute(add_fk_ddl(referencing_table, references[referencing_table]))
+                    # Only missing foreign keys are added, unnamed constraint added again would be a duplicate
+                    cur.execute(foreign_keys_sql(referencing_table))
+                    foreign_keys = cur.fetchall()
+                    missing_refs = [ref for ref in references[referencing_table]
+                                    if not existing_fk_names(foreign_keys, ref)]
+                    if missing_refs:
+                        cur.execute(add_fk_ddl(referencing_table, missing_refs))
                     referenced_tables = ', '.join([ref['referenced_table'] for ref in references[referencing_table]])
                     print(f"Table '{referencing_table}' was referenced to tables: {referenced_tables}")
                 for table in unique_constr:
@@ -72,6 +138,25 @@ if __name__ == '__main__':
                         [f"\t({', '.join(col_list)})" for col_list in unique_constr[table]]
                     )
                     print(f"Table '{table}' now has next unique consts:\n {uniq_cols}")
+        # CREATE INDEX CONCURRENTLY can't be executed inside a transaction block
+        connection.autocommit = concurrently
+        with connection:
+            with connection.cursor() as cur:
+                for table in indexes:
+                    for index in indexes[table]:
+                        name = index_name(table, index)
+                        cur.execute(index_is_valid_sql(name))
+                        state = cur.fetchone()
+                        if state is not None and not state[0]:
+                            # Failed CREATE INDEX CONCURRENTLY leaves invalid index, IF NOT EXISTS would keep it
+                            cur.execute(drop_index_ddl(table, index, concurrently))
+                            print(f"Invalid index '{name}' on table '{table}' was dropped to be built again.")
+                        cur.execute(create_index_ddl(table, index, concurrently))
+                        cur.execute(index_is_valid_sql(name))
+                        if not cur.fetchone()[0]:
+                            print(f"Index '{name}' on table '{table}' is INVALID, run the script again.")
+                            continue
+                        print(f"Index '{name}' on table '{table}' is ready to use.")
 
     except (Exception, psycopg2.Error) as error:
         print("Error while creating tables: ", error)
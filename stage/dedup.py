@@ -0,0 +1,75 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+
+
+class LineDeduplicator:
+    """
+    Streaming detector of duplicate CSV lines within one ETL.
+    Every line is reduced to a 128-bit fingerprint, so a check costs O(1) instead of a scan over all previous lines.
+    Memory is bounded: when more than 'max_memory_fingerprints' fingerprints are collected, they are spilled to a
+    temporary on-disk index (sqlite, primary key lookup), and collecting starts again in memory.
+
+    Example
+        with LineDeduplicator(max_memory_fingerprints=1000000) as dedup:
+            for values in lines:
+                if dedup.is_duplicate(values):
+                    ...  # line was already seen
+    """
+
+    def __init__(self, max_memory_fingerprints: int = 1000000, spill_dir: str = None):
+        self.max_memory_fingerprints = max_memory_fingerprints
+        self.spill_dir = spill_dir
+        self._fingerprints = set()
+        self._spill_path = None
+        self._spill = None
+
+    @staticmethod
+    def fingerprint(values) -> bytes:
+        line = '\x1f'.join([str(val) for val in values])
+        return hashlib.blake2b(line.encode(), digest_size=16).digest()
+
+    def is_duplicate(self, values) -> bool:
+        """
+        Checks if line with such values was already seen and remembers it otherwise.
+        :param values: sequence of line values (raw or already typed)
+        :return: True if line is duplicate
+        """
+        fp = self.fingerprint(values)
+        if fp in self._fingerprints:
+            return True
+        if self._spill is not None and \
+                self._spill.execute("SELECT 1 FROM fp WHERE fp = ?", (fp,)).fetchone() is not None:
+            return True
+        self._fingerprints.add(fp)
+        if len(self._fingerprints) >= self.max_memory_fingerprints:
+            self._spill_to_disk()
+        return False
+
+    def _spill_to_disk(self):
+        if self._spill is None:
+            fd, self._spill_path = tempfile.mkstemp(prefix='dedup_', suffix='.sqlite', dir=self.spill_dir)
+            os.close(fd)
+            self._spill = sqlite3.connect(self._spill_path)
+            self._spill.execute("PRAGMA journal_mode = OFF")
+            self._spill.execute("PRAGMA synchronous = OFF")
+            self._spill.execute("CREATE TABLE fp (fp BLOB PRIMARY KEY) WITHOUT ROWID")
+        with self._spill:
+            self._spill.executemany("INSERT OR IGNORE INTO fp VALUES (?)", ((fp,) for fp in self._fingerprints))
+        self._fingerprints.clear()
+
+    def close(self):
+        self._fingerprints.clear()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self._spill_path is not None:
+            os.remove(self._spill_path)
+            self._spill_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
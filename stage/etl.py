@@ -3,16 +3,69 @@ import psycopg2
 from os import listdir, rename as file_rename
 from os.path import isfile, join
 import os
+import sys
 import csv
-from psycopg2.extras import execute_values
+import io
+import time
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+from tempfile import SpooledTemporaryFile
+from psycopg2.extras import execute_values, Json
+from stage.dedup import LineDeduplicator
+from stage.sources import open_csv_source
+from stage.converters import compile_line_converter, compile_batch_converter, parse_timestamp_mdy_hm
+from stage.db_structure import table_ddl, references, unique_constr, indexes
+from etl_events import EtlEventLog
+from etl_metrics import EtlProfiler, export_run_metrics
+from etl_bulk import bulk_load
+from ddl_func import column_sql_type, loading_columns, column_parsers, sql_type_numpy_dtypes, bulk_load_ddl, \
+    foreign_keys_sql
+
+# .env is parsed once, not for every setting
+env = dotenv_values()
 
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 CSV_FILES_PATH_NEW = 'source_data/new'
 CSV_FILES_PATH_PROCESSED = 'source_data/processed'
 CSV_FILES_PATH_ERROR = 'source_data/error'
+# How many line fingerprints are kept in memory before spilling them to disk
+DEDUP_MAX_MEMORY_LINES = 1000000
+# How rows are loaded into target table: 'values' (INSERT ... VALUES via execute_values) or 'copy' (COPY FROM STDIN)
+LOAD_MODE = env.get("STAGE_LOAD_MODE") or 'values'
+# Size of in-memory buffer for COPY, bigger data is spooled to temp file
+COPY_BUFFER_MAX_SIZE = 64 * 1024 * 1024
+# How many rejected CSV lines are collected before they are written to rejected rows table in one statement
+REJECTED_ROWS_BATCH_SIZE = 10000
+# How many files are processed in parallel (each worker process has its own connection), 1 - sequential ETL
+WORKERS = int(env.get("STAGE_WORKERS") or 1)
+# Streaming mode: CSV is parsed by chunks of this size, every chunk is committed with a checkpoint.
+# 0 - whole file is parsed and then inserted in one transaction
+CHUNK_SIZE = int(env.get("STAGE_CHUNK_SIZE") or 0)
+# How many parsed chunks may wait for the background writer
+CHUNK_QUEUE_SIZE = 4
+# Columnar mode: CSV lines are converted by batches of this size (NumPy is used if installed), 0 - line by line
+CONVERT_BATCH_SIZE = int(env.get("STAGE_CONVERT_BATCH_SIZE") or 0)
+# Directory of Prometheus node_exporter textfile collector, metrics of the last run are written there if it's set
+METRICS_TEXTFILE_DIR = env.get("METRICS_TEXTFILE_DIR")
+# Detailed profiling: CSV reading, validation and dedup are timed line by line (it slows parsing down noticeably),
+# otherwise they are measured together as 'parse' phase
+PROFILE_DETAIL = env.get("STAGE_PROFILE_DETAIL") == '1'
 
-target_table = dotenv_values().get("STAGE_SALES_SOURCE_TABLE")
-meta_table = dotenv_values().get("STAGE_POSTGRES_DB_META_TABLE")
+target_table = env.get("STAGE_SALES_SOURCE_TABLE")
+meta_table = env.get("STAGE_POSTGRES_DB_META_TABLE")
+rejected_table = env.get("STAGE_REJECTED_ROWS_TABLE") or "rejected_rows"
+events_table = env.get("STAGE_EVENTS_TABLE") or "etl_event"
+# Columns to insert, their parsers and order are derived from target table definition in db_structure.py.
+# CSV lines contain values of all insert columns except 'etl_meta_info_id', in the same order.
+target_table_ddl = table_ddl[target_table]
+insert_columns = loading_columns(target_table_ddl)
+csv_columns = tuple(column for column in insert_columns if column != "etl_meta_info_id")
+csv_column_types = tuple(column_sql_type(target_table_ddl[column]) for column in csv_columns)
+# Escaping of special chars for COPY text format
+copy_escape_table = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
 
 
 class ValidationDataError(Exception):
@@ -31,40 +84,108 @@ class InsertDataError(Exception):
     pass
 
 
+class InsertRejectedRowsError(Exception):
+    pass
+
+
+def sales_line_converter():
+    # Converter of sales CSV line, order timestamps repeat at minute granularity and are memoized
+    return compile_line_converter(
+        column_parsers(target_table_ddl, csv_columns, {"TIMESTAMP": parse_timestamp_mdy_hm}),
+        memo_columns=[i for i, column_type in enumerate(csv_column_types) if column_type == "TIMESTAMP"]
+    )
+
+
+def sales_batch_converter(line_converter):
+    return compile_batch_converter(
+        line_converter,
+        numpy_dtypes={i: sql_type_numpy_dtypes[column_type] for i, column_type in enumerate(csv_column_types)
+                      if column_type in sql_type_numpy_dtypes}
+    )
+
+
 def prepare_csv_line_to_insert(inserting_line):
-    from datetime import datetime
-    val_count = 6
-    types = {
-        0: lambda val: int(val),
-        1: lambda val: str(val),
-        2: lambda val: int(val),
-        3: lambda val: float(val),
-        4: lambda val: datetime.strptime(val, '%m/%d/%y %H:%M'),
-        5: lambda val: str(val),
-    }
+    return default_line_converter(inserting_line)
+
 
-    return [types[i](inserting_line[i]) for i in range(val_count)]
+default_line_converter = sales_line_converter()
 
 
+def copy_text_line(values) -> str:
+    # datetime, int and float are rendered by str() in formats PostgreSQL accepts, NULL is '\N'
+    return '\t'.join(
+        ['\\N' if val is None else str(val).translate(copy_escape_table) for val in values]
+    ) + '\n'
 
-def insert_data(connection: psycopg2._psycopg.connection, target_table, data):
+
+def copy_data(cur: psycopg2._psycopg.cursor, target_table, data):
+    with SpooledTemporaryFile(max_size=COPY_BUFFER_MAX_SIZE, mode='w+', newline='') as buffer:
+        buffer.writelines(copy_text_line(line) for line in data)
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {target_table} ({', '.join(insert_columns)}) FROM STDIN", buffer)
+
+
+def write_data(cur: psycopg2._psycopg.cursor, target_table, data, mode='values'):
+    match mode:
+        case 'values':
+            execute_values(
+                cur,
+                f"INSERT INTO {target_table} ({', '.join(insert_columns)}) VALUES %s",
+                data
+            )
+        case 'copy':
+            copy_data(cur, target_table, data)
+        case _:
+            raise Exception(f"loading mode '{mode}' is not supported.")
+
+
+def insert_data(connection: psycopg2._psycopg.connection, target_table, data, mode='values'):
     try:
         with connection:
             with connection.cursor() as cur:
-                execute_values(
-                    cur,
-                    f"INSERT INTO {target_table} ("
-                    f"order_id, product, quantity_ordered, price_per_each, "
-                    f"order_date, purchase_address, etl_meta_info_id) "
-                    f"VALUES %s",
-                    data
-                )
+                write_data(cur, target_table, data, mode)
     except psycopg2.Error as error:
         raise InsertDataError(error.diag.message_primary)
     except Exception as error:
         raise InsertDataError(error)
 
 
+def raw_csv_line(line) -> str:
+    # Restores source CSV line from parsed values (with quoting where it's needed)
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=',', lineterminator='').writerow(line)
+    return buffer.getvalue()
+
+
+def write_rejected_rows(cur: psycopg2._psycopg.cursor, rejected_table, rows):
+    # All rows are sent in one statement, so there is one round-trip per batch
+    if not rows:
+        return
+    execute_values(
+        cur,
+        f"INSERT INTO {rejected_table} (etl_meta_info_id, line_number, reason, raw_line) VALUES %s",
+        rows,
+        page_size=len(rows)
+    )
+
+
+def insert_rejected_rows(connection: psycopg2._psycopg.connection, rejected_table, rows):
+    try:
+        with connection:
+            with connection.cursor() as cur:
+                write_rejected_rows(cur, rejected_table, rows)
+    except psycopg2.Error as error:
+        raise InsertRejectedRowsError(f"Error while inserting rejected rows: {error.diag.message_primary}")
+    except Exception as error:
+        raise InsertRejectedRowsError(f"Error while inserting rejected rows: {error}")
+
+
+def rejected_summary(rejected_reasons: Counter, rejected_table: str) -> str:
+    reasons = ', '.join([f"{reason}: {count}" for reason, count in rejected_reasons.most_common()])
+    return f"{sum(rejected_reasons.values())} CSV lines were rejected ({reasons}). " \
+           f"See table {rejected_table} for details."
+
+
 def insert_meta(connection: psycopg2._psycopg.connection, source: str, meta_table: str, target_table: str):
     try:
         with connection:
@@ -80,34 +201,62 @@ def insert_meta(connection: psycopg2._psycopg.connection, source: str, meta_tabl
         raise InsertMetaError(f"Error while inserting metainfo: {error}. ETL was terminated.")
 
 
+def find_checkpoint(connection: psycopg2._psycopg.connection, meta_table: str, source: str):
+    """
+    Looks for unfinished streaming ETL of the source, which has committed chunks.
+    :return: tuple (etl_meta_info_id, last committed CSV line number) or None
+    """
+    try:
+        with connection:
+            with connection.cursor() as cur:
+                cur.execute(f"SELECT id, last_committed_line FROM {meta_table} "
+                            f"WHERE source = '{source}' AND state <> 'finished' AND last_committed_line IS NOT NULL "
+                            f"ORDER BY id DESC LIMIT 1")
+                return cur.fetchone()
+    except psycopg2.Error as error:
+        raise InsertMetaError(f"Error while looking for checkpoint: {error.diag.message_primary}. ETL was terminated.")
+
+
 def updated_meta_info(
         connection: psycopg2._psycopg.connection,
         meta_table: str,
         etl_meta_info_id: int,
-        status=None, appendix_message=None, line_number=None):
-    sql_statement = f"UPDATE {meta_table} SET \n"
+        status=None, appendix_message=None, line_number=None, rows_count=None, duration=None, metrics=None):
+    # Messages are appended to events table by background writer, meta info row is updated only on state change.
+    # 'metrics' are values of metrics columns (see etl_metrics.py), they are saved with final state.
+    state_sql = None
+    match status:
+        case 'success':
+            state_sql = "end_date = now(), state = 'finished'"
+            level, message = 'info', "Loading was finished."
+            if appendix_message:
+                message += f" {appendix_message}"
+        case 'resume':
+            state_sql = "end_date = NULL, state = 'processing'"
+            level, message = 'info', f"Resuming from CSV LINE {line_number + 1}."
+        case 'warning' if line_number is None:
+            level, message = 'warning', appendix_message
+        case 'warning':
+            level, message = 'warning', f"CSV LINE {line_number}: {appendix_message}"
+        case 'error':
+            state_sql = "end_date = now(), state = 'error'"
+            level, message = 'error', appendix_message
+        case _:
+            raise UpdateMetaError(f"Error while updating metainfo: updating status '{status}' cannot be processed.")
+    events.log(etl_meta_info_id, 'load', level, message, rows_count, duration)
+    if status == 'error':
+        events.flush()
+    if state_sql is None:
+        return
+    metrics = {column: Json(val) if isinstance(val, dict) else val for column, val in (metrics or {}).items()}
+    metrics_sql = ''.join([f", {column} = %s" for column in metrics])
     try:
-        # Define cursor for existing connection
         with connection:
             with connection.cursor() as cur:
-                # Get current 'log' value of meta info.
-                cur.execute(f"SELECT log FROM {meta_table} WHERE id = {etl_meta_info_id}")
-                log = cur.fetchone()[0]
-                # Update 'log' depends on status
-                match status:
-                    case 'success':
-                        sql_statement += "end_date = now(), state = 'finished', \n"
-                        log += "\n\nSUCCESS: Loading was finished."
-                    case 'warning':
-                        log += f"\n\nWARNING, CSV LINE {line_number}: {appendix_message}"
-                    case 'error':
-                        sql_statement += "end_date = now(), state = 'error', \n"
-                        log += f"\n\nERROR: {appendix_message}"
-                    case _:
-                        raise Exception(f"updating status '{status}'cannot be processed.")
-                # Appending log and where clause in sql statement for proper etl_meta_info_id
-                sql_statement += f"log = '{log}' \nWHERE id = {etl_meta_info_id};"
-                cur.execute(sql_statement)
+                cur.execute(
+                    f"UPDATE {meta_table} SET {state_sql}{metrics_sql} WHERE id = {etl_meta_info_id}",
+                    list(metrics.values())
+                )
     # Exception handling
     except psycopg2.Error as error:
         raise UpdateMetaError(f"Error while updating metainfo: {error.diag.message_primary}")
@@ -115,69 +264,317 @@ def updated_meta_info(
         raise UpdateMetaError(f"Error while updating metainfo: {error}")
 
 
-if __name__ == '__main__':
+def stage_connect() -> psycopg2._psycopg.connection:
+    return psycopg2.connect(
+        host=env.get("STAGE_POSTGRES_HOST"),
+        port=env.get("STAGE_POSTGRES_PORT"),
+        database=env.get("STAGE_POSTGRES_DB"),
+        user=env.get("STAGE_POSTGRES_USER"),
+        password=env.get("STAGE_POSTGRES_PASS")
+    )
+
+
+# ETL log, events are written by background thread with its own connection
+events = EtlEventLog(stage_connect, events_table)
+
+
+def validate_csv_lines(
+        reader, header_line, dedup: LineDeduplicator, etl_meta_info_id: int, convert=None, batch_size=0):
+    """
+    Validates CSV lines and converts them to rows to insert.
+    If 'batch_size' is set, lines are converted by batches in columnar way, order of yielded lines is kept.
+    Yields tuples (CSV line number, row to insert, None) or (CSV line number, None, rejected row)
+    """
+    convert = convert or sales_line_converter()
+    convert_batch = sales_batch_converter(convert) if batch_size else None
+    # Batch items are [line number, CSV line, validation error or None]
+    batch = []
+    lines_count = 0
+    for line in reader:
+        lines_count += 1
+        error = None
+        if line == header_line:
+            error = ValidationDataError("this line is header line")
+        elif '' in line:
+            error = ValidationDataError("empty values in line")
+        if not batch_size:
+            if error is None:
+                inserting_line = convert(line)
+                if not dedup.is_duplicate(inserting_line):
+                    inserting_line.append(int(etl_meta_info_id))
+                    yield lines_count, tuple(inserting_line), None
+                    continue
+                error = ValidationDataError("duplicate line")
+            yield lines_count, None, (etl_meta_info_id, lines_count, str(error), raw_csv_line(line))
+            continue
+        batch.append([lines_count, line, error])
+        if len(batch) >= batch_size:
+            yield from _validate_batch(batch, convert_batch, dedup, etl_meta_info_id)
+            batch = []
+    yield from _validate_batch(batch, convert_batch, dedup, etl_meta_info_id)
+
+
+def _validate_batch(batch, convert_batch, dedup: LineDeduplicator, etl_meta_info_id: int):
+    if not batch:
+        return
+    converted = iter(convert_batch([item[1] for item in batch if item[2] is None]))
+    for lines_count, line, error in batch:
+        if error is None:
+            inserting_line = next(converted)
+            if not dedup.is_duplicate(inserting_line):
+                inserting_line.append(int(etl_meta_info_id))
+                yield lines_count, tuple(inserting_line), None
+                continue
+            error = ValidationDataError("duplicate line")
+        yield lines_count, None, (etl_meta_info_id, lines_count, str(error), raw_csv_line(line))
+
+
+def load_file(
+        connection: psycopg2._psycopg.connection, lines, etl_meta_info_id: int, rejected_reasons: Counter,
+        profiler: EtlProfiler = None):
+    # Whole file is collected in memory and inserted in one transaction
+    profiler = profiler or EtlProfiler()
+    data_to_insert = []
+    rejected_rows = []
+    for lines_count, row, rejected_row in lines:
+        if row:
+            data_to_insert.append(row)
+            continue
+        rejected_rows.append(rejected_row)
+        rejected_reasons[rejected_row[2]] += 1
+        if len(rejected_rows) >= REJECTED_ROWS_BATCH_SIZE:
+            with profiler.phase('insert_rejected') as stat:
+                insert_rejected_rows(connection, rejected_table, rejected_rows)
+                stat['rows'] = len(rejected_rows)
+            rejected_rows.clear()
+    with profiler.phase('insert_rejected') as stat:
+        insert_rejected_rows(connection, rejected_table, rejected_rows)
+        stat['rows'] = len(rejected_rows)
+    with profiler.phase('insert') as stat:
+        insert_data(connection, target_table, data_to_insert, LOAD_MODE)
+        stat['rows'] = len(data_to_insert)
+    return len(data_to_insert)
+
+
+def chunk_writer(
+        connection: psycopg2._psycopg.connection, chunks: Queue, etl_meta_info_id: int, errors: list,
+        profiler: EtlProfiler):
+    # Background writer: each chunk is committed together with its rejected rows and checkpoint.
+    # After an error chunks are only drained, so parser is never blocked on full queue.
+    while (chunk := chunks.get()) is not None:
+        if errors:
+            continue
+        data, rejected_rows, last_line = chunk
+        try:
+            with connection, profiler.phase('insert') as stat:
+                with connection.cursor() as cur:
+                    write_data(cur, target_table, data, LOAD_MODE)
+                    write_rejected_rows(cur, rejected_table, rejected_rows)
+                    stat['rows'] = len(data)
+                    cur.execute(f"UPDATE {meta_table} SET last_committed_line = {last_line} "
+                                f"WHERE id = {etl_meta_info_id}")
+        except psycopg2.Error as error:
+            errors.append(InsertDataError(error.diag.message_primary))
+        except Exception as error:
+            errors.append(InsertDataError(error))
+
+
+def load_file_chunked(
+        connection: psycopg2._psycopg.connection, lines, etl_meta_info_id: int, rejected_reasons: Counter,
+        resume_line=0, profiler: EtlProfiler = None):
+    # File is parsed by chunks, parsing overlaps with writing of previous chunks in background thread.
+    # Lines up to 'resume_line' were committed by previous run, they are parsed only to fill deduplicator.
+    profiler = profiler or EtlProfiler()
+    chunks = Queue(maxsize=CHUNK_QUEUE_SIZE)
+    writer_errors = []
+    writer = threading.Thread(
+        target=chunk_writer, args=(connection, chunks, etl_meta_info_id, writer_errors, profiler))
+    writer.start()
+    rows_count = 0
+    data, rejected_rows = [], []
     try:
-        # Connection to target db
-        connection = psycopg2.connect(
-            host=dotenv_values().get("STAGE_POSTGRES_HOST"),
-            port=dotenv_values().get("STAGE_POSTGRES_PORT"),
-            database=dotenv_values().get("STAGE_POSTGRES_DB"),
-            user=dotenv_values().get("STAGE_POSTGRES_USER"),
-            password=dotenv_values().get("STAGE_POSTGRES_PASS")
-        )
-        # Looking for new csv files to ETL
-        files = [f for f in listdir(CSV_FILES_PATH_NEW) if isfile(join(CSV_FILES_PATH_NEW, f))]
-        # Starting ETL for each file
-        for file in files:
-            # Create me
-            try:
-                etl_meta_info_id = insert_meta(
-                    connection=connection,
-                    source=f"{CSV_FILES_PATH_NEW}/{file}",
-                    meta_table=meta_table,
-                    target_table=target_table
-                )
-            except InsertMetaError as e:
-                print(f"{e}. Stopping ETL for file {file}")
-                file_rename(f"{CSV_FILES_PATH_NEW}/{file}", f"{CSV_FILES_PATH_ERROR}/{file}")
+        for lines_count, row, rejected_row in lines:
+            if rejected_row:
+                rejected_reasons[rejected_row[2]] += 1
+            if lines_count <= resume_line:
                 continue
+            if row:
+                data.append(row)
+            else:
+                rejected_rows.append(rejected_row)
+            if len(data) + len(rejected_rows) >= CHUNK_SIZE:
+                with profiler.phase('writer_wait'):
+                    chunks.put((data, rejected_rows, lines_count))
+                rows_count += len(data)
+                data, rejected_rows = [], []
+                if writer_errors:
+                    break
+        else:
+            if data or rejected_rows:
+                with profiler.phase('writer_wait'):
+                    chunks.put((data, rejected_rows, lines_count))
+                rows_count += len(data)
+    finally:
+        with profiler.phase('writer_wait'):
+            chunks.put(None)
+            writer.join()
+    if writer_errors:
+        raise writer_errors[0]
+    return rows_count
 
-            try:
-                with open(f"{CSV_FILES_PATH_NEW}/{file}", newline='') as f:
-                    reader = csv.reader(f, delimiter=',')
-                    header_line = next(reader, None)
-                    lines_count = 0
-                    data_to_insert = []
-                    for line in reader:
-                        lines_count += 1
-                        try:
-                            if line == header_line:
-                                raise ValidationDataError("this line is header line")
-                            elif '' in line:
-                                raise ValidationDataError("empty values in line")
-                            inserting_line = prepare_csv_line_to_insert(line)
-                            inserting_line.append(int(etl_meta_info_id))
-                            if inserting_line in data_to_insert:
-                                raise ValidationDataError("duplicate line")
-                            data_to_insert.append(tuple(inserting_line))
-                        except ValidationDataError as error:
-                            updated_meta_info(
-                                connection, meta_table, etl_meta_info_id,
-                                'warning', error, lines_count)
-                    insert_data(connection, target_table, data_to_insert)
-                    updated_meta_info(
-                        connection, meta_table, etl_meta_info_id,
-                        'success')
-                file_rename(f"{CSV_FILES_PATH_NEW}/{file}", f"{CSV_FILES_PATH_PROCESSED}/{file}")
-            except psycopg2.Error as error:
-                print(error.diag.message_primary)
-                updated_meta_info(
-                    connection, meta_table, etl_meta_info_id,
-                    'error', error.pgerror)
-            except Exception as error:
-                print(error)
+
+def source_metrics(metrics: dict, source_stats: dict) -> dict:
+    # Values of metrics columns with sizes of source file
+    return {
+        **metrics,
+        "compressed_bytes": source_stats.get('compressed_bytes'),
+        "uncompressed_bytes": source_stats.get('uncompressed_bytes')
+    }
+
+
+def etl_file(connection: psycopg2._psycopg.connection, file: str) -> int:
+    """
+    Runs ETL for one CSV file from CSV_FILES_PATH_NEW. File may be compressed (gzip, zstd) or be zip archive
+    of CSV files, see 'open_csv_source'.
+    :return: count of rows loaded into target table (0 if file was not loaded)
+    """
+    source = f"{CSV_FILES_PATH_NEW}/{file}"
+    resume_line = 0
+    # Create meta info or continue unfinished streaming ETL of the file
+    try:
+        checkpoint = find_checkpoint(connection, meta_table, source) if CHUNK_SIZE else None
+        if checkpoint:
+            etl_meta_info_id, resume_line = checkpoint
+            updated_meta_info(connection, meta_table, etl_meta_info_id, 'resume', line_number=resume_line)
+        else:
+            etl_meta_info_id = insert_meta(
+                connection=connection,
+                source=source,
+                meta_table=meta_table,
+                target_table=target_table
+            )
+    except (InsertMetaError, UpdateMetaError) as e:
+        if connection.closed:
+            # Connection was lost (e.g. database restart), file is good and stays for next run
+            raise
+        print(f"{e}. Stopping ETL for file {file}")
+        file_rename(f"{CSV_FILES_PATH_NEW}/{file}", f"{CSV_FILES_PATH_ERROR}/{file}")
+        return 0
+
+    # Phases: 'parse' or ('read', 'validate', 'dedup') in detailed mode, 'insert', 'insert_rejected', 'writer_wait',
+    # 'decompress' (background thread) for compressed files
+    profiler = EtlProfiler()
+    # Compressed and uncompressed size of source, they are saved in meta info with metrics
+    source_stats = {}
+    try:
+        with open_csv_source(source, source_stats, profiler) as f, \
+                LineDeduplicator(DEDUP_MAX_MEMORY_LINES) as dedup:
+            reader = csv.reader(f, delimiter=',')
+            if PROFILE_DETAIL:
+                reader = profiler.timed_iter(reader, 'read')
+                dedup.is_duplicate = profiler.timed(dedup.is_duplicate, 'dedup')
+            header_line = next(reader, None)
+            lines = validate_csv_lines(
+                reader, header_line, dedup, etl_meta_info_id, sales_line_converter(), CONVERT_BATCH_SIZE)
+            if PROFILE_DETAIL:
+                lines = profiler.timed_iter(lines, 'validate')
+            rejected_reasons = Counter()
+            load_start = time.perf_counter()
+            if CHUNK_SIZE:
+                rows_count = load_file_chunked(
+                    connection, lines, etl_meta_info_id, rejected_reasons, resume_line, profiler)
+            else:
+                rows_count = load_file(connection, lines, etl_meta_info_id, rejected_reasons, profiler)
+            load_time = time.perf_counter() - load_start
+            if PROFILE_DETAIL:
+                # Reading and dedup are measured inside validation
+                profiler.exclude('validate', 'read', 'dedup')
+            else:
+                # Parsing time is load time except time of this thread spent in inserts and waiting for writer
+                waits = profiler.seconds('writer_wait') if CHUNK_SIZE else \
+                    profiler.seconds('insert') + profiler.seconds('insert_rejected')
+                profiler.add('parse', load_time - waits, rows_count + sum(rejected_reasons.values()))
+            profiler.add('read' if PROFILE_DETAIL else 'parse', 0, bytes_count=source_stats['uncompressed_bytes'])
+            if rejected_reasons:
                 updated_meta_info(
                     connection, meta_table, etl_meta_info_id,
-                    'error', error)
+                    'warning', rejected_summary(rejected_reasons, rejected_table))
+            load_stat = f"{rows_count} rows loaded by '{LOAD_MODE}' in {load_time:.2f} sec " \
+                        f"({rows_count / load_time if load_time else 0:.0f} rows/sec)."
+            print(f"{file}: {load_stat}")
+            updated_meta_info(
+                connection, meta_table, etl_meta_info_id,
+                'success', load_stat, rows_count=rows_count, duration=load_time,
+                metrics=source_metrics(profiler.meta_values(rows_count), source_stats))
+        export_run_metrics(METRICS_TEXTFILE_DIR, 'stage', profiler, rows_count)
+        file_rename(f"{CSV_FILES_PATH_NEW}/{file}", f"{CSV_FILES_PATH_PROCESSED}/{file}")
+        return rows_count
+    except psycopg2.Error as error:
+        print(error.diag.message_primary)
+        updated_meta_info(
+            connection, meta_table, etl_meta_info_id,
+            'error', error.pgerror, metrics=source_metrics(profiler.meta_values(), source_stats))
+    except Exception as error:
+        print(error)
+        updated_meta_info(
+            connection, meta_table, etl_meta_info_id,
+            'error', error, metrics=source_metrics(profiler.meta_values(), source_stats))
+    export_run_metrics(METRICS_TEXTFILE_DIR, 'stage', profiler, success=False)
+    return 0
+
+
+def bulk_tables_ddl(connection: psycopg2._psycopg.connection) -> list:
+    # Bulk mode suspends constraints and indexes of loaded tables, meta info keeps index of checkpoints lookup.
+    # Foreign keys are dropped by their names in database: constraints added without names may be named otherwise
+    tables_ddl = []
+    with connection:
+        with connection.cursor() as cur:
+            for table in (target_table, rejected_table):
+                cur.execute(foreign_keys_sql(table))
+                tables_ddl.append(bulk_load_ddl(table, table_ddl[table], references.get(table, []),
+                                                unique_constr.get(table, ()), indexes.get(table, []),
+                                                foreign_keys=cur.fetchall()))
+    return tables_ddl
+
+
+def etl_file_worker(file: str) -> int:
+    # Entry point for pool workers: each worker process uses its own connection
+    try:
+        connection = stage_connect()
+        try:
+            return etl_file(connection, file)
+        finally:
+            connection.close()
+            # Pool worker processes exit without atexit handlers
+            events.close()
+    except (Exception, psycopg2.Error) as error:
+        print(f"{file}: {error}")
+        return 0
+
+
+if __name__ == '__main__':
+    try:
+        # Looking for new csv files to ETL
+        files = [f for f in listdir(CSV_FILES_PATH_NEW) if isfile(join(CSV_FILES_PATH_NEW, f))]
+        # Run with '--bulk' for initial load or backfill: constraints and indexes are rebuilt after all files
+        is_bulk = '--bulk' in sys.argv and len(files) > 0
+        run_start = time.perf_counter()
+        bulk_connection = stage_connect() if is_bulk else None
+        try:
+            with bulk_load(bulk_connection, bulk_tables_ddl(bulk_connection)) if is_bulk else nullcontext():
+                # Starting ETL for each file
+                if WORKERS > 1 and len(files) > 1:
+                    with ProcessPoolExecutor(max_workers=min(WORKERS, len(files))) as pool:
+                        rows_total = sum(pool.map(etl_file_worker, files))
+                else:
+                    # Connection to target db
+                    connection = stage_connect()
+                    rows_total = sum([etl_file(connection, file) for file in files])
+        finally:
+            if bulk_connection is not None:
+                bulk_connection.close()
+        run_time = time.perf_counter() - run_start
+        print(f"{len(files)} files processed, {rows_total} rows loaded in {run_time:.2f} sec "
+              f"({rows_total / run_time if run_time else 0:.0f} rows/sec).")
     except (Exception, psycopg2.Error) as error:
         print(error)
@@ -0,0 +1,151 @@
+import gzip
+import os
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from etl_metrics import EtlProfiler
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File signatures of supported compression formats
+compression_signatures = {
+    b'\x1f\x8b': 'gzip',
+    b'PK\x03\x04': 'zip',
+    b'\x28\xb5\x2f\xfd': 'zstd'
+}
+# Size of decompressed blocks written to parser
+DECOMPRESS_BLOCK_SIZE = 1024 * 1024
+
+
+def compression_format(path: str):
+    # Compression format by file signature (extension may be wrong), None for plain file
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for signature, fmt in compression_signatures.items():
+        if head.startswith(signature):
+            return fmt
+    return None
+
+
+def zip_csv_members(archive: zipfile.ZipFile) -> list:
+    # CSV files of archive in order of names, so repeated loads read lines in the same order
+    return sorted([
+        info.filename for info in archive.infolist()
+        if not info.is_dir() and info.filename.lower().endswith('.csv')
+    ])
+
+
+def decompressed_streams(path: str, fmt: str):
+    # Yields binary streams of decompressed CSV files, zip archive may contain several of them
+    match fmt:
+        case 'gzip':
+            with gzip.open(path, 'rb') as stream:
+                yield stream
+        case 'zip':
+            with zipfile.ZipFile(path) as archive:
+                members = zip_csv_members(archive)
+                if not members:
+                    raise ValueError(f"there are no CSV files in archive '{path}'")
+                for member in members:
+                    with archive.open(member) as stream:
+                        yield stream
+        case 'zstd':
+            if zstandard is None:
+                raise ValueError(f"'zstandard' package is required to load '{path}'")
+            with open(path, 'rb') as f, zstandard.ZstdDecompressor().stream_reader(f) as stream:
+                yield stream
+        case _:
+            raise ValueError(f"compression format '{fmt}' is not supported")
+
+
+def write_decompressed(path: str, fmt: str, pipe_in, stats: dict, profiler: EtlProfiler):
+    """
+    Decompresses file into pipe. CSV files of zip archive are written one after another as one CSV: header line
+    of every next file is skipped if it's the same as the first one, missing line break at the end of file is added.
+    Decompression time (without waiting for parser) is profiled as 'decompress' phase.
+    """
+    header = None
+    last_byte = b'\n'
+    seconds = 0.0
+    for stream in decompressed_streams(path, fmt):
+        start = time.perf_counter()
+        block = stream.readline()
+        stats['uncompressed_bytes'] += len(block)
+        if header is None:
+            header = block
+        elif block == header:
+            block = b''
+        if last_byte != b'\n':
+            block = b'\n' + block
+        while True:
+            seconds += time.perf_counter() - start
+            if block:
+                pipe_in.write(block)
+                last_byte = block[-1:]
+            start = time.perf_counter()
+            block = stream.read(DECOMPRESS_BLOCK_SIZE)
+            if not block:
+                break
+            stats['uncompressed_bytes'] += len(block)
+        seconds += time.perf_counter() - start
+    profiler.add('decompress', seconds, bytes_count=stats['uncompressed_bytes'])
+
+
+@contextmanager
+def open_csv_source(path: str, stats: dict = None, profiler: EtlProfiler = None):
+    """
+    Opens CSV source file as iterable of text lines for csv.reader. Compressed files (gzip, zstd, zip with one or
+    several CSV files) are detected by signature and decompressed on the fly by background thread into OS pipe,
+    so nothing is written to disk and parser works in parallel with decompression. Plain files are opened as is.
+    Decompression error is raised by iteration at the end of lines, so truncated data can't be loaded as whole file.
+    :param stats: dict, it gets 'compression' (format or None), 'compressed_bytes' (file size)
+    and 'uncompressed_bytes' (CSV bytes, known after all lines are read)
+    :param profiler: decompression is profiled as 'decompress' phase
+
+    Example
+        stats = {}
+        with open_csv_source('source_data/new/sales_2019_04.csv.gz', stats) as lines:
+            for line in csv.reader(lines):
+                ...
+        stats -> {'compression': 'gzip', 'compressed_bytes': 1500000, 'uncompressed_bytes': 8000000}
+    """
+    stats = {} if stats is None else stats
+    profiler = profiler or EtlProfiler()
+    fmt = compression_format(path)
+    stats.update({'compression': fmt, 'compressed_bytes': os.path.getsize(path), 'uncompressed_bytes': 0})
+    if fmt is None:
+        stats['uncompressed_bytes'] = stats['compressed_bytes']
+        with open(path, newline='') as f:
+            yield f
+        return
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def produce():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe_in:
+                write_decompressed(path, fmt, pipe_in, stats, profiler)
+        except BrokenPipeError:
+            # Parser stopped reading (e.g. after error), the rest of file isn't needed
+            pass
+        except Exception as error:
+            errors.append(error)
+
+    def lines(pipe_out):
+        yield from pipe_out
+        producer.join()
+        if errors:
+            raise errors[0]
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    try:
+        with os.fdopen(read_fd, newline='', buffering=DECOMPRESS_BLOCK_SIZE) as pipe_out:
+            yield lines(pipe_out)
+    finally:
+        producer.join()
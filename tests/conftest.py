@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules of repository are imported as from its root (e.g. 'python -m ods.export')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
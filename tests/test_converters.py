@@ -0,0 +1,95 @@
+import os
+import pytest
+from benchmark.converters import baseline_line_converter, valid_lines
+from benchmark.sales_generator import generate_sales_csv
+from ddl_func import column_parsers, column_sql_type, loading_columns, sql_type_numpy_dtypes
+from stage.converters import compile_line_converter, compile_batch_converter, numpy_column, \
+    parse_timestamp_mdy_hm, np
+
+# Source table of stage (see stage/db_structure.py), CSV lines have values of its loaded columns
+source_table_ddl = {
+    "id": "BIGSERIAL PRIMARY KEY",
+    "order_id": "INT",
+    "product": "VARCHAR",
+    "quantity_ordered": "INT",
+    "price_per_each": "DECIMAL",
+    "order_date": "TIMESTAMP",
+    "purchase_address": "TEXT",
+    "created_at": "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+    "updated_at": "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+    "etl_meta_info_id": "BIGINT"
+}
+csv_columns = loading_columns(source_table_ddl, exclude=("etl_meta_info_id",))
+csv_column_types = [column_sql_type(source_table_ddl[column]) for column in csv_columns]
+
+
+def line_converter():
+    # Same converter as 'sales_line_converter' of stage/etl.py
+    return compile_line_converter(
+        column_parsers(source_table_ddl, csv_columns, {"TIMESTAMP": parse_timestamp_mdy_hm}),
+        memo_columns=[i for i, column_type in enumerate(csv_column_types) if column_type == "TIMESTAMP"]
+    )
+
+
+def batch_converter():
+    return compile_batch_converter(
+        line_converter(),
+        numpy_dtypes={i: sql_type_numpy_dtypes[column_type] for i, column_type in enumerate(csv_column_types)
+                      if column_type in sql_type_numpy_dtypes}
+    )
+
+
+@pytest.fixture(scope='module')
+def lines(tmp_path_factory):
+    path = os.path.join(tmp_path_factory.mktemp('csv'), 'sales.csv')
+    generate_sales_csv(path, 2000, seed=1)
+    return valid_lines(path)
+
+
+def test_line_converter_matches_baseline(lines):
+    convert = line_converter()
+    assert [convert(line) for line in lines] == [baseline_line_converter(line) for line in lines]
+
+
+def test_batch_converter_matches_baseline(lines):
+    convert_batch = batch_converter()
+    assert convert_batch(lines) == [baseline_line_converter(line) for line in lines]
+    assert convert_batch([]) == []
+
+
+def test_converter_errors_are_raised_as_by_baseline(lines):
+    line = list(lines[0])
+    line[2] = 'Quantity Ordered'
+    with pytest.raises(ValueError):
+        baseline_line_converter(line)
+    with pytest.raises(ValueError):
+        line_converter()(line)
+    with pytest.raises(ValueError):
+        batch_converter()([lines[0], line])
+
+
+def test_memoized_columns():
+    calls = []
+
+    def parse(val):
+        calls.append(val)
+        return int(val)
+
+    convert = compile_line_converter((parse, str), memo_columns=(0, 1))
+    assert [convert(['1', 'a']), convert(['1', 'b'])] == [[1, 'a'], [1, 'b']]
+    assert calls == ['1']
+    # str columns are passed as is, without cache
+    assert convert.converters[1] is str
+    # Extra values of line are ignored
+    assert convert(['2', 'c', 'extra']) == [2, 'c']
+
+
+@pytest.mark.skipif(np is None, reason="NumPy is not installed")
+def test_numpy_column_falls_back_to_converter():
+    assert numpy_column(('1', '2', '3'), 'int64', int) == [1, 2, 3]
+    assert numpy_column(('1.5', '2'), 'float64', float) == [1.5, 2.0]
+    assert numpy_column(('1_000', ' 2'), 'int64', int) == [1000, 2]
+    # Too big for int64, but valid for int()
+    assert numpy_column(('1', '99999999999999999999'), 'int64', int) == [1, 99999999999999999999]
+    with pytest.raises(ValueError):
+        numpy_column(('1', 'x', '3'), 'int64', int)
@@ -0,0 +1,155 @@
+import random
+from collections import defaultdict
+import numpy as np
+import pytest
+from ods.cube import ColumnarCube, cube_fact_columns
+from ods.olap import OlapQueryError
+
+products = ["", "iPhone", "Google Phone", "USB-C Charging Cable"]
+dates = [(0, 0, 0), (2019, 1, 5), (2019, 1, 20), (2019, 12, 31), (2020, 1, 1)]
+
+
+@pytest.fixture(scope='module')
+def facts():
+    rnd = random.Random(7)
+    return [
+        {"sys_id": i, "product_id": rnd.randint(1, 3), "datetime_id": rnd.randint(1, 4),
+         "quantity": rnd.randint(1, 5), "price_per_each": rnd.choice([2.99, 11.95, 700.0])}
+        for i in range(1, 501)
+    ]
+
+
+@pytest.fixture(scope='module')
+def cube(facts):
+    cube = ColumnarCube()
+    for column in cube.facts:
+        values = [fact.get(column, 0) for fact in facts] if column != 'total_price' else \
+            [fact['quantity'] * fact['price_per_each'] for fact in facts]
+        cube.facts[column] = np.array(values, dtype=cube.facts[column].dtype)
+    cube.attributes['product_name'] = np.array(products)
+    for i, name in enumerate(('year', 'month', 'day')):
+        cube.attributes[name] = np.array([date[i] for date in dates], dtype='int64')
+    return cube
+
+
+def expected_group_by(facts, key, where=lambda fact: True):
+    groups = defaultdict(lambda: [0, 0.0, 0, 0.0])
+    for fact in facts:
+        if where(fact):
+            group = groups[key(fact)]
+            group[0] += fact['quantity']
+            group[1] += fact['quantity'] * fact['price_per_each']
+            group[2] += 1
+            group[3] += fact['price_per_each']
+    return [(*k, q, pytest.approx(revenue), lines, pytest.approx(price_sum / lines))
+            for k, (q, revenue, lines, price_sum) in sorted(groups.items())]
+
+
+def test_query_matches_group_by(cube, facts):
+    columns, rows = cube.query(
+        ["Product", "Order Year"], ["Product Quantity", "Order Full Price", "Order Lines", "Product Price"])
+    assert columns == ["Product", "Order Year", "Product Quantity", "Order Full Price", "Order Lines", "Product Price"]
+    assert rows == expected_group_by(facts, lambda fact: (products[fact['product_id']], dates[fact['datetime_id']][0]))
+
+
+def test_query_with_filters(cube, facts):
+    _, rows = cube.query(
+        ["Order Month"], ["Product Quantity", "Order Full Price", "Order Lines", "Product Price"],
+        [("Order Year", "=", 2019), ("Product", "in", ["iPhone", "Google Phone"])]
+    )
+    assert rows == expected_group_by(
+        facts, lambda fact: (dates[fact['datetime_id']][1],),
+        lambda fact: dates[fact['datetime_id']][0] == 2019 and fact['product_id'] in (1, 2)
+    )
+
+
+def test_query_without_dimensions(cube, facts):
+    _, rows = cube.query([], ["Order Lines", "Product Quantity"], [("Order Day", "between", (1, 20))])
+    selected = [fact for fact in facts if 1 <= dates[fact['datetime_id']][2] <= 20]
+    assert rows == [(len(selected), sum(fact['quantity'] for fact in selected))]
+    assert cube.query([], ["Order Lines"], [("Order Year", ">", 2020)])[1] == []
+
+
+def test_query_errors(cube):
+    with pytest.raises(OlapQueryError):
+        cube.query(["Order Full Date"], ["Order Lines"])
+
+
+class FakeOdsCursor:
+    # Cursor over ODS tables kept in Python: {table: {id: tuple of values}} and list of fact dicts
+    def __init__(self, tables: dict, facts: list, finished_etl_meta_info_id: int):
+        self.tables = tables
+        self.facts = facts
+        self.finished_etl_meta_info_id = finished_etl_meta_info_id
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        if 'etl_meta_info' in sql and 'FROM sales_info' not in sql:
+            self.rows = [(self.finished_etl_meta_info_id,)]
+        elif 'FROM sales_info' in sql:
+            last, max_id = params
+            self.rows = [tuple(fact[column] for column in cube_fact_columns) for fact in self.facts
+                         if last < fact['sys_etl_meta_info_id'] <= max_id]
+        else:
+            table = sql.split(' FROM ')[1].split()[0]
+            self.rows = [(row_id, *values) for row_id, values in sorted(self.tables[table].items())
+                         if row_id >= params[0]]
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+def fact(sys_id, product_id, datetime_id, quantity, price, etl_meta_info_id):
+    return {"sys_id": sys_id, "order_id": sys_id, "product_id": product_id, "purchase_address_id": 1,
+            "datetime_id": datetime_id, "quantity": quantity, "price_per_each": price,
+            "total_price": quantity * price, "sys_etl_meta_info_id": etl_meta_info_id}
+
+
+def test_refresh_save_load_and_updated_facts(tmp_path):
+    tables = {
+        "sales_order": {i: (1000 + i,) for i in range(1, 5)},
+        "sales_product": {1: ("iPhone",), 2: ("Google Phone",)},
+        "sales_purchase_address": {1: ("917 1st St, Dallas, TX 75001",)},
+        "sales_date": {1: (2019, 1, 5)}
+    }
+    facts = [fact(1, 1, 1, 1, 700.0, 1), fact(2, 2, 1, 2, 600.0, 1), fact(3, 2, 1, 1, 600.0, 1)]
+    path = str(tmp_path / 'cube')
+    cube = ColumnarCube.load(path)
+    assert cube.refresh(FakeOdsCursor(tables, facts, 1)) == 3
+    cube.save()
+
+    cube = ColumnarCube.load(path)
+    assert isinstance(cube.facts['sys_id'], np.memmap)
+    assert cube.query(["Product"], ["Product Quantity", "Order Lines"])[1] == \
+        [("Google Phone", 3, 2), ("iPhone", 1, 1)]
+
+    # Run 2 updates fact 2 to new product and adds fact of new date, run 3 is still in progress
+    tables["sales_product"][3] = ("USB-C Charging Cable",)
+    tables["sales_date"][2] = (2019, 2, 1)
+    facts[1] = fact(2, 3, 1, 5, 11.95, 2)
+    facts += [fact(4, 1, 2, 1, 700.0, 2), fact(5, 1, 2, 1, 700.0, 3)]
+    assert cube.refresh(FakeOdsCursor(tables, facts, 2)) == 2
+    assert len(cube) == 4
+    expected = [
+        ("Google Phone", 1, 1, 1, 600.0),
+        ("USB-C Charging Cable", 1, 5, 1, pytest.approx(59.75)),
+        ("iPhone", 1, 1, 1, 700.0),
+        ("iPhone", 2, 1, 1, 700.0)
+    ]
+    assert cube.query(["Product", "Order Month"], ["Product Quantity", "Order Lines", "Order Full Price"])[1] == \
+        expected
+    cube.save()
+
+    cube = ColumnarCube.load(path)
+    assert cube.last_etl_meta_info_id == 2
+    assert cube.query(["Product", "Order Month"], ["Product Quantity", "Order Lines", "Order Full Price"])[1] == \
+        expected
+    assert cube.refresh(FakeOdsCursor(tables, facts, 2)) == 0
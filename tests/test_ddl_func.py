@@ -0,0 +1,47 @@
+from datetime import datetime
+import pytest
+from ddl_func import add_missing_columns, partition_bounds, partition_name
+
+
+@pytest.mark.parametrize("ts, interval, bounds", [
+    (datetime(2019, 12, 30, 8, 46), 'month', (datetime(2019, 12, 1), datetime(2020, 1, 1))),
+    (datetime(2019, 11, 30, 23, 59), 'month', (datetime(2019, 11, 1), datetime(2019, 12, 1))),
+    (datetime(2019, 1, 1), 'month', (datetime(2019, 1, 1), datetime(2019, 2, 1))),
+    (datetime(2019, 12, 31, 23, 59), 'day', (datetime(2019, 12, 31), datetime(2020, 1, 1))),
+    (datetime(2020, 2, 28, 12), 'day', (datetime(2020, 2, 28), datetime(2020, 2, 29))),
+    (datetime(2019, 12, 31), 'year', (datetime(2019, 1, 1), datetime(2020, 1, 1)))
+])
+def test_partition_bounds(ts, interval, bounds):
+    assert partition_bounds(ts, interval) == bounds
+
+
+def test_partition_bounds_unknown_interval():
+    with pytest.raises(ValueError):
+        partition_bounds(datetime(2019, 12, 1), 'week')
+
+
+def test_partition_name():
+    assert partition_name('sales_info', datetime(2019, 12, 30, 8, 46)) == 'sales_info_p2019_12'
+    assert partition_name('sales_info', datetime(2019, 4, 1), 'day') == 'sales_info_p2019_04_01'
+
+
+class ColumnsCursor:
+    # Cursor of database with table 't' having columns 'id' and 'state'
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql):
+        self.statements.append(sql)
+
+    def fetchall(self):
+        return [("id",), ("state",)]
+
+
+def test_add_missing_columns():
+    cur = ColumnsCursor()
+    added = add_missing_columns(cur, 't', {"id": "BIGSERIAL PRIMARY KEY", "state": "VARCHAR", "rows_count": "BIGINT"})
+    assert added == ["rows_count"]
+    assert cur.statements[-1] == "ALTER TABLE t \n\tADD COLUMN IF NOT EXISTS rows_count BIGINT"
+    cur = ColumnsCursor()
+    assert add_missing_columns(cur, 't', {"id": "BIGSERIAL PRIMARY KEY"}) == []
+    assert len(cur.statements) == 1
@@ -0,0 +1,27 @@
+import os
+from stage.dedup import LineDeduplicator
+
+
+def test_duplicates_are_found_in_memory_and_spilled_fingerprints(tmp_path):
+    with LineDeduplicator(max_memory_fingerprints=3, spill_dir=str(tmp_path)) as dedup:
+        lines = [(str(i), 'USB-C Charging Cable', '1') for i in range(10)]
+        assert [dedup.is_duplicate(line) for line in lines] == [False] * 10
+        # 9 fingerprints were spilled by 3, the last one is in memory
+        assert len(os.listdir(tmp_path)) == 1
+        assert len(dedup._fingerprints) == 1
+        assert [dedup.is_duplicate(line) for line in lines] == [True] * 10
+        assert not dedup.is_duplicate(('10', 'USB-C Charging Cable', '1'))
+
+
+def test_values_are_not_joined_ambiguously():
+    with LineDeduplicator() as dedup:
+        assert not dedup.is_duplicate(('1', '23'))
+        assert not dedup.is_duplicate(('12', '3'))
+
+
+def test_close_removes_spill_file(tmp_path):
+    dedup = LineDeduplicator(max_memory_fingerprints=1, spill_dir=str(tmp_path))
+    dedup.is_duplicate(('1',))
+    assert len(os.listdir(tmp_path)) == 1
+    dedup.close()
+    assert os.listdir(tmp_path) == []
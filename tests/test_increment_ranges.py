@@ -0,0 +1,57 @@
+import pytest
+from ods.etl import increment_ranges
+
+
+class NtileCursor:
+    # Stage cursor computing 'ntile' bounds of values in Python, mogrify keeps params for checks
+    def __init__(self, values: list):
+        self.values = values
+        self.rows = []
+        self.mogrified = []
+
+    def execute(self, sql, params=None):
+        count = int(sql.split('ntile(')[1].split(')')[0])
+        ordered = sorted(self.values)
+        # PostgreSQL ntile: the first 'len % count' buckets have one row more
+        size, rest = divmod(len(ordered), count)
+        bounds, start = [], 0
+        for part in range(min(count, len(ordered))):
+            bounds.append((ordered[start],))
+            start += size + (1 if part < rest else 0)
+        self.rows = bounds
+
+    def fetchall(self):
+        return self.rows
+
+    def mogrify(self, sql, params):
+        self.mogrified.append((sql, params))
+        return sql.encode()
+
+
+def range_rows(sql: str, params: list, values: list) -> list:
+    lower = params[0] if '>= %s' in sql else None
+    upper = params[-1] if '< %s' in sql else None
+    return [val for val in values if (lower is None or val >= lower) and (upper is None or val < upper)]
+
+
+@pytest.mark.parametrize("values, count, ranges", [
+    (list(range(100)), 4, 4),
+    (list(range(3)), 8, 3),
+    ([5] * 50 + [7] * 50, 4, 2),
+    ([1] * 10, 3, 1),
+    ([], 4, 0)
+])
+def test_ranges_are_disjoint_and_cover_increment(values, count, ranges):
+    cur = NtileCursor(values)
+    queries = increment_ranges(cur, "SELECT * FROM sales", "created_at", count)
+    assert len(queries) == ranges
+    covered = sorted(val for sql, params in cur.mogrified for val in range_rows(sql, params, values))
+    assert covered == sorted(values)
+
+
+def test_first_and_last_ranges_are_open():
+    cur = NtileCursor(list(range(10)))
+    increment_ranges(cur, "SELECT * FROM sales", "created_at", 2)
+    (first_sql, first_params), (last_sql, last_params) = cur.mogrified
+    assert first_sql.endswith("s WHERE created_at < %s") and first_params == [5]
+    assert last_sql.endswith("s WHERE created_at >= %s") and last_params == [5]
@@ -0,0 +1,99 @@
+import pickle
+from datetime import datetime
+import pytest
+from ods.olap import OlapQueryError, QueryResultCache, choose_rollup, compile_query
+
+
+def normalized(sql: str) -> str:
+    return ' '.join(sql.split())
+
+
+def test_choose_rollup():
+    # The smallest rollup having all dimensions: almost every purchase address is unique,
+    # so address rollup is bigger than product rollup having more dimensions
+    assert choose_rollup({"Order Year", "Order Month"}, ["Order Full Price"]) == 'rollup_product_day'
+    assert choose_rollup(set(), ["Order Lines"]) == 'rollup_product_day'
+    assert choose_rollup(set(), ["Order Lines"], {'rollup_product_day': 9000, 'rollup_address_month': 100}) == \
+        'rollup_address_month'
+    assert choose_rollup({"Purchase Address"}, ["Order Lines"]) == 'rollup_address_month'
+    assert choose_rollup({"Product", "Order Day"}, ["Order Lines"]) == 'rollup_product_day'
+    # No rollup has both dimensions, average price is not additive
+    assert choose_rollup({"Product", "Purchase Address"}, ["Order Lines"]) is None
+    assert choose_rollup({"Product"}, ["Product Price"]) is None
+    assert choose_rollup({"Order"}, ["Order Lines"]) is None
+
+
+def test_compile_query_by_rollup():
+    sql, params = compile_query(["Product"], ["Order Full Price"], [("Order Year", "=", 2019)])
+    assert normalized(sql) == (
+        "SELECT sp.name, coalesce(sum(r.revenue), 0) FROM rollup_product_day r "
+        "JOIN sales_product sp ON r.product_id = sp.id WHERE r.year = %s GROUP BY 1 ORDER BY 1"
+    )
+    assert params == [2019]
+
+
+def test_compile_query_by_facts_with_partition_pruning():
+    sql, params = compile_query(
+        ["Order", "Order Month"], ["Product Price"],
+        [("Order Year", "=", 2019), ("Order Month", "=", 12), ("Product", "in", ("iPhone", "Macbook Pro Laptop"))]
+    )
+    assert normalized(sql) == (
+        "SELECT so.order_id, date_part('month', si.order_ts)::INT, avg(si.price_per_each) FROM sales_info si "
+        "JOIN sales_order so ON si.order_id = so.id JOIN sales_product sp ON si.product_id = sp.id "
+        "WHERE date_part('year', si.order_ts)::INT = %s AND date_part('month', si.order_ts)::INT = %s "
+        "AND sp.name = ANY(%s) AND si.order_ts >= %s AND si.order_ts < %s GROUP BY 1, 2 ORDER BY 1, 2"
+    )
+    assert params == [2019, 12, ["iPhone", "Macbook Pro Laptop"], datetime(2019, 12, 1), datetime(2020, 1, 1)]
+
+
+def test_compile_query_without_dimensions():
+    sql, params = compile_query([], ["Order Lines"], [("Order Day", "between", (1, 15))])
+    assert normalized(sql) == \
+        "SELECT coalesce(sum(r.order_lines), 0)::BIGINT FROM rollup_product_day r WHERE r.day BETWEEN %s AND %s"
+    assert params == [1, 15]
+
+
+def test_measures_have_same_types_by_rollup_and_facts():
+    # "Order Day" needs the product rollup, "Order" only exists in facts
+    rollup_sql, _ = compile_query(["Order Day"], ["Product Quantity", "Order Full Price", "Order Lines"])
+    facts_sql, _ = compile_query(["Order"], ["Product Quantity", "Order Full Price", "Order Lines"])
+    assert "FROM rollup_product_day r" in rollup_sql and "FROM sales_info si" in facts_sql
+    assert "coalesce(sum(r.quantity), 0)::BIGINT, coalesce(sum(r.revenue), 0), " \
+           "coalesce(sum(r.order_lines), 0)::BIGINT" in rollup_sql
+    assert "coalesce(sum(si.quantity), 0)::BIGINT, coalesce(sum(si.total_price), 0), count(*)" in facts_sql
+
+
+@pytest.mark.parametrize("dimensions, measures, filters", [
+    (["Customer"], ["Order Lines"], []),
+    (["Product"], ["Profit"], []),
+    (["Product"], ["Order Lines"], [("Order Year", "like", 2019)])
+])
+def test_compile_query_errors(dimensions, measures, filters):
+    with pytest.raises(OlapQueryError):
+        compile_query(dimensions, measures, filters)
+
+
+def test_query_result_cache_evicts_least_recently_used():
+    cache = QueryResultCache(max_entries=2)
+    cache.put('a', [1])
+    cache.put('b', [2])
+    assert cache.get('a') == [1]
+    cache.put('c', [3])
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == ([1], [3])
+
+
+def test_query_result_cache_is_limited_by_size():
+    small = [(1, 2.0)]
+    large = [(i, float(i)) for i in range(1000)]
+    cache = QueryResultCache(max_bytes=len(pickle.dumps(large)) + 10)
+    cache.put('small', small)
+    cache.put('large', large)
+    # Both results don't fit, the least recently used one is evicted
+    assert cache.get('small') is None
+    assert cache.get('large') == large
+    cache.put('too large', large * 2)
+    assert cache.get('too large') is None
+    assert cache.get('large') == large
+    cache.clear()
+    assert cache.size == 0 and cache.get('large') is None
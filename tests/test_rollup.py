@@ -0,0 +1,38 @@
+from ods.db_structure import rollups
+from ods.rollup import apply_rollup_delta_sql, build_rollup_sql
+
+
+def normalized(sql: str) -> str:
+    return ' '.join(sql.split())
+
+
+def test_apply_rollup_delta_sql_subtracts_old_values_of_changed_facts():
+    sql = normalized(apply_rollup_delta_sql(
+        'rollup_address_month', rollups['rollup_address_month'], "si.source_id IN (SELECT source_id FROM changed_facts)",
+        sign=-1
+    ))
+    assert sql.startswith(
+        "INSERT INTO rollup_address_month (purchase_address_id, year, month, quantity, revenue, order_lines) SELECT")
+    assert "-1 * sum(si.quantity) AS quantity, -1 * sum(si.total_price) AS revenue, -1 * count(*) AS order_lines" in sql
+    assert "FROM sales_info si WHERE si.source_id IN (SELECT source_id FROM changed_facts)" in sql
+    assert "GROUP BY si.purchase_address_id, date_part('year', si.order_ts)::INT, " \
+           "date_part('month', si.order_ts)::INT" in sql
+    assert sql.endswith(
+        "ON CONFLICT (purchase_address_id, year, month) DO UPDATE SET "
+        "quantity = rollup_address_month.quantity + EXCLUDED.quantity, "
+        "revenue = rollup_address_month.revenue + EXCLUDED.revenue, "
+        "order_lines = rollup_address_month.order_lines + EXCLUDED.order_lines")
+
+
+def test_apply_rollup_delta_sql_adds_new_values():
+    sql = normalized(apply_rollup_delta_sql('rollup_product_day', rollups['rollup_product_day'], "si.sys_id > 10"))
+    assert "1 * sum(si.quantity) AS quantity" in sql
+    assert "-1 *" not in sql
+    assert "ON CONFLICT (product_id, year, month, day)" in sql
+
+
+def test_build_rollup_sql_fills_only_empty_rollup():
+    sql = normalized(build_rollup_sql('rollup_product_day', rollups['rollup_product_day']))
+    assert sql.startswith("INSERT INTO rollup_product_day (product_id, year, month, day, quantity, revenue, order_lines)")
+    assert "WHERE NOT EXISTS (SELECT 1 FROM rollup_product_day)" in sql
+    assert "ON CONFLICT" not in sql